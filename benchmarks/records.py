@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Benchmark the memory per queued message of the forwarder queue with plain dicts
+compared to the compact records.
+
+$ python3 benchmarks/records.py --messages 100000
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from log_proxy.forwarders import Forwarder
+from log_proxy.records import Record
+
+
+def create_frames(count: int, hosts: int) -> list:
+    frames = []
+    for i in range(count):
+        message = {
+            "level": random.choice((10, 20, 30, 40)),
+            "pid": 1234,
+            "host": f"host-{i % hosts}.example.org",
+            "message": f"Request {i} finished",
+            "created_at": "2021-01-01 00:00:00.000000",
+            "created_by": "app.requests",
+            "exception": None,
+            "path": "/usr/lib/python3/site-packages/app/requests.py",
+            "lineno": 42,
+        }
+        frames.append(json.dumps(message).encode())
+    return frames
+
+
+def bench(frames: list, convert) -> tuple:
+    forwarder = Forwarder()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for frame in frames:
+        forwarder.put_nowait(convert(json.loads(frame)))
+    duration = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(frames), duration / len(frames)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--hosts", type=int, default=100)
+    args = parser.parse_args()
+
+    frames = create_frames(args.messages, args.hosts)
+    print(f"{'type':>8} {'memory':>14} {'decode and queue':>18}")
+    for name, convert in (("dict", lambda x: x), ("record", Record)):
+        size, duration = bench(frames, convert)
+        print(f"{name:>8} {size:>8.0f} bytes {duration * 1e6:>15.2f} us")
+
+
+if __name__ == "__main__":
+    main()
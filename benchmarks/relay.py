@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Benchmark the cost per frame of a relaying server compared to decoding and
+encoding the frames again.
+
+$ python3 benchmarks/relay.py --frames 100000 --size 200
+"""
+
+import argparse
+import asyncio
+import json
+import struct
+import time
+
+from log_proxy import LogServer, SocketForwarder
+
+
+def create_frame(size: int) -> bytes:
+    message = {
+        "level": 20,
+        "pid": 1234,
+        "message": "x" * size,
+        "created_at": "2021-01-01 00:00:00",
+        "created_by": "bench",
+    }
+    data = json.dumps(message).encode()
+    return struct.pack(">L", len(data)) + data
+
+
+async def bench(frame: bytes, count: int, relay: bool) -> float:
+    forwarder = SocketForwarder("127.0.0.1", 0)
+    server = LogServer("127.0.0.1", 0, forwarder, relay=relay)
+    host = b'{"host": "client", '
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(frame * count)
+    reader.feed_eof()
+
+    start = time.perf_counter()
+    for _ in range(count):
+        message = await server._read_message(reader, host=host)
+        message = server._validate_message(message, ["level"])
+        await server._process_message(message, "client")
+        forwarder._frame(forwarder.queue.get_nowait()[-1])
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--size", type=int, nargs="+", default=[100, 1000, 10000])
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'decode':>12} {'relay':>12}")
+    for size in args.size:
+        frame = create_frame(size)
+        decode = asyncio.run(bench(frame, args.frames, False))
+        relay = asyncio.run(bench(frame, args.frames, True))
+        print(
+            f"{size:>8} {decode / args.frames * 1e6:>9.2f} us "
+            f"{relay / args.frames * 1e6:>9.2f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Benchmark the syslog messages per second which a server can read, parse and
+queue on a single core.
+
+$ python3 benchmarks/syslog.py --messages 100000
+"""
+
+import argparse
+import asyncio
+import time
+
+from log_proxy import LogServer
+from log_proxy.forwarders import Forwarder
+from log_proxy.parsers import parse_syslog
+
+MESSAGES = {
+    "rfc5424": b"<34>1 2021-01-01T00:00:00.000Z host app 1234 ID47 - message text",
+    "rfc3164": b"<34>Jan  1 00:00:00 host app[1234]: message text",
+}
+
+
+async def bench(message: bytes, count: int, octets: bool) -> float:
+    server = LogServer("127.0.0.1", 0, Forwarder(), use_auth=False)
+    frame = b"%d %s" % (len(message), message) if octets else message + b"\n"
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(frame * count)
+    reader.feed_eof()
+
+    start = time.perf_counter()
+    for _ in range(count):
+        data = await server._read_syslog_frame(reader)
+        await server._process_message(
+            server._prepare_message(parse_syslog(data, "127.0.0.1"))
+        )
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'format':>8} {'framing':>8} {'messages/s':>12}")
+    for name, message in MESSAGES.items():
+        for octets in (True, False):
+            duration = asyncio.run(bench(message, args.messages, octets))
+            framing = "octets" if octets else "newline"
+            print(f"{name:>8} {framing:>8} {args.messages / duration:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
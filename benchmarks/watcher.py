@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Benchmark the startup time and the event latency of the watcher depending on
+the number of watched files.
+
+$ python3 benchmarks/watcher.py --files 1000 10000 50000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from log_proxy.forwarders import Forwarder
+from log_proxy.watcher import WatcherHandler, watch
+
+
+def create_files(path: str, count: int, per_directory: int = 100) -> list:
+    files = []
+    for i in range(count):
+        directory = os.path.join(path, f"dir{i // per_directory}")
+        os.makedirs(directory, exist_ok=True)
+
+        filename = os.path.join(directory, f"app{i}.log")
+        with open(filename, "w") as fp:
+            fp.write("existing line\n")
+        files.append(filename)
+    return files
+
+
+def bench_startup(path: str, workers: int) -> float:
+    handler = WatcherHandler(patterns=["*.log"], workers=workers)
+    start = time.perf_counter()
+    handler.read_initial_size(path)
+    return time.perf_counter() - start
+
+
+async def bench_latency(path: str, files: list, samples: int) -> list:
+    forwarder = Forwarder()
+    task = asyncio.create_task(watch(path, forwarder, patterns=["*.log"]))
+    await asyncio.sleep(1)
+
+    latencies = []
+    step = max(1, len(files) // samples)
+    for filename in files[::step][:samples]:
+        start = time.perf_counter()
+        with open(filename, "a") as fp:
+            fp.write("new line\n")
+
+        await asyncio.wait_for(forwarder.get(), 10)
+        latencies.append(time.perf_counter() - start)
+
+    task.cancel()
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'startup':>10} {'1 worker':>10} {'latency p50/p99':>18}")
+    for count in args.files:
+        with tempfile.TemporaryDirectory() as path:
+            files = create_files(path, count)
+            parallel = bench_startup(path, args.workers)
+            single = bench_startup(path, 1)
+            latencies = asyncio.run(bench_latency(path, files, args.samples))
+            p50 = statistics.median(latencies) * 1000
+            p99 = sorted(latencies)[int(len(latencies) * 0.99) - 1] * 1000
+            print(
+                f"{count:>8} {parallel:>9.3f}s {single:>9.3f}s "
+                f"{p50:>8.1f}/{p99:.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
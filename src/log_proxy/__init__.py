@@ -1,12 +1,21 @@
-from .forwarders import MongoDBForwarder, PostgresForwarder, SocketForwarder
-from .handlers import JSONSocketHandler
+from .forwarders import (
+    FileForwarder,
+    MongoDBForwarder,
+    PostgresForwarder,
+    SocketForwarder,
+    SQLiteForwarder,
+)
+from .handlers import JSONDatagramHandler, JSONSocketHandler
 from .server import LogServer, LogTokenFileError
 
 __all__ = [
+    "FileForwarder",
+    "JSONDatagramHandler",
     "JSONSocketHandler",
     "LogServer",
     "LogTokenFileError",
     "MongoDBForwarder",
     "PostgresForwarder",
     "SocketForwarder",
+    "SQLiteForwarder",
 ]
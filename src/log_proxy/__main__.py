@@ -2,12 +2,18 @@
 import argparse
 import asyncio
 import logging
+import os
+import signal
+import ssl
+import subprocess
 import sys
 from configparser import ConfigParser
 from typing import Tuple
 
-from . import base, forwarders, utils
+from . import base, forwarders, parsers, utils
+from .bench import Benchmark, parse_distribution, parse_level
 from .handlers import JSONSocketHandler
+from .profiling import SamplingProfiler
 from .server import LogServer
 
 try:
@@ -18,6 +24,9 @@ except ImportError:
 
 _logger = logging.getLogger(__name__)
 
+# Seconds to wait for the remaining lines of the stdin to be sent
+STDIN_DRAIN_TIMEOUT = 10
+
 
 class CustomHelpFormatter(argparse.HelpFormatter):
     def _format_action_invocation(self, action: argparse.Action) -> str:
@@ -96,6 +105,63 @@ def parser_server(parser: argparse.ArgumentParser) -> None:
         f"the server will listen on port {base.DEFAULT_PORT}. "
         "(configuration: %(dest)s)",
     )
+    group.add_argument(
+        "--udp",
+        default=None,
+        metavar="[host][:port]",
+        type=lambda x: utils.parse_address(x, host="", port=base.DEFAULT_PORT),
+        help="Additionally receive logs via UDP on the given address. Every "
+        "datagram contains length prefixed JSON frames like the TCP stream and "
+        "starts with the token frame if --token-file is used. The datagrams are "
+        "neither encrypted nor part of the fair scheduling. "
+        "(configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--syslog",
+        default=None,
+        metavar="[host][:port]",
+        type=lambda x: utils.parse_address(x, host="", port=base.DEFAULT_SYSLOG_PORT),
+        help="Additionally receive syslog messages in the RFC 5424 or RFC 3164 "
+        "format via UDP and TCP on the given address. TCP supports octet counting "
+        "and newline framing. The syslog listeners don't use TLS or tokens. "
+        f"(default port: {base.DEFAULT_SYSLOG_PORT}, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--http",
+        default=None,
+        metavar="[host]:port",
+        type=lambda x: utils.parse_address(x, host=""),
+        help="Additionally accept batches of logs as NDJSON posted to /logs on the "
+        "given address. The body can be gzip compressed and the token is passed "
+        "as bearer token in the Authorization header. Full queues are answered "
+        "with 429. The listener uses the TLS configuration of the server. "
+        "(configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--unix",
+        default=None,
+        metavar="PATH",
+        help="Additionally listen on a Unix socket for local clients. The clients "
+        "are identified by their user instead of a token and the connection isn't "
+        "encrypted. (configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--unix-mode",
+        default=0o660,
+        type=lambda x: int(x, 8),
+        metavar="MODE",
+        help="Permissions of the Unix socket as octal number. "
+        "(default: 660, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--unix-users",
+        default=None,
+        type=utils.parse_users,
+        metavar="USER[,USER]*",
+        help="Only accept clients of the given user names or ids on the Unix "
+        "socket. (default: all users with access to the socket, "
+        "configuration: %(dest)s)",
+    )
     group.add_argument(
         "--ca",
         default=None,
@@ -124,6 +190,16 @@ def parser_server(parser: argparse.ArgumentParser) -> None:
         default=None,
         help="Ciphers to use for the TLS connection. (configuration: %(dest)s)",
     )
+    group.add_argument(
+        "--tls-tickets",
+        default=2,
+        type=int,
+        metavar="COUNT",
+        help="Number of TLS 1.3 session tickets issued per handshake which allow "
+        "reconnecting clients to resume the session without a full handshake. The "
+        "ticket keys are renewed with every start of the server. Use 0 to disable "
+        "the resumption. (default: %(default)s, configuration: %(dest)s)",
+    )
     group.add_argument(
         "--token-file",
         type=utils.valid_file,
@@ -131,6 +207,142 @@ def parser_server(parser: argparse.ArgumentParser) -> None:
         help="Enable token authentication using the given json file to store the "
         "trusted tokens. (configuration: %(dest)s)",
     )
+    group.add_argument(
+        "--client-queue-size",
+        default=0,
+        type=int,
+        help="Enable the fair scheduling between the clients using a queue of the "
+        "given size per client. The clients are weighted by the optional weight "
+        "in the token file. Without --token-file all clients share one queue and "
+        "no fairness is applied. The scheduler waits for space in the forwarder "
+        "queue, so with --queue-size messages are dropped from the client queues "
+        "instead. (default: disabled, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--queue-size",
+        default=0,
+        type=int,
+        help="Maximum number of messages in the queue of the forwarder. If the "
+        "queue is full the oldest messages with the lowest level are dropped. "
+        "With --client-queue-size the queue applies backpressure to the client "
+        "queues instead. "
+        "(default: unlimited, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--queue-sampling",
+        default=None,
+        type=float,
+        metavar="FILL",
+        help="Start to sample messages below warning level once the queue is "
+        "filled above the given fraction between 0 and 1. "
+        "(configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--dead-letter",
+        default=None,
+        metavar="FILE",
+        help="Append messages which can't be forwarded because they are invalid "
+        "as JSON lines to the file instead of dropping them. "
+        "(configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--stats-interval",
+        default=60,
+        type=float,
+        metavar="SECONDS",
+        help="Interval to report the number of dropped messages. Use 0 to disable "
+        "the reports. (default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--shutdown-timeout",
+        default=30,
+        type=float,
+        metavar="SECONDS",
+        help="Time to forward the queued messages after SIGTERM, SIGUSR2 or a "
+        "replaced forwarder after SIGHUP. SIGUSR2 starts a new process which "
+        "takes over the listening sockets once it's ready. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+
+    group = parser.add_argument_group("Server limits")
+    group.add_argument(
+        "--max-frame-size",
+        default=1 << 20,
+        type=int,
+        metavar="BYTES",
+        help="Close connections which send a larger frame. Use 0 to disable the "
+        "limit. (default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--max-field-size",
+        default=0,
+        type=int,
+        metavar="CHARS",
+        help="Truncate the message and exception of the logs to the given length. "
+        "(default: disabled, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--max-connections",
+        default=0,
+        type=int,
+        help="Maximum number of concurrent connections. "
+        "(default: unlimited, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--max-client-connections",
+        default=0,
+        type=int,
+        help="Maximum number of concurrent connections per client. Without "
+        "--token-file the clients are identified by their address. "
+        "(default: unlimited, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--idle-timeout",
+        default=0,
+        type=float,
+        metavar="SECONDS",
+        help="Close connections which don't send a log within the given time. "
+        "(default: disabled, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--auth-timeout",
+        default=10,
+        type=float,
+        metavar="SECONDS",
+        help="Close connections which don't authenticate within the given time. "
+        "Use 0 to disable the timeout. (default: %(default)s, configuration: "
+        "%(dest)s)",
+    )
+
+    parser_profiling(parser)
+
+
+def parser_profiling(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("Profiling")
+    group.add_argument(
+        "--profile-dir",
+        default=None,
+        metavar="DIR",
+        help="Enable the sampling profiler which is toggled by SIGUSR1. The stacks "
+        "and the timings of the server stages are written into the directory. "
+        "(configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--profile-duration",
+        default=30,
+        type=utils.positive_float,
+        metavar="SECONDS",
+        help="Maximum duration of a profile. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--profile-interval",
+        default=0.005,
+        type=utils.positive_float,
+        metavar="SECONDS",
+        help="Interval between the samples of the profiler. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
 
 
 def parser_forward_database(parser: argparse.ArgumentParser, db: str) -> None:
@@ -169,6 +381,112 @@ def parser_forward_database(parser: argparse.ArgumentParser, db: str) -> None:
         help="The password for the database. (configuration: %(dest)s)",
     )
 
+    if db == "mongodb":
+        group.add_argument(
+            "--db-timeseries",
+            default=False,
+            action="store_true",
+            help="Create the collection as time series collection. "
+            "(configuration: %(dest)s)",
+        )
+        group.add_argument(
+            "--db-ttl",
+            default=0,
+            type=int,
+            metavar="SECONDS",
+            help="Remove the messages after the given time. "
+            "(default: disabled, configuration: %(dest)s)",
+        )
+
+    if db != "postgres":
+        return
+
+    group.add_argument(
+        "--db-partition",
+        default=None,
+        choices=["day", "hour"],
+        help="Partition the table by the creation time of the messages. "
+        "(default: disabled, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--db-retention",
+        default=0,
+        type=int,
+        metavar="PARTITIONS",
+        help="Number of past partitions to keep. Older partitions are dropped. "
+        "(default: keep all, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--db-premake",
+        default=3,
+        type=int,
+        metavar="PARTITIONS",
+        help="Number of future partitions to create ahead of time. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+
+
+def parser_forward_sqlite(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("Forwarding configuration")
+    group.add_argument(
+        "--db",
+        dest="database",
+        default=None,
+        metavar="FILE",
+        help="The database file to log the messages to. (configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--db-table",
+        default="logs",
+        help="The database table to forward the messages. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+
+
+def parser_forward_file(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("Forwarding configuration")
+    group.add_argument(
+        "--file-directory",
+        default=None,
+        help="The directory to write the segment files to. (configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--file-prefix",
+        default="logs",
+        help="The prefix of the segment files. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--file-max-bytes",
+        default=64 << 20,
+        type=int,
+        metavar="BYTES",
+        help="Rotate the segment once it reached the size. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--file-max-age",
+        default=3600,
+        type=utils.positive_float,
+        metavar="SECONDS",
+        help="Rotate the segment once it's older. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--file-fsync-interval",
+        default=1,
+        type=float,
+        metavar="SECONDS",
+        help="Interval to sync the segment to the disk. Use 0 to sync after every "
+        "batch. (default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--file-no-compress",
+        default=False,
+        action="store_true",
+        help="Don't compress the rotated segments. (configuration: %(dest)s)",
+    )
+
 
 def parser_forward_socket(parser: argparse.ArgumentParser) -> None:
     group = parser.add_argument_group("Forwarding configuration")
@@ -177,8 +495,10 @@ def parser_forward_socket(parser: argparse.ArgumentParser) -> None:
         dest="forward",
         metavar="host[:port]",
         default=None,
-        type=lambda x: utils.parse_address(x, port=base.DEFAULT_PORT),
+        type=lambda x: utils.parse_addresses(x, port=base.DEFAULT_PORT),
         help=f"Connect to a different log server to forward the log messages further."
+        f" Multiple servers can be separated by commas to spread the messages over"
+        f" the reachable servers. The logging of the client only uses the first one."
         f" (default: {base.DEFAULT_PORT}, configuration: %(dest)s)",
     )
     group.add_argument(
@@ -224,6 +544,37 @@ def parser_forward_socket(parser: argparse.ArgumentParser) -> None:
     )
 
 
+def parser_forward_relay(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("Relay configuration")
+    group.add_argument(
+        "--relay",
+        action="store_true",
+        default=False,
+        help="Forward the received frames unchanged if they are valid messages "
+        "instead of encoding them again. The host of the client is inserted into "
+        "frames without host. (configuration: %(dest)s)",
+    )
+
+
+def parser_stdin(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("Stdin configuration")
+    group.add_argument(
+        "--log-stdin-queue-size",
+        default=10000,
+        type=int,
+        help="Maximum number of lines from the stdin waiting to be sent to the "
+        "server. Use 0 for an unlimited queue. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--log-stdin-policy",
+        default="block",
+        choices=["block", "drop"],
+        help="Either stop reading the stdin if the queue is full or drop the oldest "
+        "lines. (default: %(default)s, configuration: %(dest)s)",
+    )
+
+
 def parser_watcher(parser: argparse.ArgumentParser) -> None:
     if not watch:
         return
@@ -257,6 +608,112 @@ def parser_watcher(parser: argparse.ArgumentParser) -> None:
         action="store_true",
         help="Enable case sensitivity for file names. (configuration: %(dest)s)",
     )
+    group.add_argument(
+        "--watch-backend",
+        default="native",
+        choices=["native", "poll"],
+        help="Backend to detect changes of the files. Use poll for filesystems "
+        "without inotify support like NFS. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--watch-poll-interval",
+        default=0.5,
+        type=utils.positive_float,
+        metavar="SECONDS",
+        help="Poll interval of recently changed files. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--watch-poll-max-interval",
+        default=10,
+        type=utils.positive_float,
+        metavar="SECONDS",
+        help="Maximal poll interval of idle files. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--watch-queue-size",
+        default=10000,
+        type=int,
+        help="Maximum number of lines waiting to be sent to the server. If the "
+        "queue is full the oldest lines with the lowest level are dropped. Use 0 "
+        "for an unlimited queue. (default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--watch-parsers",
+        default=None,
+        metavar="FILE",
+        type=utils.valid_file,
+        help="JSON file with a list of parsers for the watched files. The first "
+        "parser with a matching pattern is used. (configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--watch-checkpoint",
+        default=None,
+        metavar="FILE",
+        help="Store the offsets of the watched files in this file to continue "
+        "after a restart. (configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--watch-checkpoint-interval",
+        default=5,
+        type=float,
+        metavar="SECONDS",
+        help="Interval to write the checkpoint file. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+
+
+def parser_bench(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("Benchmark configuration")
+    group.add_argument(
+        "--bench-connections",
+        default=1,
+        type=int,
+        help="Number of concurrent connections. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--bench-rate",
+        default=0,
+        type=float,
+        metavar="RECORDS",
+        help="Target rate of records per second over all connections. Use 0 to "
+        "send as fast as possible. (default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--bench-duration",
+        default=10,
+        type=float,
+        metavar="SECONDS",
+        help="Duration of the benchmark. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--bench-sizes",
+        default=parse_distribution("100", int),
+        type=lambda x: parse_distribution(x, int),
+        metavar="SIZE[:WEIGHT][,...]",
+        help="Distribution of the message sizes in characters like 100:9,10000:1. "
+        "(default: 100, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--bench-levels",
+        default=parse_distribution("info", parse_level),
+        type=lambda x: parse_distribution(x, parse_level),
+        metavar="LEVEL[:WEIGHT][,...]",
+        help="Distribution of the levels like info:90,warning:9,error:1. "
+        "(default: info, configuration: %(dest)s)",
+    )
+    group.add_argument(
+        "--bench-framing",
+        default="raw",
+        choices=["raw", "handler"],
+        help="Send prepared raw frames or encode every record with the "
+        "JSONSocketHandler like an application. "
+        "(default: %(default)s, configuration: %(dest)s)",
+    )
 
 
 def parse_args(args: Tuple[str] = None) -> argparse.Namespace:
@@ -277,8 +734,19 @@ def parse_args(args: Tuple[str] = None) -> argparse.Namespace:
     )
     parser_base(client)
     parser_forward_socket(client)
+    parser_stdin(client)
     parser_watcher(client)
 
+    bench = mode_parser.add_parser(
+        "bench",
+        formatter_class=CustomHelpFormatter,
+        help="Run a load test against a log server with synthetic records and "
+        "report the achieved rate, the send latencies and the errors.",
+    )
+    parser_base(bench)
+    parser_forward_socket(bench)
+    parser_bench(bench)
+
     server = mode_parser.add_parser(
         "server",
         formatter_class=CustomHelpFormatter,
@@ -302,10 +770,21 @@ def parse_args(args: Tuple[str] = None) -> argparse.Namespace:
     parser_server(database_parser)
     parser_forward_database(database_parser, "mongodb")
 
+    database_parser = forward_parser.add_parser("sqlite")
+    parser_base(database_parser)
+    parser_server(database_parser)
+    parser_forward_sqlite(database_parser)
+
+    file_parser = forward_parser.add_parser("file")
+    parser_base(file_parser)
+    parser_server(file_parser)
+    parser_forward_file(file_parser)
+
     socket_parser = forward_parser.add_parser("socket")
     parser_base(socket_parser)
     parser_server(socket_parser)
     parser_forward_socket(socket_parser)
+    parser_forward_relay(socket_parser)
 
     parsed = parser.parse_args(args or sys.argv[1:])
     if not getattr(parsed, "config", None):
@@ -328,6 +807,21 @@ def configure(args: argparse.Namespace, **kwargs) -> None:
     )
 
 
+def socket_forwarder(
+    args: argparse.Namespace, ssl_context: ssl.SSLContext, **kwargs
+) -> forwarders.SocketForwarder:
+    """Create the socket forwarder for the addresses of --forward"""
+    (host, port), *upstreams = args.forward
+    return forwarders.SocketForwarder(
+        host,
+        port,
+        upstreams=upstreams,
+        ssl_context=ssl_context,
+        token=args.forward_token,
+        **kwargs,
+    )
+
+
 async def run_client(args: argparse.Namespace) -> None:
     """Run it as a client"""
 
@@ -343,7 +837,7 @@ async def run_client(args: argparse.Namespace) -> None:
         ssl_context = None
 
     forward = JSONSocketHandler(
-        *args.forward,
+        *args.forward[0],
         ssl_context=ssl_context,
         token=args.forward_token,
     )
@@ -356,27 +850,94 @@ async def run_client(args: argparse.Namespace) -> None:
         watch and args.watch or args.log_stdin,
         "Neither --log-stdin nor --watch are specified",
     )
+    # The lines of the stdin and the watched files are send directly to the server
+    # while the logging is only used for the own diagnostics
+    stdin = None
+    if args.log_stdin:
+        stdin = socket_forwarder(args, ssl_context, max_size=args.log_stdin_queue_size)
+        asyncio.create_task(stdin.process())
+
     if watch and args.watch:
-        if args.log_stdin:
-            asyncio.create_task(utils.stdin_to_log())
+        if stdin:
+            asyncio.create_task(
+                utils.stdin_to_forwarder(stdin, block=args.log_stdin_policy == "block")
+            )
+
+        forwarder = socket_forwarder(args, ssl_context, max_size=args.watch_queue_size)
+        asyncio.create_task(forwarder.process())
+
+        line_parsers = None
+        if args.watch_parsers:
+            line_parsers = parsers.load_parsers(args.watch_parsers)
 
         await watch(
             args.watch,
+            forwarder,
             patterns=args.watch_include,
             ignore_patterns=args.watch_exclude,
             case_sensitive=args.watch_case_sensitive,
+            checkpoint=args.watch_checkpoint,
+            checkpoint_interval=args.watch_checkpoint_interval,
+            parsers=line_parsers,
+            backend=args.watch_backend,
+            poll_interval=args.watch_poll_interval,
+            poll_max_interval=args.watch_poll_max_interval,
         )
 
-    elif args.log_stdin:
-        # Only log the stdin
-        await utils.stdin_to_log()
+    elif stdin:
+        await utils.stdin_to_forwarder(stdin, block=args.log_stdin_policy == "block")
 
+        # Give the forwarder the chance to send the remaining lines
+        if not await stdin.drain(STDIN_DRAIN_TIMEOUT):
+            _logger.warning("Not all lines of the stdin could be sent")
 
-async def run_server(args: argparse.Namespace) -> None:
-    # Configure the log stream
+
+async def run_bench(args: argparse.Namespace) -> dict:
+    """Run the benchmark against the first server of --forward"""
     configure(args)
+    require(args.forward, "Missing --forward")
 
-    # Build the forwarder
+    ssl_context = None
+    if args.forward_ca:
+        ssl_context = utils.generate_ssl_context(
+            ca=args.forward_ca,
+            cert=args.forward_cert,
+            key=args.forward_key,
+            ciphers=args.forward_cipher,
+            check_hostname=not args.no_verify_hostname,
+        )
+
+    bench = Benchmark(
+        *args.forward[0],
+        connections=args.bench_connections,
+        rate=args.bench_rate,
+        duration=args.bench_duration,
+        sizes=args.bench_sizes,
+        levels=args.bench_levels,
+        framing=args.bench_framing,
+        ssl_context=ssl_context,
+        token=args.forward_token,
+    )
+    report = await bench.run()
+
+    latency = ", ".join(f"{k} {v:.2f} ms" for k, v in report["latency"].items())
+    _logger.info(
+        f"Sent {report['sent']} records in {report['duration']:.1f} s over "
+        f"{report['connections']} connections ({report['rate']:.0f} records/s)"
+    )
+    _logger.info(f"Send latency: {latency}")
+    if report["errors"]:
+        _logger.warning(f"Errors: {report['errors']}")
+    return report
+
+
+def build_forwarder(args: argparse.Namespace) -> forwarders.Forwarder:
+    """Build the forwarder of the server from the arguments"""
+    queue_args = {
+        "max_size": args.queue_size,
+        "sample_threshold": args.queue_sampling,
+        "dead_letter": args.dead_letter,
+    }
     if args.forwarder == "socket":
         # Build the SSL context for the forwarder
         if args.forward_ca:
@@ -393,11 +954,7 @@ async def run_server(args: argparse.Namespace) -> None:
         require(args.forward, "--forward is missing")
 
         # Create the socket forwarder
-        forwarder = forwarders.SocketForwarder(
-            *args.forward,
-            ssl_context=ssl_context,
-            token=args.forward_token,
-        )
+        forwarder = socket_forwarder(args, ssl_context, **queue_args)
     elif args.forwarder == "postgres":
         require(args.database, "--db is missing")
         require(args.db_table, "--db-table is missing")
@@ -409,6 +966,10 @@ async def run_server(args: argparse.Namespace) -> None:
             port=args.db_port or 5432,
             user=args.db_user,
             password=args.db_password,
+            partition=args.db_partition,
+            retention=args.db_retention,
+            premake=args.db_premake,
+            **queue_args,
         )
     elif args.forwarder == "mongodb":
         require(args.database, "--db is missing")
@@ -421,10 +982,88 @@ async def run_server(args: argparse.Namespace) -> None:
             port=args.db_port or 27017,
             user=args.db_user,
             password=args.db_password,
+            timeseries=args.db_timeseries,
+            ttl=args.db_ttl,
+            **queue_args,
+        )
+    elif args.forwarder == "sqlite":
+        require(args.database, "--db is missing")
+
+        # Create the sqlite forwarder
+        forwarder = forwarders.SQLiteForwarder(
+            database=args.database,
+            table=args.db_table,
+            **queue_args,
+        )
+    elif args.forwarder == "file":
+        require(args.file_directory, "--file-directory is missing")
+
+        # Create the segment file forwarder
+        forwarder = forwarders.FileForwarder(
+            args.file_directory,
+            prefix=args.file_prefix,
+            max_bytes=args.file_max_bytes,
+            max_age=args.file_max_age,
+            fsync_interval=args.file_fsync_interval,
+            compress=not args.file_no_compress,
+            **queue_args,
         )
     else:
         raise NotImplementedError()
 
+    return forwarder
+
+
+async def reload_server(server: LogServer, argv: Tuple[str], timeout: float) -> None:
+    """Reload the token file and replace the forwarder with the new configuration"""
+    _logger.info("Reloading the configuration")
+    try:
+        args = parse_args(argv)
+        forwarder = build_forwarder(args)
+    except (AssertionError, SystemExit, OSError, ValueError) as e:
+        _logger.error(f"Can't reload the configuration: {e!r}")
+        return
+
+    server.reload_tokens(args.token_file)
+    await server.replace_forwarder(forwarder, timeout)
+
+
+async def upgrade_server(server: LogServer, argv: Tuple[str], timeout: float) -> None:
+    """Start a new process which inherits the listening sockets and shut down once
+    the process confirmed that it's listening. The server keeps running if the
+    process exits before"""
+    fds = server.listening_fds()
+    ready_fd, notify_fd = os.pipe()
+    env = {
+        **os.environ,
+        base.LISTEN_FDS_ENV: ",".join(map(str, fds)),
+        base.READY_FD_ENV: str(notify_fd),
+    }
+    command = [sys.executable, "-m", "log_proxy", *(argv or sys.argv[1:])]
+    try:
+        process = subprocess.Popen(command, pass_fds=[*fds, notify_fd], env=env)
+    except OSError as e:
+        os.close(ready_fd)
+        _logger.error(f"Can't start the new process: {e}")
+        return
+    finally:
+        os.close(notify_fd)
+
+    if not await utils.wait_ready(ready_fd):
+        _logger.error(f"Process {process.pid} exited before it was ready")
+        return
+
+    _logger.info(f"Handed the listening sockets over to process {process.pid}")
+    await server.shutdown(timeout)
+
+
+async def run_server(args: argparse.Namespace, argv: Tuple[str] = None) -> None:
+    # Configure the log stream
+    configure(args)
+
+    # Build the forwarder
+    forwarder = build_forwarder(args)
+
     # Build the SSL context for the server
     if args.cert and args.key:
         ssl_context = utils.generate_ssl_context(
@@ -433,10 +1072,19 @@ async def run_server(args: argparse.Namespace) -> None:
             key=args.key,
             ciphers=args.cipher,
             server=True,
+            tickets=args.tls_tickets,
         )
     else:
         ssl_context = None
 
+    profiler = None
+    if args.profile_dir:
+        profiler = SamplingProfiler(
+            args.profile_dir,
+            duration=args.profile_duration,
+            interval=args.profile_interval,
+        )
+
     # Start the server
     server = LogServer(
         *args.listen,
@@ -444,18 +1092,53 @@ async def run_server(args: argparse.Namespace) -> None:
         token_file=args.token_file,
         use_auth=bool(args.token_file),
         forwarder=forwarder,
+        client_queue_size=args.client_queue_size,
+        stats_interval=args.stats_interval,
+        max_frame_size=args.max_frame_size,
+        max_field_size=args.max_field_size,
+        max_connections=args.max_connections,
+        max_client_connections=args.max_client_connections,
+        idle_timeout=args.idle_timeout,
+        auth_timeout=args.auth_timeout,
+        relay=args.forwarder == "socket" and args.relay,
+        profiler=profiler,
+        sockets=utils.inherited_sockets(),
+        udp_address=args.udp,
+        syslog_address=args.syslog,
+        unix_path=args.unix,
+        unix_mode=args.unix_mode,
+        unix_uids=args.unix_users,
+        http_address=args.http,
+        ready_fd=utils.inherited_ready_fd(),
     )
 
+    # SIGHUP reloads the configuration, SIGUSR2 hands the sockets over to a new
+    # process and SIGTERM shuts down gracefully
+    if hasattr(signal, "SIGHUP"):
+        timeout = args.shutdown_timeout
+        handlers = {
+            signal.SIGHUP: lambda: reload_server(server, argv, timeout),
+            signal.SIGUSR2: lambda: upgrade_server(server, argv, timeout),
+            signal.SIGTERM: lambda: server.shutdown(timeout),
+        }
+        loop = asyncio.get_running_loop()
+        for signum, handler in handlers.items():
+            loop.add_signal_handler(
+                signum, lambda handler=handler: asyncio.ensure_future(handler())
+            )
+
     await server.run()
 
 
-def main(args: Tuple[str] = None) -> None:
-    args = parse_args(args)
+def main(argv: Tuple[str] = None) -> None:
+    args = parse_args(argv)
 
     if args.mode == "client":
         asyncio.run(run_client(args))
+    elif args.mode == "bench":
+        asyncio.run(run_bench(args))
     else:
-        asyncio.run(run_server(args))
+        asyncio.run(run_server(args, argv))
 
 
 if __name__ == "__main__":
@@ -2,6 +2,11 @@ import logging
 
 CONFIG_SECTION = "log_proxy"
 DEFAULT_PORT = 3773
+DEFAULT_SYSLOG_PORT = 514
+# Environment variable with the listening sockets inherited by a new process
+LISTEN_FDS_ENV = "LOG_PROXY_LISTEN_FDS"
+# Environment variable with the pipe a new process confirms its readiness on
+READY_FD_ENV = "LOG_PROXY_READY_FD"
 LOG_LEVELS = {
     "critical": logging.CRITICAL,
     "debug": logging.DEBUG,
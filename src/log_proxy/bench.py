@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import ssl
+import struct
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, List, Tuple
+
+from . import parsers
+from .handlers import JSONSocketHandler
+
+# Values with their weights to draw the synthetic records from
+Distribution = Tuple[List[Any], List[float]]
+
+# Number of distinct frames which are prepared for the raw framing
+RAW_FRAMES = 1024
+
+# Number of frames written at once without rate limit
+BURST = 64
+
+# Seconds to wait before reconnecting after an error
+RECONNECT_DELAY = 0.1
+
+
+def parse_distribution(value: str, convert: Callable[[str], Any]) -> Distribution:
+    """Parse a comma separated list of values with optional weights like
+    "100:8,1000:2". This function is used for the argument parsing"""
+    values, weights = [], []
+    for entry in filter(None, map(str.strip, value.split(","))):
+        item, _, weight = entry.partition(":")
+        try:
+            values.append(convert(item.strip()))
+            weights.append(float(weight) if weight else 1.0)
+        except (KeyError, ValueError) as e:
+            raise argparse.ArgumentTypeError(f"Invalid entry {entry}.") from e
+
+    if not values or min(weights) < 0 or not sum(weights):
+        raise argparse.ArgumentTypeError("Invalid distribution.")
+    return values, weights
+
+
+def parse_level(value: str) -> int:
+    """Convert a level name or number and fail for unknown levels"""
+    level = parsers.parse_level(value, None)
+    if level is None:
+        raise ValueError(f"Unknown level {value}")
+    return level
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the percentile of the sorted values"""
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Benchmark:
+    """Sends synthetic records over multiple connections to a log server at a
+    target rate. The records are either encoded by the JSONSocketHandler like in
+    an application or prepared once as raw frames to produce the highest load.
+
+    The send latency of a record is measured from its scheduled time until the
+    frame is handed to the socket. Records delayed by the backpressure of the
+    server therefore count with their full waiting time"""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        *,
+        connections: int = 1,
+        rate: float = 0,
+        duration: float = 10,
+        sizes: Distribution = ([100], [1.0]),
+        levels: Distribution = ([logging.INFO], [1.0]),
+        framing: str = "raw",
+        ssl_context: ssl.SSLContext = None,
+        token: str = None,
+    ):
+        if framing not in ("raw", "handler"):
+            raise ValueError(f"Unknown framing {framing}")
+
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.rate = rate
+        self.duration = duration
+        self.sizes = sizes
+        self.levels = levels
+        self.framing = framing
+        self.ssl_context = ssl_context
+        self.token = token
+        self.handler = JSONSocketHandler(host, port)
+        self.frames = []
+        self.latencies = []
+        self.errors = Counter()
+        self.sent = 0
+
+    def _record(self) -> logging.LogRecord:
+        level = random.choices(*self.levels)[0]
+        size = random.choices(*self.sizes)[0]
+        return logging.makeLogRecord(
+            {
+                "name": "bench",
+                "levelno": level,
+                "levelname": logging.getLevelName(level),
+                "msg": "x" * size,
+            }
+        )
+
+    def _raw_frame(self) -> bytes:
+        record = self._record()
+        data = json.dumps(
+            {
+                "level": record.levelno,
+                "pid": os.getpid(),
+                "created_at": datetime.now().isoformat(" "),
+                "created_by": record.name,
+                "message": record.msg,
+            }
+        ).encode()
+        return struct.pack(">L", len(data)) + data
+
+    def frame(self) -> bytes:
+        """Return the next frame to send"""
+        if self.framing == "handler":
+            return self.handler.makePickle(self._record())
+        return random.choice(self.frames)
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(
+            self.host,
+            self.port,
+            ssl=self.ssl_context,
+            server_hostname=self.host if self.ssl_context else None,
+        )
+        if self.token:
+            writer.write(self.handler._convert_json({"token": self.token}))
+        return reader, writer
+
+    async def _send(self, deadline: float) -> None:
+        """Send the frames of a single connection until the deadline"""
+        loop = asyncio.get_running_loop()
+        interval = self.connections / self.rate if self.rate > 0 else 0
+        start = loop.time()
+        scheduled = 0
+        reader = writer = None
+
+        while loop.time() < deadline:
+            now = loop.time()
+            if interval:
+                due = int((now - start) / interval) + 1 - scheduled
+                if due <= 0:
+                    await asyncio.sleep(start + scheduled * interval - now)
+                    continue
+            else:
+                due = BURST
+
+            first, scheduled = scheduled, scheduled + due
+            try:
+                # A stalled server must not extend the benchmark beyond the deadline
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(
+                        self._connect(), max(deadline - loop.time(), 0)
+                    )
+
+                for _ in range(due):
+                    writer.write(self.frame())
+                await asyncio.wait_for(writer.drain(), max(deadline - loop.time(), 0))
+
+                # The server closes the connection on invalid frames or tokens
+                if reader.at_eof():
+                    raise ConnectionResetError("Connection closed by the server")
+            except (OSError, asyncio.TimeoutError) as e:
+                self.errors[type(e).__name__] += 1
+                if writer:
+                    writer.close()
+                reader = writer = None
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            done = loop.time()
+            for i in range(first, scheduled):
+                self.latencies.append(
+                    done - (start + i * interval if interval else now)
+                )
+            self.sent += due
+
+        if writer:
+            writer.close()
+
+    async def run(self) -> dict:
+        """Run the benchmark and return the report"""
+        self.frames = [self._raw_frame() for _ in range(RAW_FRAMES)]
+        self.latencies, self.errors, self.sent = [], Counter(), 0
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + self.duration
+        await asyncio.gather(*(self._send(deadline) for _ in range(self.connections)))
+        return self.report(loop.time() - start)
+
+    def report(self, duration: float) -> dict:
+        """Summarize the achieved rate, the send latencies in ms and the errors"""
+        latencies = sorted(self.latencies)
+        return {
+            "connections": self.connections,
+            "framing": self.framing,
+            "duration": duration,
+            "sent": self.sent,
+            "target_rate": self.rate,
+            "rate": self.sent / duration if duration else 0,
+            "latency": {
+                name: percentile(latencies, fraction) * 1000
+                for name, fraction in (
+                    ("p50", 0.5),
+                    ("p90", 0.9),
+                    ("p99", 0.99),
+                    ("p999", 0.999),
+                    ("max", 1.0),
+                )
+            },
+            "errors": dict(self.errors),
+        }
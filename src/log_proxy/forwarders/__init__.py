@@ -1,4 +1,6 @@
 from .base import DatabaseForwarder, Forwarder
+from .file import FileForwarder
 from .mongodb import MongoDBForwarder
 from .postgres import PostgresForwarder
 from .socket import SocketForwarder
+from .sqlite import SQLiteForwarder
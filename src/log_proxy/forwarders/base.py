@@ -1,15 +1,125 @@
 import asyncio
+import heapq
+import itertools
+import json
 import logging
+import random
+from bisect import bisect_right
+from collections import Counter
+from typing import Iterable, List
 
 _logger = logging.getLogger()
 
+# Lower bounds of the level bands. Every band is a separate lane in the queue
+LEVEL_BANDS = (logging.INFO, logging.WARNING, logging.ERROR)
+
+
+def get_level(message: dict) -> int:
+    """Return the numeric level of a message or NOTSET if it's unknown"""
+    level = message.get("level")
+    return level if isinstance(level, int) else logging.NOTSET
+
+
+def get_time(message: dict) -> str:
+    """Return the creation time used to order the messages. Invalid values are
+    ordered first instead of breaking the comparison"""
+    created_at = message.get("created_at")
+    return created_at if isinstance(created_at, str) else ""
+
+
+class RawMessage(dict):
+    """Message which is relayed as the original encoded frame. The dict only holds
+    the level to queue the message"""
+
+    __slots__ = ("frame",)
+
+    def __init__(self, frame: bytes, level: int):
+        super().__init__(level=level)
+        self.frame = frame
+
+
+class LevelQueue(asyncio.Queue):
+    """Priority queue which keeps a separate lane per level band. The entries are
+    returned ordered over all lanes while shedding evicts the oldest entry of the
+    lowest band first"""
+
+    def _init(self, maxsize: int) -> None:
+        self._lanes = [[] for _ in range(len(LEVEL_BANDS) + 1)]
+        self._size = 0
+
+    def _band(self, item: tuple) -> int:
+        return bisect_right(LEVEL_BANDS, get_level(item[-1]))
+
+    def _put(self, item: tuple) -> None:
+        heapq.heappush(self._lanes[self._band(item)], item)
+        self._size += 1
+
+    def _get(self) -> tuple:
+        lane = min((lane for lane in self._lanes if lane), key=lambda x: x[0])
+        self._size -= 1
+        return heapq.heappop(lane)
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return not self._size
+
+    def evict(self, item: tuple) -> tuple:
+        """Drop the oldest entry of the lowest band if it's less important than
+        the item and return it. Return None if nothing can be evicted"""
+        band = self._band(item)
+        for i, lane in enumerate(self._lanes[:band]):
+            if lane:
+                self._size -= 1
+                return heapq.heappop(lane)
+        return None
+
+    def shed(self, item: tuple) -> tuple:
+        """Make room for the item and return the dropped entry. This is the item
+        itself if everything in the queue is more important"""
+        band = self._band(item)
+        for i, lane in enumerate(self._lanes):
+            if not lane:
+                continue
+
+            if band < i:
+                return item
+
+            self._size -= 1
+            return heapq.heappop(lane)
+        return item
+
 
 class Forwarder:
     """Common forwarder class. Which already manages the message queue"""
 
-    def __init__(self, max_size: int = 0):
-        self.queue = asyncio.PriorityQueue(max_size)
-        self.counter = 0
+    # Errors caused by a single invalid message instead of the connection
+    record_errors = (KeyError, ValueError, TypeError)
+
+    # Range of the exponential backoff after connection errors in seconds
+    min_backoff = 0.01
+    max_backoff = 5
+
+    def __init__(
+        self,
+        max_size: int = 0,
+        *,
+        sample_threshold: float = None,
+        sample_level: int = logging.WARNING,
+        batch_size: int = 100,
+        dead_letter: str = None,
+    ):
+        self.queue = LevelQueue(max_size)
+        self.batch_size = batch_size
+        # Tie-breaker of messages with the same time. Forwarders sharing the queue
+        # also share the counter
+        self.counter = itertools.count()
+        self.dropped = Counter()
+        self.rejected = 0
+        self.sample_threshold = sample_threshold
+        self.sample_level = sample_level
+        self.dead_letter = dead_letter
 
     def __repr__(self) -> str:
         return "<forwarder>"
@@ -18,10 +128,50 @@ class Forwarder:
         """Return if the queue is empty"""
         return self.queue.empty()
 
+    def full(self) -> bool:
+        """Return if the queue is full"""
+        return self.queue.full()
+
+    def stats(self) -> dict:
+        """Return statistics about the forwarder"""
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": dict(self.dropped),
+            "rejected": self.rejected,
+        }
+
+    async def report(self, interval: float) -> None:
+        """Periodically log the statistics if messages were dropped since the last
+        report"""
+        reported = Counter()
+        while True:
+            await asyncio.sleep(interval)
+            if self.dropped == reported:
+                continue
+
+            dropped = self.dropped - reported
+            reported = self.dropped.copy()
+            levels = ", ".join(
+                f"{logging.getLevelName(level)}={count}"
+                for level, count in sorted(dropped.items())
+            )
+            _logger.warning(
+                f"{self} dropped {sum(dropped.values())} messages ({levels}), "
+                f"{self.queue.qsize()} queued"
+            )
+
     async def get(self) -> dict:
         """Return the next message from the queue"""
         return (await self.queue.get())[-1]
 
+    async def get_batch(self) -> List[dict]:
+        """Wait for the next message and return it together with the already queued
+        messages up to the batch size"""
+        messages = [await self.get()]
+        while len(messages) < self.batch_size and not self.queue.empty():
+            messages.append(self.queue.get_nowait()[-1])
+        return messages
+
     def connected(self) -> bool:
         """Return if the forwarder is properly connected"""
         return False
@@ -32,37 +182,177 @@ class Forwarder:
     async def process_message(self, message: dict) -> None:
         """Process a single message"""
 
+    async def process_messages(self, messages: List[dict]) -> None:
+        """Process a batch of messages. Processed messages are removed from the
+        list to only retry the remaining ones after an error"""
+        while messages:
+            await self.process_message(messages[0])
+            messages.pop(0)
+
+    def sampled(self, message: dict) -> bool:
+        """Sample messages with a low level once the queue is filled above the
+        threshold. The chance to keep a message drops linear with the fill level"""
+        if not self.queue.maxsize or self.sample_threshold is None:
+            return True
+
+        if get_level(message) >= self.sample_level:
+            return True
+
+        fill = self.queue.qsize() / self.queue.maxsize
+        if fill <= self.sample_threshold:
+            return True
+
+        chance = (1 - fill) / max(1 - self.sample_threshold, 1e-9)
+        return random.random() < chance
+
     async def put(self, message: dict) -> None:
-        """Put the message on the queue. If the queue is full the first message will
-        be dropped"""
+        """Put the message on the queue. If the queue is full the oldest message of
+        the lowest level band will be dropped"""
+        self.put_nowait(message)
+
+    def put_many(self, messages: Iterable[dict]) -> None:
+        """Put multiple messages on the queue without waiting"""
+        for message in messages:
+            self.put_nowait(message)
+
+    def _item(self, message: dict) -> tuple:
+        """Build the queue entry of the message"""
+        return (get_time(message), next(self.counter), message)
+
+    async def put_wait(self, message: dict) -> None:
+        """Put the message on the queue and wait for free space instead of dropping
+        messages if the queue is full"""
+        await self.queue.put(self._item(message))
+
+    def put_nowait(self, message: dict) -> None:
+        """Put the message on the queue without waiting. This never blocks because
+        messages are dropped if the queue is full"""
+        if not self.sampled(message):
+            self.dropped[get_level(message)] += 1
+            return
+
+        item = self._item(message)
+
         if self.queue.full():
-            await self.queue.get()
+            dropped = self.queue.shed(item)
+            self.dropped[get_level(dropped[-1])] += 1
+            if dropped is item:
+                return
 
-        time = message.get("created_at")
-        await self.queue.put((time, self.counter, message))
-        self.counter += 1
+            # The evicted entry won't be processed anymore
+            self.queue.task_done()
+
+        self.queue.put_nowait(item)
 
     def invalidate(self) -> None:
         """Invalidate the connection of the forwarder"""
 
+    def reject(self, message: dict, error: Exception) -> None:
+        """Write an invalid message to the dead letter file"""
+        self.rejected += 1
+        if not self.dead_letter:
+            _logger.warning(f"Dropping invalid message: {error!r}")
+            return
+
+        entry = {"error": repr(error), "message": dict(message)}
+        try:
+            with open(self.dead_letter, "a") as fp:
+                fp.write(json.dumps(entry, default=str) + "\n")
+        except OSError as e:
+            _logger.error(f"Can't write dead letter: {e}")
+
+    async def isolate(self, messages: List[dict]) -> None:
+        """Process the messages one by one and reject the invalid ones without
+        dropping the connection"""
+        while messages:
+            try:
+                await self.process_message(messages[0])
+            except self.record_errors as e:
+                self.reject(messages[0], e)
+            messages.pop(0)
+
+    def backoff(self, failures: int) -> float:
+        """Return the delay before the next attempt with exponential backoff and
+        jitter"""
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
     async def process(self) -> None:
-        """Process the queue a message at a time"""
+        """Process the queue in batches of messages. Invalid messages are isolated
+        and rejected. After other errors the remaining messages of the batch are put
+        back on the queue and sent again after reconnecting"""
+        failures = 0
         while True:
+            messages, count = [], 0
             try:
                 if not self.connected():
                     await self.connect()
 
-                msg = await self.get()
-                await self.process_message(msg)
+                messages = await self.get_batch()
+                count = len(messages)
+                try:
+                    await self.process_messages(messages)
+                except self.record_errors:
+                    await self.isolate(messages)
+
+                self.done(count)
+                failures = 0
+            except asyncio.CancelledError:
+                # Keep the unsent messages for a takeover of the queue
+                self.put_many(messages)
+                self.done(count)
+                raise
             except Exception as e:
-                _logger.exception(e)
+                failures += 1
+                if isinstance(e, (OSError, asyncio.TimeoutError)):
+                    _logger.warning(f"{self} failed {failures} times: {e!r}")
+                else:
+                    _logger.exception(e)
+
                 self.invalidate()
-                await asyncio.sleep(5)
+                self.put_many(messages)
+                self.done(count)
+                await asyncio.sleep(self.backoff(failures))
+
+    def done(self, count: int) -> None:
+        """Mark a number of messages taken from the queue as processed"""
+        for _ in range(count):
+            self.queue.task_done()
+
+    def transfer(self, target: "Forwarder") -> int:
+        """Move the queued messages to another forwarder and return the number of
+        moved messages"""
+        count = 0
+        while not self.queue.empty():
+            target.put_nowait(self.queue.get_nowait()[-1])
+            self.queue.task_done()
+            count += 1
+        return count
+
+    async def drain(self, timeout: float = None) -> bool:
+        """Wait until all queued messages are processed. Returns False if the
+        timeout was reached before"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
 
 class DatabaseForwarder(Forwarder):
     """Common database forwarder"""
 
-    def __init__(self, *, max_size: int = 0, **kwargs):
-        super().__init__(max_size=max_size)
+    def __init__(
+        self,
+        *,
+        max_size: int = 0,
+        sample_threshold: float = None,
+        dead_letter: str = None,
+        **kwargs,
+    ):
+        super().__init__(
+            max_size=max_size,
+            sample_threshold=sample_threshold,
+            dead_letter=dead_letter,
+        )
         self.args = {k: v for k, v in kwargs.items() if v}
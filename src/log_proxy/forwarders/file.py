@@ -0,0 +1,190 @@
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List
+
+from ..records import dumps
+from .base import Forwarder
+
+_logger = logging.getLogger()
+
+
+def compress_file(path: str) -> None:
+    """Compress the file with gzip and remove the original"""
+    with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dest:
+        shutil.copyfileobj(src, dest, 1 << 20)
+    os.remove(path)
+
+
+class FileForwarder(Forwarder):
+    """Appends the messages as JSON lines to local segment files. The writes are
+    buffered and synced to the disk every fsync_interval seconds. Segments rotate
+    after max_bytes or max_age seconds and get compressed in the background"""
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        prefix: str = "logs",
+        max_bytes: int = 64 << 20,
+        max_age: float = 3600,
+        fsync_interval: float = 1,
+        compress: bool = True,
+        buffer_size: int = 1 << 20,
+        max_size: int = 0,
+        sample_threshold: float = None,
+        dead_letter: str = None,
+    ):
+        super().__init__(
+            max_size, sample_threshold=sample_threshold, dead_letter=dead_letter
+        )
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.file = self.path = None
+        self.size = self.opened = 0
+        self.dirty = False
+        self.syncer = None
+        self.tasks = set()
+
+        # A single thread keeps the syncing and closing of the segments in order
+        self.executor = ThreadPoolExecutor(1)
+
+    def __repr__(self) -> str:
+        return f"<forwarder file:{self.directory}>"
+
+    def connected(self) -> bool:
+        """Return if a segment is open"""
+        return self.file is not None
+
+    async def connect(self) -> None:
+        """Open a new segment and start syncing it periodically"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._open()
+
+        if self.syncer is None and self.fsync_interval > 0:
+            self.syncer = asyncio.create_task(self._sync_periodically())
+
+    def invalidate(self) -> None:
+        """Close the current segment after an error"""
+        file, self.file = self.file, None
+        if file:
+            try:
+                file.close()
+            except OSError as e:
+                _logger.error(f"Can't close segment: {e}")
+
+    def _open(self) -> None:
+        name = datetime.now().strftime(f"{self.prefix}-%Y%m%d-%H%M%S-%f.jsonl")
+        self.path = os.path.join(self.directory, name)
+        self.file = open(self.path, "ab", buffering=self.buffer_size)
+        self.size = self.file.tell()
+        self.opened = time.monotonic()
+        self.dirty = False
+
+    def _sync(self, file) -> None:
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _close(self, file) -> None:
+        self._sync(file)
+        file.close()
+
+    async def sync(self) -> None:
+        """Flush the buffer and sync the current segment to the disk"""
+        if not self.file or not self.dirty:
+            return
+
+        self.dirty = False
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._sync, self.file)
+
+    async def close(self) -> None:
+        """Stop the syncing, close the current segment and shut the executor down"""
+        if self.syncer:
+            self.syncer.cancel()
+            await asyncio.gather(self.syncer, return_exceptions=True)
+            self.syncer = None
+
+        file, self.file = self.file, None
+        if file:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self.executor, self._close, file)
+            except OSError as e:
+                _logger.error(f"Can't close segment: {e}")
+
+        self.executor.shutdown()
+
+    async def rotate(self) -> None:
+        """Close the current segment and continue with a new one. The closed
+        segment is compressed in the background"""
+        file, path = self.file, self.path
+        self._open()
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._close, file)
+
+        if self.compress:
+            task = asyncio.ensure_future(
+                loop.run_in_executor(None, compress_file, path)
+            )
+            self.tasks.add(task)
+            task.add_done_callback(self._compressed)
+
+    def _compressed(self, task: asyncio.Future) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            _logger.error(f"Can't compress segment: {task.exception()}")
+
+    def expired(self) -> bool:
+        """Return if the current segment should be rotated"""
+        if not self.size:
+            return False
+
+        if self.size >= self.max_bytes:
+            return True
+        return time.monotonic() - self.opened >= self.max_age
+
+    async def _sync_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                if self.file and self.expired():
+                    await self.rotate()
+                else:
+                    await self.sync()
+            except OSError as e:
+                _logger.error(f"Can't sync segment: {e}")
+
+    async def process(self) -> None:
+        """Process the queue and close the segment once the processing stops"""
+        try:
+            await super().process()
+        finally:
+            await self.close()
+
+    async def process_message(self, message: dict) -> None:
+        """Process a single message"""
+        await self.process_messages([message])
+
+    async def process_messages(self, messages: List[dict]) -> None:
+        """Append the batch with a single write to the segment"""
+        data = "".join(dumps(message) + "\n" for message in messages).encode()
+        self.file.write(data)
+        self.size += len(data)
+        self.dirty = True
+
+        if self.expired():
+            await self.rotate()
+        elif self.fsync_interval <= 0:
+            await self.sync()
@@ -1,17 +1,27 @@
 import logging
+from datetime import datetime
+from typing import List
 
 from .base import DatabaseForwarder
 
 try:
-    from pymongo import MongoClient
+    from bson.errors import InvalidDocument
+    from pymongo import ASCENDING, DESCENDING, MongoClient
 except ImportError:
     MongoClient = None
+    ASCENDING, DESCENDING = 1, -1
+    InvalidDocument = ValueError
 
 _logger = logging.getLogger()
 
+# Fields which are stored as metadata of the time series
+META_FIELDS = ("host", "created_by")
+
 
 class MongoDBForwarder(DatabaseForwarder):
-    """Forwards messages to a MongoDB database"""
+    """Forwards messages to a MongoDB database. The collection can be created as
+    time series collection with host and created_by as metadata. A TTL removes
+    the messages after the given number of seconds"""
 
     def __init__(
         self,
@@ -19,19 +29,55 @@ class MongoDBForwarder(DatabaseForwarder):
         database: str,
         table: str = "logs",
         max_size: int = 0,
+        timeseries: bool = False,
+        ttl: int = 0,
         **kwargs,
     ):
         super().__init__(max_size=max_size, **kwargs)
         self.database = database
         self.table = table
+        self.timeseries = timeseries
+        self.ttl = ttl
         self.client = None
 
+    record_errors = (*DatabaseForwarder.record_errors, InvalidDocument)
+
     def __repr__(self) -> str:
         return f"<forwarder mongo:{self.table}>"
 
     async def connect(self) -> None:
         """Connect to the database and create the table if needed"""
         self.client = MongoClient(**self.args)
+        if self.timeseries:
+            self.create_timeseries()
+        elif self.ttl > 0:
+            collection = self.client[self.database][self.table]
+            collection.create_index("created_at", expireAfterSeconds=self.ttl)
+
+    def create_timeseries(self) -> None:
+        """Create the time series collection and the indexes of the metadata"""
+        db = self.client[self.database]
+        if self.table not in db.list_collection_names():
+            options = {}
+            if self.ttl > 0:
+                options["expireAfterSeconds"] = self.ttl
+
+            db.create_collection(
+                self.table,
+                timeseries={
+                    "timeField": "created_at",
+                    "metaField": "meta",
+                    "granularity": "seconds",
+                },
+                **options,
+            )
+
+        collection = db[self.table]
+        for field in META_FIELDS:
+            collection.create_index(
+                [(f"meta.{field}", ASCENDING), ("created_at", DESCENDING)]
+            )
+        collection.create_index([("level", ASCENDING), ("created_at", DESCENDING)])
 
     def invalidate(self) -> None:
         """Invalidate the connection of the forwarder"""
@@ -41,6 +87,25 @@ class MongoDBForwarder(DatabaseForwarder):
         """Return if the forwarder is properly connected"""
         return self.client is not None
 
+    def convert(self, message: dict) -> dict:
+        """Convert the message into the document of the collection"""
+        if not self.timeseries and self.ttl <= 0:
+            return message
+
+        document = dict(message)
+        created_at = document.get("created_at")
+        if isinstance(created_at, str):
+            document["created_at"] = datetime.fromisoformat(created_at)
+
+        if self.timeseries:
+            document["meta"] = {f: document.pop(f, None) for f in META_FIELDS}
+        return document
+
     async def process_message(self, message: dict) -> None:
         """Process a single message"""
-        self.client[self.database][self.table].insert_one(message)
+        self.client[self.database][self.table].insert_one(self.convert(message))
+
+    async def process_messages(self, messages: List[dict]) -> None:
+        """Insert the batch of messages at once"""
+        documents = [self.convert(message) for message in messages]
+        self.client[self.database][self.table].insert_many(documents)
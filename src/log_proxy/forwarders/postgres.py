@@ -1,37 +1,66 @@
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from typing import List
 
 from .base import DatabaseForwarder
 
 try:
+    from asyncpg import DataError
     from asyncpg import connect as pg_connect
 except ImportError:
     pg_connect = None
+    DataError = ValueError
 
 _logger = logging.getLogger()
 
+# Length, name format and truncation of the supported partition intervals
+PARTITIONS = {
+    "day": (timedelta(days=1), "%Y%m%d", {"hour": 0, "minute": 0}),
+    "hour": (timedelta(hours=1), "%Y%m%d%H", {"minute": 0}),
+}
+
 
 class PostgresForwarder(DatabaseForwarder):
-    """Forwards messages to a PostgreSQL database"""
+    """Forwards messages to a PostgreSQL database. The table can be partitioned
+    by the creation time. Partitions are created ahead of time and dropped after
+    the retention while messages outside of the partitions end up in the default
+    partition. Failing maintenance is retried later without blocking inserts"""
 
     def __init__(
         self,
         *,
         table: str = "logs",
         max_size: int = 0,
+        partition: str = None,
+        retention: int = 0,
+        premake: int = 3,
         **kwargs,
     ):
+        if partition and partition not in PARTITIONS:
+            raise ValueError(f"Unknown partition interval {partition}")
+
         super().__init__(max_size=max_size, **kwargs)
         self.args["host"] = self.args.get("host")
         self.table = table
+        self.partition = partition
+        self.retention = retention
+        self.premake = premake
+        self.maintained = None
         self.connection = None
 
+    record_errors = (*DatabaseForwarder.record_errors, DataError)
+
     def __repr__(self) -> str:
         return f"<forwarder postgres:{self.table}>"
 
     async def connect(self) -> None:
         """Connect to the database and create the table if needed"""
         self.connection = await pg_connect(**self.args)
+        if self.partition:
+            await self.create_partitioned_table()
+            return
+
         await self.connection.execute(
             f"""
                 CREATE TABLE IF NOT EXISTS "{self.table}" (
@@ -56,6 +85,137 @@ class PostgresForwarder(DatabaseForwarder):
                 f'ON "{self.table}" ("{column}")'
             )
 
+    async def create_partitioned_table(self) -> None:
+        """Create the table partitioned by the creation time with a BRIN index on
+        the time and the default partition. An existing regular table is used
+        without partitions"""
+        kind = await self.connection.fetchval(
+            "SELECT relkind FROM pg_class WHERE relname = $1", self.table
+        )
+        if kind not in (None, "p"):
+            _logger.error(f"Table {self.table} exists and isn't partitioned")
+            self.partition = None
+            return
+
+        await self.connection.execute(
+            f"""
+                CREATE TABLE IF NOT EXISTS "{self.table}" (
+                    "id" BIGSERIAL,
+                    "level" INT NOT NULL,
+                    "pid" INT NOT NULL,
+                    "host" VARCHAR,
+                    "message" VARCHAR NOT NULL,
+                    "created_at" TIMESTAMP NOT NULL,
+                    "created_by" VARCHAR NOT NULL,
+                    "exception" VARCHAR,
+                    "path" VARCHAR,
+                    "lineno" INT,
+                    PRIMARY KEY ("id", "created_at")
+                ) PARTITION BY RANGE ("created_at")
+            """
+        )
+
+        for column in ("level", "host", "created_by"):
+            await self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{self.table}_{column}_idx"'
+                f'ON "{self.table}" ("{column}")'
+            )
+
+        await self.connection.execute(
+            f'CREATE INDEX IF NOT EXISTS "{self.table}_created_at_idx"'
+            f' ON "{self.table}" USING BRIN ("created_at")'
+        )
+        await self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS "{self.table}_default"'
+            f' PARTITION OF "{self.table}" DEFAULT'
+        )
+        await self.try_maintain_partitions()
+
+    def partition_name(self, start: datetime) -> str:
+        """Return the name of the partition starting at the given time"""
+        return f"{self.table}_p{start.strftime(PARTITIONS[self.partition][1])}"
+
+    def partition_start(self, now: datetime) -> datetime:
+        """Return the start of the partition containing the given time"""
+        truncate = PARTITIONS[self.partition][2]
+        return now.replace(second=0, microsecond=0, **truncate)
+
+    async def partitions(self) -> List[str]:
+        """Return the names of the partitions of the table"""
+        rows = await self.connection.fetch(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = $1",
+            self.table,
+        )
+        return [name for (name,) in rows]
+
+    async def create_partition(self, begin: datetime, end: datetime) -> None:
+        """Create a range partition. Rows of the range in the default partition
+        would block the creation and are moved while the default is detached"""
+        name = self.partition_name(begin)
+        default = f"{self.table}_default"
+        async with self.connection.transaction():
+            await self.connection.execute(
+                f'ALTER TABLE "{self.table}" DETACH PARTITION "{default}"'
+            )
+            await self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{name}"'
+                f' PARTITION OF "{self.table}"'
+                f" FOR VALUES FROM ('{begin.isoformat(' ')}')"
+                f" TO ('{end.isoformat(' ')}')"
+            )
+            await self.connection.execute(
+                f'WITH moved AS (DELETE FROM "{default}"'
+                ' WHERE "created_at" >= $1 AND "created_at" < $2 RETURNING *)'
+                f' INSERT INTO "{name}" SELECT * FROM moved',
+                begin,
+                end,
+            )
+            await self.connection.execute(
+                f'ALTER TABLE "{self.table}" ATTACH PARTITION "{default}" DEFAULT'
+            )
+
+    async def maintain_partitions(self, now: datetime = None) -> None:
+        """Create the upcoming partitions and drop the ones after the retention"""
+        length = PARTITIONS[self.partition][0]
+        start = self.partition_start(now or datetime.now())
+        existing = set(await self.partitions())
+
+        for i in range(self.premake + 1):
+            begin = start + i * length
+            if self.partition_name(begin) not in existing:
+                await self.create_partition(begin, begin + length)
+
+        if self.retention > 0:
+            # The names sort chronologically and the default partition is skipped
+            oldest = self.partition_name(start - self.retention * length)
+            prefix = f"{self.table}_p"
+            for name in sorted(existing):
+                if name.startswith(prefix) and name < oldest:
+                    _logger.info(f"Dropping partition {name}")
+                    await self.connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+
+    async def try_maintain_partitions(self) -> None:
+        """Maintain the partitions and log failures. The next attempt happens
+        after the regular interval to not stall the inserts"""
+        try:
+            await self.maintain_partitions()
+        except Exception as e:
+            _logger.error(f"Can't maintain partitions: {e!r}")
+        self.maintained = time.monotonic()
+
+    async def process_messages(self, messages: List[dict]) -> None:
+        """Maintain the partitions regularly before inserting the messages"""
+        if self.partition and self.connection:
+            interval = PARTITIONS[self.partition][0].total_seconds() / 4
+            last = self.maintained
+            if last is None or time.monotonic() - last >= interval:
+                await self.try_maintain_partitions()
+
+        await super().process_messages(messages)
+
     def invalidate(self) -> None:
         """Invalidate the connection of the forwarder"""
         self.connection = None
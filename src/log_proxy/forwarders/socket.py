@@ -1,35 +1,78 @@
 import asyncio
-import json
 import ssl
 import struct
+from typing import List, Tuple
 
-from .base import Forwarder
+from ..records import dumps
+from ..tls import SessionContext, server_port
+from .base import Forwarder, RawMessage
 
 
 class SocketForwarder(Forwarder):
-    """Forwards messages to a log server"""
+    """Forwards messages to a log server. With additional upstreams every server
+    gets its own connection which takes the next batch from the shared queue once
+    the previous one is sent. Batches go to the least busy servers this way and a
+    failing server doesn't take batches until it's reachable again"""
 
     def __init__(
         self,
         host,
         port,
         *,
+        upstreams: List[Tuple[str, int]] = None,
         ssl_context: ssl.SSLContext = None,
         token: str = None,
         max_size: int = 0,
+        sample_threshold: float = None,
+        dead_letter: str = None,
     ):
-        super().__init__(max_size)
+        super().__init__(
+            max_size, sample_threshold=sample_threshold, dead_letter=dead_letter
+        )
 
         self.host, self.port = host, port
         self.ssl_context = ssl_context
         self.token = token
         self.reader = self.writer = None
 
+        # The connections to the additional upstreams share the queue
+        self.upstreams = []
+        for upstream_host, upstream_port in upstreams or []:
+            upstream = SocketForwarder(
+                upstream_host,
+                upstream_port,
+                ssl_context=ssl_context,
+                token=token,
+                dead_letter=dead_letter,
+            )
+            upstream.queue = self.queue
+            upstream.counter = self.counter
+            upstream.dropped = self.dropped
+            self.upstreams.append(upstream)
+
     def __repr__(self):
-        return f"<forwarder {self.host}:{self.port}>"
+        addresses = [f"{f.host}:{f.port}" for f in (self, *self.upstreams)]
+        return f"<forwarder {','.join(addresses)}>"
+
+    def stats(self) -> dict:
+        """Return statistics about the forwarder and the TLS handshakes"""
+        stats = super().stats()
+        if isinstance(self.ssl_context, SessionContext):
+            stats["tls"] = self.ssl_context.stats()
+        return stats
+
+    def _ssl_object(self) -> ssl.SSLObject:
+        if not self.writer or not isinstance(self.ssl_context, SessionContext):
+            return None
+        return self.writer.get_extra_info("ssl_object")
 
     def invalidate(self) -> None:
         """Invalidate the connection of the forwarder"""
+        # The TLS 1.3 ticket arrives after the handshake and is kept for reconnects
+        ssl_object = self._ssl_object()
+        if ssl_object:
+            self.ssl_context.save(ssl_object, self.port)
+
         self.reader = self.writer = None
 
     def connected(self) -> bool:
@@ -38,18 +81,48 @@ class SocketForwarder(Forwarder):
 
     async def connect(self) -> None:
         """Connect the forwarder to the server"""
-        self.reader, self.writer = await asyncio.open_connection(
-            self.host,
-            self.port,
-            ssl=self.ssl_context,
-        )
+        with server_port(self.port):
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=self.ssl_context,
+            )
+
+        ssl_object = self._ssl_object()
+        if ssl_object:
+            self.ssl_context.handshake(ssl_object, self.port)
 
         if self.token:
             await self.process_message({"token": self.token})
 
+    def _encode(self, message: dict) -> bytes:
+        if isinstance(message, RawMessage):
+            return message.frame
+        return dumps(message).encode()
+
+    def _frame(self, message: dict) -> bytes:
+        """Encode the message and prefix it with the length"""
+        data = self._encode(message)
+        return struct.pack(">L", len(data)) + data
+
     async def process_message(self, message: dict) -> None:
         """Process a single message"""
-        data = json.dumps(message)
+        data = self._encode(message)
         self.writer.write(struct.pack(">L", len(data)))
-        self.writer.write(data.encode())
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def process_messages(self, messages: List[dict]) -> None:
+        """Write the batch of messages at once and flush them"""
+        self.writer.write(b"".join(map(self._frame, messages)))
         await self.writer.drain()
+
+    async def process(self) -> None:
+        """Process the queue with one connection per upstream"""
+        if not self.upstreams:
+            await super().process()
+            return
+
+        await asyncio.gather(
+            super().process(), *(upstream.process() for upstream in self.upstreams)
+        )
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from .base import DatabaseForwarder
+
+_logger = logging.getLogger()
+
+COLUMNS = (
+    "level",
+    "pid",
+    "host",
+    "message",
+    "created_at",
+    "created_by",
+    "exception",
+    "path",
+    "lineno",
+)
+
+
+class SQLiteForwarder(DatabaseForwarder):
+    """Forwards messages to a SQLite database in WAL mode. The blocking calls run
+    in a dedicated thread which owns the connection"""
+
+    def __init__(
+        self,
+        *,
+        database: str,
+        table: str = "logs",
+        max_size: int = 0,
+        **kwargs,
+    ):
+        super().__init__(max_size=max_size, **kwargs)
+        self.database = database
+        self.table = table
+        self.connection = None
+        self.executor = ThreadPoolExecutor(1)
+
+    record_errors = (
+        *DatabaseForwarder.record_errors,
+        sqlite3.IntegrityError,
+        sqlite3.InterfaceError,
+    )
+
+    def __repr__(self) -> str:
+        return f"<forwarder sqlite:{self.table}>"
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.database, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            f"""
+                CREATE TABLE IF NOT EXISTS "{self.table}" (
+                    "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                    "level" INT NOT NULL,
+                    "pid" INT NOT NULL,
+                    "host" VARCHAR,
+                    "message" VARCHAR NOT NULL,
+                    "created_at" TIMESTAMP NOT NULL,
+                    "created_by" VARCHAR NOT NULL,
+                    "exception" VARCHAR,
+                    "path" VARCHAR,
+                    "lineno" INT
+                )
+            """
+        )
+
+        for column in ("level", "host", "created_by"):
+            connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{self.table}_{column}_idx"'
+                f'ON "{self.table}" ("{column}")'
+            )
+        connection.commit()
+        return connection
+
+    async def connect(self) -> None:
+        """Connect to the database and create the table if needed"""
+        self.connection = await self._run(self._connect)
+
+    def invalidate(self) -> None:
+        """Invalidate the connection of the forwarder"""
+        connection, self.connection = self.connection, None
+        if connection:
+            self.executor.submit(connection.close)
+
+    def connected(self) -> bool:
+        """Return if the forwarder is properly connected"""
+        return self.connection is not None
+
+    def _insert(self, connection: sqlite3.Connection, rows: List[tuple]) -> None:
+        # The connection as context manager wraps the batch in one transaction
+        with connection:
+            connection.executemany(
+                f"""
+                    INSERT INTO "{self.table}" ({", ".join(COLUMNS)})
+                    VALUES ({", ".join("?" * len(COLUMNS))})
+                """,
+                rows,
+            )
+
+    async def process_message(self, message: dict) -> None:
+        """Process a single message"""
+        await self.process_messages([message])
+
+    async def process_messages(self, messages: List[dict]) -> None:
+        """Insert the batch of messages within a single transaction"""
+        rows = [
+            tuple(message.get(column) for column in COLUMNS) for message in messages
+        ]
+        await self._run(self._insert, self.connection, rows)
@@ -4,16 +4,46 @@ import socket
 import ssl
 import struct
 from datetime import datetime
-from logging.handlers import SocketHandler
+from logging.handlers import DatagramHandler, SocketHandler
 
+from .tls import SessionContext, server_port
 
-class JSONSocketHandler(SocketHandler):
-    """Logging handler to send the log via a socket to a server in JSON format"""
+
+class JSONMixin:
+    """Encodes the log records as length prefixed JSON frames"""
+
+    def _convert_json(self, data: dict) -> bytes:
+        """Convert the data to a simple byte representation"""
+        data = json.dumps(data)
+        datalen = struct.pack(">L", len(data))
+        return datalen + data.encode()
+
+    def makePickle(self, record: logging.LogRecord) -> bytes:
+        """Use json instead of pickle to prevent code execution"""
+        if record.exc_info:
+            self.format(record)
+
+        data = {
+            "level": record.levelno,
+            "pid": record.process,
+            "created_at": datetime.fromtimestamp(record.created).isoformat(" "),
+            "created_by": record.name,
+            "message": record.getMessage(),
+            "exception": record.exc_text,
+            "path": record.pathname,
+            "lineno": record.lineno,
+        }
+        return self._convert_json(data)
+
+
+class JSONSocketHandler(JSONMixin, SocketHandler):
+    """Logging handler to send the log via a socket to a server in JSON format.
+    Without port the host is the path of a Unix socket"""
 
     def __init__(
         self,
         host: str,
-        port: int,
+        port: int = None,
         *,
         ssl_context: ssl.SSLContext = None,
         token: str = None,
@@ -21,19 +51,21 @@ class JSONSocketHandler(SocketHandler):
         super().__init__(host, port)
         self.ssl_context = ssl_context
         self.token = token
-
-    def _convert_json(self, data: dict) -> bytes:
-        """Convert the data to a simple byte representation"""
-        data = json.dumps(data)
-        datalen = struct.pack(">L", len(data))
-        return datalen + data.encode()
+        self.ticket_pending = False
 
     def makeSocket(self, timeout: float = 1) -> socket.socket:
         """Wrap the socket with a SSL context if passed"""
         sock = super().makeSocket(timeout)
 
+        # Unix sockets are authenticated by the peer credentials
+        if self.port is None:
+            return sock
+
         if self.ssl_context:
-            return self.ssl_context.wrap_socket(sock, server_side=True)
+            with server_port(self.port):
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+            if isinstance(self.ssl_context, SessionContext):
+                self.ticket_pending = not self.ssl_context.handshake(sock, self.port)
 
         # Send the token for authorization
         if self.token:
@@ -41,19 +73,37 @@ class JSONSocketHandler(SocketHandler):
 
         return sock
 
-    def makePickle(self, record: logging.LogRecord) -> bytes:
-        """Use json instead of pickle to prevent code execution"""
-        if record.exc_info:
-            self.format(record)
+    def _receive_ticket(self) -> bool:
+        """Process the pending TLS 1.3 session ticket without blocking and return
+        if the session could be saved"""
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            self.sock.recv(1)
+        except OSError:
+            pass
+        finally:
+            self.sock.settimeout(timeout)
 
-        data = {
-            "level": record.levelno,
-            "pid": record.process,
-            "created_at": datetime.fromtimestamp(record.created).isoformat(" "),
-            "created_by": record.name,
-            "message": record.getMessage(),
-            "exception": record.exc_text,
-            "path": record.pathname,
-            "lineno": record.lineno,
-        }
-        return self._convert_json(data)
+        return self.ssl_context.save(self.sock, self.port)
+
+    def send(self, s: bytes) -> None:
+        """Send the data and save the session once the ticket arrived"""
+        super().send(s)
+
+        if self.ticket_pending and self.sock:
+            self.ticket_pending = not self._receive_ticket()
+
+
+class JSONDatagramHandler(JSONMixin, DatagramHandler):
+    """Logging handler to send the log via UDP to a server in JSON format. Every
+    datagram carries the token in front of the record"""
+
+    def __init__(self, host: str, port: int, *, token: str = None):
+        super().__init__(host, port)
+        self.token = token
+        self.prefix = self._convert_json({"token": token}) if token else b""
+
+    def makePickle(self, record: logging.LogRecord) -> bytes:
+        """Prepend the token frame to the JSON frame of the record"""
+        return self.prefix + super().makePickle(record)
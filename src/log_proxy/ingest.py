@@ -0,0 +1,169 @@
+import json
+import zlib
+from asyncio import IncompleteReadError, LimitOverrunError, StreamReader
+from http import HTTPStatus
+from typing import AsyncIterator, Dict, Tuple
+
+# Size of the chunks read from the body and produced by the decompression
+CHUNK_SIZE = 1 << 16
+
+Request = Tuple[str, str, str, Dict[str, str]]
+
+
+class HTTPError(Exception):
+    """Error which is answered with the status code and the body"""
+
+    def __init__(self, status: int, message: str = None, body: dict = None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+        self.body = body or {"error": str(self)}
+
+
+async def read_request(reader: StreamReader) -> Request:
+    """Read the request line and the headers. Return None if the client closed
+    the connection before a new request"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HTTPError(400) from e
+    except LimitOverrunError as e:
+        raise HTTPError(431) from e
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError as e:
+        raise HTTPError(400) from e
+
+    headers = {}
+    for line in filter(None, lines[1:]):
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HTTPError(400)
+        headers[name.strip().lower()] = value.strip()
+    return method, target.split("?", 1)[0], version, headers
+
+
+def keep_alive(version: str, headers: Dict[str, str]) -> bool:
+    """Return if the connection stays open after the request"""
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+
+async def _read(reader: StreamReader, size: int) -> AsyncIterator[bytes]:
+    while size > 0:
+        chunk = await reader.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise IncompleteReadError(b"", size)
+        size -= len(chunk)
+        yield chunk
+
+
+async def read_body(
+    reader: StreamReader, headers: Dict[str, str]
+) -> AsyncIterator[bytes]:
+    """Yield the body in chunks using the content length or the chunked transfer
+    encoding"""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            try:
+                size = int(line.split(b";", 1)[0], 16)
+            except ValueError as e:
+                raise HTTPError(400) from e
+
+            if size == 0:
+                break
+
+            async for chunk in _read(reader, size):
+                yield chunk
+
+            if await reader.readexactly(2) != b"\r\n":
+                raise HTTPError(400)
+
+        # Skip the trailer
+        while await reader.readuntil(b"\r\n") != b"\r\n":
+            pass
+        return
+
+    length = headers.get("content-length")
+    if length is None:
+        raise HTTPError(411)
+    if not length.isdigit():
+        raise HTTPError(400)
+
+    async for chunk in _read(reader, int(length)):
+        yield chunk
+
+
+async def decompress(
+    chunks: AsyncIterator[bytes], encoding: str
+) -> AsyncIterator[bytes]:
+    """Decompress the gzip encoded chunks. The output is limited per step to not
+    inflate a small body into a large buffer"""
+    encoding = encoding.lower()
+    if encoding in ("", "identity"):
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    if encoding not in ("gzip", "x-gzip"):
+        raise HTTPError(415)
+
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    try:
+        async for chunk in chunks:
+            while chunk:
+                yield decompressor.decompress(chunk, CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+
+                # Bodies can consist of multiple gzip members
+                if decompressor.eof and decompressor.unused_data:
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+        yield decompressor.flush()
+    except zlib.error as e:
+        raise HTTPError(400, "Invalid gzip data") from e
+
+
+async def iter_lines(
+    chunks: AsyncIterator[bytes], max_size: int = 0
+) -> AsyncIterator[bytes]:
+    """Split the chunks into the non-empty lines. Only the incomplete last line is
+    kept between the chunks"""
+    pending = b""
+    async for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if 0 < max_size < len(line):
+                raise HTTPError(413)
+            if line:
+                yield line
+
+        if 0 < max_size < len(pending):
+            raise HTTPError(413)
+
+    pending = pending.strip()
+    if pending:
+        yield pending
+
+
+def response(status: int, body: dict, keep_alive: bool = True) -> bytes:
+    """Build a response with a JSON body"""
+    payload = json.dumps(body).encode()
+    lines = [
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(payload)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    if status == HTTPStatus.TOO_MANY_REQUESTS:
+        lines.append("Retry-After: 1")
+    return "\r\n".join(lines).encode() + b"\r\n\r\n" + payload
@@ -0,0 +1,332 @@
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import PurePath
+from typing import Any, Dict, List, Tuple
+
+from . import base
+
+_logger = logging.getLogger(__name__)
+
+# Alternative keys of the fields in JSON lines
+JSON_FIELDS = {
+    "level": ("level", "levelname", "levelno", "severity"),
+    "created_at": ("created_at", "timestamp", "time", "asctime", "@timestamp"),
+    "created_by": ("created_by", "name", "logger", "logger_name"),
+    "message": ("message", "msg"),
+    "exception": ("exception", "exc_info", "exc_text", "stack_trace"),
+    "pid": ("pid", "process"),
+}
+
+
+def parse_level(value: Any, default: int = logging.INFO) -> int:
+    """Convert a level name or number into the numeric level"""
+    if isinstance(value, int):
+        return value
+
+    if not isinstance(value, str):
+        return default
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    value = value.lower()
+    if value == "fatal":
+        return logging.CRITICAL
+    return base.LOG_LEVELS.get(value, default)
+
+
+def _local(dt: datetime) -> str:
+    """Convert the datetime into the naive local time which is expected by the
+    databases"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.isoformat(" ")
+
+
+def parse_time(value: Any, time_format: str = None) -> str:
+    """Convert a timestamp into the isoformat used by the messages. If it can't be
+    parsed the current time is used"""
+    try:
+        if isinstance(value, (int, float)):
+            return _local(datetime.fromtimestamp(value))
+
+        if isinstance(value, str):
+            if time_format:
+                return _local(datetime.strptime(value, time_format))
+
+            value = value.strip().replace(",", ".").replace("T", " ")
+            if value.endswith("Z"):
+                value = value[:-1] + "+00:00"
+            return _local(datetime.fromisoformat(value))
+    except (ValueError, OverflowError, OSError):
+        pass
+
+    return datetime.now().isoformat(" ")
+
+
+# Logging levels of the syslog severities
+SYSLOG_LEVELS = (
+    logging.CRITICAL,
+    logging.CRITICAL,
+    logging.CRITICAL,
+    logging.ERROR,
+    logging.WARNING,
+    logging.INFO,
+    logging.INFO,
+    logging.DEBUG,
+)
+SYSLOG_MONTHS = {
+    month: i + 1
+    for i, month in enumerate(
+        ("Jan", "Feb", "Mar", "Apr", "May", "Jun")
+        + ("Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+    )
+}
+
+# <PRI>1 TIMESTAMP HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA [MSG]
+RFC5424 = re.compile(
+    r"<(\d{1,3})>1 (\S+) (\S+) (\S+) (\S+) \S+ (?:-|(?:\[(?:[^\]\\]|\\.)*\])+)"
+    r"(?: (?:\ufeff)?(.*))?",
+    re.DOTALL,
+)
+# <PRI>Mmm dd hh:mm:ss [HOSTNAME] TAG[PID]: MSG
+RFC3164 = re.compile(
+    r"<(\d{1,3})>([A-Z][a-z]{2}) ([ \d]\d) (\d\d:\d\d:\d\d) (?:(\S+) )?"
+    r"([^\s:\[]+)(?:\[(\d+)\])?: ?(.*)",
+    re.DOTALL,
+)
+SYSLOG_PRI = re.compile(r"<(\d{1,3})>(.*)", re.DOTALL)
+
+
+def _syslog_time(month: str, day: str, clock: str) -> str:
+    """Convert the RFC 3164 timestamp without year into the isoformat"""
+    now = datetime.now()
+    month = SYSLOG_MONTHS.get(month, now.month)
+    # Messages from December arriving in January belong to the last year
+    year = now.year - 1 if month > now.month + 1 else now.year
+    try:
+        created_at = datetime(year, month, int(day), *map(int, clock.split(":")))
+    except ValueError:
+        # Invalid dates like the 31st of February use the receive time
+        created_at = now
+    return created_at.isoformat(" ")
+
+
+def parse_syslog(data: bytes, host: str = None) -> dict:
+    """Convert a RFC 5424 or RFC 3164 syslog message into a log message. Messages
+    in other formats are kept as plain text with INFO level"""
+    text = data.decode(errors="replace").rstrip("\r\n\0")
+    message = {"level": logging.INFO, "pid": 0, "created_by": "syslog"}
+
+    match = RFC5424.match(text)
+    if match:
+        pri, timestamp, hostname, app, pid, msg = match.groups()
+        created_at = parse_time(timestamp)
+    else:
+        match = RFC3164.match(text)
+        if match:
+            pri, month, day, clock, hostname, app, pid, msg = match.groups()
+            created_at = _syslog_time(month, day, clock)
+        else:
+            match = SYSLOG_PRI.match(text)
+            pri, msg = match.groups() if match else (None, text)
+            hostname = app = pid = None
+            created_at = datetime.now().isoformat(" ")
+
+    if pri is not None:
+        message["level"] = SYSLOG_LEVELS[int(pri) & 7]
+    if app and app != "-":
+        message["created_by"] = app
+    if pid and pid.isdigit():
+        message["pid"] = int(pid)
+
+    hostname = hostname if hostname and hostname != "-" else host
+    if hostname:
+        message["host"] = hostname
+
+    message["created_at"] = created_at
+    message["message"] = msg or ""
+    return message
+
+
+class LineParser:
+    """Convert the text read from a file into messages. The parsing works on the
+    entire chunk of text at once. Records spanning multiple lines are assembled
+    and the lines following the first line end up in the exception field.
+
+    Formats:
+      plain  Every line is a message. Lines matching `continuation` belong to the
+             previous record
+      regex  Lines matching `regex` start a new record and the named groups are
+             used as fields. Other lines belong to the previous record
+      json   Every line is a JSON object
+    """
+
+    def __init__(
+        self,
+        pattern: str = "*",
+        *,
+        format: str = "plain",
+        regex: str = None,
+        continuation: str = None,
+        fields: Dict[str, str] = None,
+        time_format: str = None,
+    ):
+        if format not in ("plain", "regex", "json"):
+            raise ValueError(f"Unknown format {format}")
+
+        if format == "regex" and not regex:
+            raise ValueError("The regex format requires a regex")
+
+        self.pattern = pattern
+        self.format = format
+        self.time_format = time_format
+        self.pid = os.getpid()
+        self.pending = {}
+
+        self.fields = {key: (value,) for key, value in (fields or {}).items()}
+        self.fields = {**JSON_FIELDS, **self.fields}
+
+        # Regex matching the first line of every record within a chunk
+        if format == "regex":
+            self.start = re.compile(rf"^(?:{regex})$", re.MULTILINE)
+        elif continuation:
+            self.start = re.compile(rf"^(?!(?:{continuation})).*\S.*$", re.MULTILINE)
+        else:
+            self.start = None
+
+    def __repr__(self) -> str:
+        return f"<parser {self.format}:{self.pattern}>"
+
+    def match(self, path: str) -> bool:
+        """Check if the parser should be used for the path"""
+        return PurePath(path).match(self.pattern)
+
+    def _message(self, path: str, fields: dict, exception: str = None) -> dict:
+        """Build a message from the extracted fields"""
+        pid = fields.get("pid")
+        message = {
+            "level": parse_level(fields.get("level")),
+            "pid": int(pid) if str(pid or "").isdigit() else self.pid,
+            "created_at": parse_time(fields.get("created_at"), self.time_format),
+            "created_by": fields.get("created_by") or path,
+            "message": str(fields.get("message", "")).strip(),
+        }
+
+        exception = exception or fields.get("exception")
+        if exception:
+            message["exception"] = exception
+        return message
+
+    def _json_fields(self, data: dict) -> dict:
+        """Extract the fields from a JSON object"""
+        result = {}
+        for field, keys in self.fields.items():
+            for key in keys:
+                if data.get(key) is not None:
+                    result[field] = data[key]
+                    break
+        return result
+
+    def _parse_json(self, path: str, text: str) -> List[dict]:
+        lines = [line for line in map(str.strip, text.split("\n")) if line]
+        if not lines:
+            return []
+
+        # Decode all lines at once and only fall back to single lines on errors.
+        # Lines like "[1" and "2]" would merge which is detected by the count
+        try:
+            objects = json.loads(f"[{','.join(lines)}]")
+        except ValueError:
+            objects = None
+
+        if objects is None or len(objects) != len(lines):
+            objects = []
+            for line in lines:
+                try:
+                    objects.append(json.loads(line))
+                except ValueError:
+                    objects.append(line)
+
+        messages = []
+        for obj in objects:
+            if isinstance(obj, dict):
+                messages.append(self._message(path, self._json_fields(obj)))
+            else:
+                messages.append(self._message(path, {"message": str(obj)}))
+        return messages
+
+    def _assemble(self, path: str, pending: Tuple) -> dict:
+        """Build the message from the first line and the continuation lines"""
+        match, bodies, _ = pending
+        lines = "".join(bodies).split("\n")
+        exception = "\n".join(line.rstrip() for line in lines if line.strip())
+
+        fields = {}
+        if self.format == "regex":
+            fields = {k: v for k, v in match.groupdict().items() if v is not None}
+        if "message" not in fields:
+            fields["message"] = match.group(0)
+        return self._message(path, fields, exception)
+
+    def feed(self, path: str, text: str) -> List[dict]:
+        """Parse a chunk of full lines. The last record of the chunk is kept
+        until the next record starts or the parser is flushed"""
+        if self.format == "json":
+            return self._parse_json(path, text)
+
+        if self.start is None:
+            lines = map(str.strip, text.split("\n"))
+            return [self._message(path, {"message": line}) for line in lines if line]
+
+        messages = []
+        matches = list(self.start.finditer(text))
+        head = text[: matches[0].start()] if matches else text
+
+        # Lines before the first record belong to the pending record of the path
+        if path in self.pending:
+            match, bodies, _ = self.pending[path]
+            bodies.append(head)
+            if head:
+                self.pending[path] = (match, bodies, time.monotonic())
+        elif head.strip():
+            for line in filter(str.strip, head.split("\n")):
+                messages.append(self._message(path, {"message": line}))
+
+        for i, match in enumerate(matches):
+            if path in self.pending:
+                messages.append(self._assemble(path, self.pending.pop(path)))
+
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+            self.pending[path] = (match, [text[match.end() : end]], time.monotonic())
+
+        return messages
+
+    def flush(self, path: str = None, max_age: float = 0) -> List[dict]:
+        """Return the pending records which are older than max_age seconds"""
+        now = time.monotonic()
+        paths = [path] if path else list(self.pending)
+
+        messages = []
+        for p in paths:
+            pending = self.pending.get(p)
+            if pending and now - pending[2] >= max_age:
+                messages.append(self._assemble(p, self.pending.pop(p)))
+        return messages
+
+
+def load_parsers(filename: str) -> List[LineParser]:
+    """Load the parser definitions from a JSON file containing a list of objects
+    with the arguments of the LineParser"""
+    with open(filename) as fp:
+        definitions = json.load(fp)
+
+    if not isinstance(definitions, list):
+        raise ValueError("The parser file must contain a list")
+
+    return [LineParser(**definition) for definition in definitions]
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import FrameType
+from typing import Any
+
+_logger = logging.getLogger()
+
+
+class Tracer:
+    """Measures the time spent in the stages of the pipeline. Enabling the tracer
+    wraps the registered methods of the instances while disabling it restores the
+    original methods which leaves no overhead"""
+
+    def __init__(self):
+        self.targets = []
+        self.stages = {}
+        self.enabled = False
+
+    def add(self, obj: Any, name: str) -> None:
+        """Register the coroutine method of the object as stage"""
+        self.targets.append((obj, name))
+        if self.enabled:
+            self._wrap(obj, name)
+
+    def _wrap(self, obj: Any, name: str) -> None:
+        stage = f"{type(obj).__name__}.{name}"
+        stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+        func = getattr(obj, name)
+
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+
+        setattr(obj, name, wrapper)
+
+    def enable(self) -> None:
+        """Reset the timings and start to measure the stages"""
+        if self.enabled:
+            return
+
+        self.enabled = True
+        self.stages = {}
+        for obj, name in self.targets:
+            self._wrap(obj, name)
+
+    def disable(self) -> None:
+        """Stop to measure the stages"""
+        self.enabled = False
+        for obj, name in self.targets:
+            if name in vars(obj):
+                delattr(obj, name)
+
+    def summary(self) -> dict:
+        """Return the number of calls and the timings of the stages in ms"""
+        return {
+            stage: {
+                "count": count,
+                "total": total * 1000,
+                "mean": total / count * 1000 if count else 0,
+                "max": peak * 1000,
+            }
+            for stage, (count, total, peak) in sorted(self.stages.items())
+        }
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stack of the event loop thread in a background thread for a
+    limited time. The stacks are written in the folded format of flame graphs
+    together with a summary of the traced stages"""
+
+    def __init__(
+        self,
+        directory: str,
+        *,
+        duration: float = 30,
+        interval: float = 0.005,
+        tracer: Tracer = None,
+    ):
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.tracer = tracer or Tracer()
+        self.stopped = self.timer = None
+
+    def running(self) -> bool:
+        """Return if a profile is captured"""
+        return self.stopped is not None
+
+    def toggle(self) -> None:
+        """Start or stop the capturing of a profile"""
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def start(self) -> None:
+        """Start to capture a profile of the current thread"""
+        if self.running():
+            return
+
+        _logger.info(f"Starting the profiler for {self.duration} seconds")
+        self.stopped = threading.Event()
+        self.tracer.enable()
+        threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), self.stopped),
+            daemon=True,
+        ).start()
+
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_later(self.duration, self.stop)
+
+    def stop(self) -> None:
+        """Stop the capturing. The sampling thread writes the profile"""
+        if not self.running():
+            return
+
+        self.timer.cancel()
+        self.tracer.disable()
+        self.stopped.set()
+        self.stopped = self.timer = None
+
+    def _sample(self, thread_id: int, stopped: threading.Event) -> None:
+        stacks = Counter()
+        while not stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+
+        self._dump(stacks, self.tracer.summary())
+
+    def _dump(self, stacks: Counter, stages: dict) -> None:
+        path = os.path.join(
+            self.directory, datetime.now().strftime("profile-%Y%m%d-%H%M%S")
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.folded", "w") as fp:
+                for stack, count in stacks.most_common():
+                    fp.write(f"{stack} {count}\n")
+
+            summary = {"samples": sum(stacks.values()), "stages": stages}
+            with open(f"{path}.json", "w") as fp:
+                json.dump(summary, fp, indent=2)
+        except OSError as e:
+            _logger.error(f"Can't write the profile: {e}")
+            return
+
+        _logger.info(f"Profile written to {path}.folded")
@@ -0,0 +1,108 @@
+import json
+import sys
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Iterator
+
+# Fields which are stored in the slots of the records
+FIELDS = (
+    "level",
+    "pid",
+    "host",
+    "message",
+    "created_at",
+    "created_by",
+    "exception",
+    "path",
+    "lineno",
+)
+SLOTTED = frozenset(FIELDS)
+
+# Low-cardinality fields whose values are shared between the records
+INTERNED = frozenset(("host", "created_by", "path"))
+
+_MISSING = object()
+
+
+class Record(MutableMapping):
+    """Compact log record which stores the known fields in slots instead of a dict
+    per message. The repeated strings of the low-cardinality fields are interned
+    while unknown fields end up in a separate dict"""
+
+    __slots__ = (*FIELDS, "extra")
+
+    def __init__(self, data: Mapping = None):
+        self.extra = None
+        for key, value in (data or {}).items():
+            self[key] = value
+
+    def __repr__(self) -> str:
+        return f"Record({self.to_dict()!r})"
+
+    def __getitem__(self, key: str) -> Any:
+        if key in SLOTTED:
+            value = getattr(self, key, _MISSING)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in SLOTTED:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            return
+
+        if key in INTERNED and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        if key not in SLOTTED:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+        elif hasattr(self, key):
+            delattr(self, key)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the value of the field or the default if it's missing"""
+        if key in SLOTTED:
+            return getattr(self, key, default)
+        return self.extra.get(key, default) if self.extra else default
+
+    def to_dict(self) -> dict:
+        """Return the record as dict"""
+        data = {key: getattr(self, key) for key in FIELDS if hasattr(self, key)}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(default=_encode_default)
+
+
+def dumps(message: Mapping) -> str:
+    """Encode the message or record as JSON"""
+    return _encoder.encode(message)
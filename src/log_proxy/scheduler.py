@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from collections import deque
+
+from . import forwarders
+from .forwarders.base import LevelQueue, get_level, get_time
+
+_logger = logging.getLogger()
+
+
+class FairScheduler:
+    """Keeps a bounded queue per client and drains them into the forwarder using
+    deficit round-robin. A full client queue evicts its oldest message of a lower
+    level band first and only blocks the connections of this client if nothing
+    less important is queued. The other clients can continue meanwhile.
+
+    The scheduler waits for free space in the forwarder queue instead of letting
+    it shed messages. With a limited forwarder queue the messages pile up in the
+    client queues where the shedding happens per client"""
+
+    def __init__(
+        self,
+        forwarder: forwarders.Forwarder,
+        max_size: int = 1000,
+        quantum: int = 16,
+    ):
+        self.forwarder = forwarder
+        self.max_size = max_size
+        self.quantum = quantum
+        self.counter = 0
+        self.queues = {}
+        self.weights = {}
+        self.deficits = {}
+        self.active = deque()
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+
+    def set_weight(self, name: str, weight: float) -> None:
+        """Set the weight of a client. The default weight is 1"""
+        self.weights[name] = max(float(weight), 0.0) or 1.0
+
+    def qsize(self, name: str = None) -> int:
+        """Return the number of queued messages of a client"""
+        queue = self.queues.get(name)
+        return queue.qsize() if queue else 0
+
+    def full(self, name: str = None) -> bool:
+        """Return if the queue of a client is full"""
+        queue = self.queues.get(name)
+        return queue is not None and queue.full()
+
+    async def put(self, name: str, message: dict) -> None:
+        """Put a message on the queue of the client. If the queue is full a less
+        important message is dropped or it waits if there is none"""
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = LevelQueue(self.max_size)
+
+        item = (get_time(message), self.counter, message)
+        self.counter += 1
+
+        dropped = queue.evict(item) if queue.full() else None
+        if dropped:
+            self.forwarder.dropped[get_level(dropped[-1])] += 1
+            queue.put_nowait(item)
+        else:
+            await queue.put(item)
+
+        self.idle.clear()
+
+        # Activate the client if it has no deficit yet
+        if name not in self.deficits:
+            self.deficits[name] = 0
+            self.active.append(name)
+        self.ready.set()
+
+    async def drain(self, timeout: float = None) -> bool:
+        """Wait until the client queues are moved into the forwarder. Returns False
+        if the timeout was reached before"""
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self) -> None:
+        """Drain the client queues into the forwarder"""
+        while True:
+            if not self.active:
+                self.ready.clear()
+                self.idle.set()
+                await self.ready.wait()
+                continue
+
+            name = self.active.popleft()
+            queue = self.queues[name]
+            self.deficits[name] += self.quantum * self.weights.get(name, 1.0)
+
+            while self.deficits[name] >= 1 and not queue.empty():
+                await self.forwarder.put_wait(queue.get_nowait()[-1])
+                self.deficits[name] -= 1
+
+            # Idle clients don't keep their deficit
+            if queue.empty():
+                self.deficits.pop(name)
+            else:
+                self.active.append(name)
@@ -2,23 +2,63 @@ import asyncio
 import json
 import logging
 import os
+import signal
+import socket
 import ssl
+import struct
+import time
 from asyncio import StreamReader, StreamWriter
 from asyncio.exceptions import IncompleteReadError
-from typing import List
+from collections import Counter
+from typing import Callable, Iterable, List, Tuple
 
-from . import forwarders, utils
+from . import forwarders, ingest, parsers, utils
+from .forwarders.base import RawMessage
+from .profiling import SamplingProfiler
+from .records import Record
+from .scheduler import FairScheduler
+from .tls import SessionContext
 
 _logger = logging.getLogger()
 
 
 RequiredFields = ("level", "pid", "message", "created_at", "created_by")
 
+# Fields which are truncated if they exceed the maximum field size
+TruncatedFields = ("message", "exception")
+
+# Maximum number of digits of the length prefix of octet counted syslog frames
+SyslogLengthDigits = 10
+
 
 class LogTokenFileError(Exception):
     pass
 
 
+def split_frames(data: bytes) -> List[bytes]:
+    """Split the data into the length prefixed frames"""
+    frames, offset = [], 0
+    while offset < len(data):
+        (length,) = struct.unpack_from(">L", data, offset)
+        offset += 4
+        if length <= 0 or offset + length > len(data):
+            raise ValueError("Invalid frame length")
+
+        frames.append(data[offset : offset + length])
+        offset += length
+    return frames
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """Passes the received datagrams to the callback"""
+
+    def __init__(self, callback: Callable[[bytes, tuple], None]):
+        self.callback = callback
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.callback(data, addr)
+
+
 class LogServer:
     """Logging server which can accept logs from the JSONSocketHandler. Received
     logs are passed to the standard python log. This allows to pass the logs further
@@ -32,6 +72,24 @@ class LogServer:
         ssl_context: ssl.SSLContext = None,
         token_file: str = None,
         use_auth: bool = True,
+        client_queue_size: int = 0,
+        stats_interval: float = 0,
+        max_frame_size: int = 1 << 20,
+        max_field_size: int = 0,
+        max_connections: int = 0,
+        max_client_connections: int = 0,
+        idle_timeout: float = 0,
+        auth_timeout: float = 10,
+        relay: bool = False,
+        profiler: SamplingProfiler = None,
+        sockets: List[socket.socket] = None,
+        udp_address: Tuple[str, int] = None,
+        syslog_address: Tuple[str, int] = None,
+        unix_path: str = None,
+        unix_mode: int = 0o660,
+        unix_uids: Iterable[int] = None,
+        http_address: Tuple[str, int] = None,
+        ready_fd: int = None,
     ):
         self.host = host
         self.port = port
@@ -41,6 +99,35 @@ class LogServer:
         self.token_file = token_file
         self.token_mtime = None
         self.forwarder = forwarder
+        self.stats_interval = stats_interval
+        self.max_frame_size = max_frame_size
+        self.max_field_size = max_field_size
+        self.max_connections = max_connections
+        self.max_client_connections = max_client_connections
+        self.idle_timeout = idle_timeout
+        self.auth_timeout = auth_timeout
+        self.relay = relay
+        self.profiler = profiler
+        self.sockets = sockets
+        self.servers = []
+        self.clients = set()
+        self.tasks = []
+        self.closed = None
+        self.udp_address = udp_address
+        self.syslog_address = syslog_address
+        self.unix_path = unix_path
+        self.unix_mode = unix_mode
+        self.unix_uids = set(unix_uids) if unix_uids is not None else None
+        self.http_address = http_address
+        self.ready_fd = ready_fd
+        # Listeners besides the main sockets which aren't handed over on upgrades
+        self.listeners = []
+        self.tokens_checked = 0
+        self.connection_count = 0
+        self.connections = Counter()
+        self.scheduler = None
+        if client_queue_size > 0:
+            self.scheduler = FairScheduler(forwarder, max_size=client_queue_size)
 
     def add_token(self, token: str, **kwargs) -> None:
         """Add a token and store additional information about the client"""
@@ -66,7 +153,18 @@ class LogServer:
             with open(self.token_file) as fp:
                 self.tokens = json.load(fp)
 
-    def auth_client(self, auth: dict) -> dict:
+    def reload_tokens(self, token_file: str = None) -> None:
+        """Read the token file again. Invalid files keep the current tokens"""
+        if token_file:
+            self.token_file = token_file
+
+        self.token_mtime = None
+        try:
+            self._update_tokens()
+        except (OSError, ValueError) as e:
+            _logger.error(f"Can't reload the token file: {e}")
+
+    def auth_client(self, auth: dict, update: bool = True) -> dict:
         """Evaluate the auth message and return the fitting client"""
         if not isinstance(auth, dict):
             return None
@@ -75,7 +173,8 @@ class LogServer:
         if not token:
             return None
 
-        self._update_tokens()
+        if update:
+            self._update_tokens()
         client = self.tokens.get(token)
         if client is None:
             return None
@@ -83,16 +182,70 @@ class LogServer:
         client["name"] = client.get("name", token)
         return client
 
-    async def _read_message(self, reader: StreamReader) -> dict:
-        """Read a message from the reader and evaluate it"""
-        try:
-            (length,) = await utils.receive_struct(reader, ">L")
-            if length <= 0:
+    def _relay_message(
+        self, data: bytes, message: dict, host: bytes = None
+    ) -> RawMessage:
+        """Keep the decoded frame as raw message to skip the encoding for the next
+        hop. Only valid messages are relayed and the host prefix is inserted if
+        the message has no host. Return None if the message must be rewritten"""
+        if not isinstance(message, dict) or data[:1] != b"{":
+            return None
+
+        if not set(message).issuperset(RequiredFields):
+            return None
+
+        level = message["level"]
+        if not isinstance(level, int) or isinstance(level, bool):
+            return None
+
+        # Smaller frames can't contain fields exceeding the maximum size
+        if 0 < self.max_field_size < len(data):
+            return None
+
+        if "host" in message:
+            if not message["host"]:
                 return None
+        elif host:
+            data = host + data[1:]
+        return RawMessage(data, level)
 
-            message = json.loads(await reader.readexactly(length))
-            return message
-        except (json.JSONDecodeError, IncompleteReadError):
+    async def _read_frame(self, reader: StreamReader, host: bytes = None) -> dict:
+        (length,) = await utils.receive_struct(reader, ">L")
+        if length <= 0:
+            return None
+
+        # Don't buffer frames above the limit
+        if 0 < self.max_frame_size < length:
+            _logger.warning(f"Frame of {length} bytes exceeds the maximum size")
+            return None
+
+        return self._decode(await reader.readexactly(length), host)
+
+    def _decode(self, data: bytes, host: bytes = None) -> dict:
+        """Decode the frame and keep valid frames as raw message in relay mode"""
+        message = json.loads(data)
+        if self.relay:
+            raw = self._relay_message(data, message, host)
+            if raw is not None:
+                return raw
+        return message
+
+    def _host_prefix(self, name: str) -> bytes:
+        """Return the prefix to insert the host into relayed frames"""
+        if not self.relay or not name:
+            return None
+        return b'{"host": ' + json.dumps(name).encode() + b", "
+
+    async def _read_message(
+        self, reader: StreamReader, timeout: float = 0, host: bytes = None
+    ) -> dict:
+        """Read a message from the reader and evaluate it. Oversized frames and
+        exceeding the timeout return None"""
+        try:
+            if timeout > 0:
+                return await asyncio.wait_for(self._read_frame(reader, host), timeout)
+            return await self._read_frame(reader, host)
+        except (json.JSONDecodeError, IncompleteReadError, asyncio.TimeoutError):
             return None
 
     def _validate_message(self, message: dict, required: List[str]) -> dict:
@@ -100,15 +253,110 @@ class LogServer:
         if not isinstance(message, dict):
             return None
 
+        # Relayed messages are already checked
+        if isinstance(message, RawMessage):
+            return message
+
         return message if set(message).issuperset(required) else None
 
+    def _truncate_message(self, message: dict) -> dict:
+        """Truncate the fields of the message exceeding the maximum field size"""
+        size = self.max_field_size
+        if size <= 0:
+            return message
+
+        for field in TruncatedFields:
+            value = message.get(field)
+            if isinstance(value, str) and len(value) > size:
+                message[field] = f"{value[:size]}... [{len(value) - size} truncated]"
+        return message
+
+    def _prepare_message(self, message: dict, client_name: str = None) -> dict:
+        """Validate the message and convert it into a compact record with the host
+        of the client. Returns None for invalid messages"""
+        message = self._validate_message(message, RequiredFields)
+        if message is None:
+            return None
+
+        # The host of relayed messages is set while reading the frame
+        if isinstance(message, RawMessage):
+            return message
+
+        message = self._truncate_message(Record(message))
+        if client_name and not message.get("host"):
+            message["host"] = client_name
+        return message
+
     async def _process_message(self, message: dict, client_name: str = None) -> None:
         """Forward the log to the next server or database"""
-        if not message.get("host") and client_name:
-            message["host"] = client_name
+        # The host of relayed messages is set while reading the frame
+        if client_name and not isinstance(message, RawMessage):
+            if not message.get("host"):
+                message["host"] = client_name
+
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(f"Forwarding: {message}")
+        if self.scheduler:
+            await self.scheduler.put(client_name, message)
+        else:
+            await self.forwarder.put(message)
 
-        _logger.debug(f"Forwarding: {message}")
-        await self.forwarder.put(message)
+    def _receive_datagram(self, data: bytes, addr: tuple = None) -> None:
+        """Forward the frames of a datagram. With authentication the first frame
+        must hold the token. Datagrams bypass the client queues"""
+        try:
+            frames = split_frames(data)
+
+            name = None
+            if self.use_auth:
+                # Check the token file at most once per second
+                now = time.monotonic()
+                if now - self.tokens_checked >= 1:
+                    self.tokens_checked = now
+                    self._update_tokens()
+
+                auth = json.loads(frames.pop(0)) if frames else None
+                client = self.auth_client(
+                    self._validate_message(auth, ["token"]), False
+                )
+                if not client:
+                    return
+                name = client["name"]
+
+            host = self._host_prefix(name)
+            for frame in frames:
+                message = self._prepare_message(self._decode(frame, host), name)
+                if message is not None:
+                    self.forwarder.put_nowait(message)
+        except (OSError, ValueError, struct.error) as e:
+            _logger.debug(f"Invalid datagram: {e!r}")
+
+    def _receive_syslog(self, data: bytes, addr: tuple) -> None:
+        """Forward a syslog message received as datagram"""
+        message = self._prepare_message(parsers.parse_syslog(data, addr[0]))
+        if message is not None:
+            self.forwarder.put_nowait(message)
+
+    async def _read_syslog_frame(self, reader: StreamReader) -> bytes:
+        """Read a syslog message with octet counting or newline framing. Only a
+        number followed by a space is the length of an octet counted frame"""
+        prefix = await reader.readexactly(1)
+        try:
+            while prefix[-1:].isdigit() and len(prefix) <= SyslogLengthDigits:
+                prefix += await reader.readexactly(1)
+
+            if prefix[-1:] != b" " or not prefix[:-1].isdigit():
+                if prefix[-1:] == b"\n":
+                    return prefix
+                return prefix + await reader.readuntil(b"\n")
+        except IncompleteReadError as e:
+            # The last message of the stream might miss the newline
+            return prefix + e.partial
+
+        length = int(prefix[:-1])
+        if 0 < self.max_frame_size < length:
+            raise ValueError(f"Frame of {length} bytes exceeds the limit")
+        return await reader.readexactly(length)
 
     async def _stop(self, reader: StreamReader, writer: StreamWriter) -> None:
         """Stop the reader and writer"""
@@ -116,10 +364,69 @@ class LogServer:
         writer.close()
         await writer.wait_closed()
 
-    async def _accept(self, reader: StreamReader, writer: StreamWriter) -> None:
-        """Accept new clients and wait for logs to process them"""
-        if self.use_auth:
-            message = await self._read_message(reader)
+    async def report(self, interval: float) -> None:
+        """Periodically log the TLS handshakes if new clients connected since the
+        last report"""
+        reported = 0
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.ssl_context.stats()
+            if stats["handshakes"] == reported:
+                continue
+
+            reported = stats["handshakes"]
+            _logger.info(
+                f"{stats['handshakes']} TLS handshakes, {stats['resumed']} resumed "
+                f"({stats['resumed_ratio']:.0%})"
+            )
+
+    async def _accept(
+        self, reader: StreamReader, writer: StreamWriter, serve: Callable = None
+    ) -> None:
+        """Accept new clients within the connection limit"""
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object and isinstance(self.ssl_context, SessionContext):
+            self.ssl_context.handshake(ssl_object)
+
+        if 0 < self.max_connections <= self.connection_count:
+            _logger.warning("Maximum number of connections reached")
+            await self._stop(reader, writer)
+            return
+
+        self.connection_count += 1
+        self.clients.add(writer)
+        try:
+            await (serve or self._serve)(reader, writer)
+        finally:
+            self.connection_count -= 1
+            self.clients.discard(writer)
+
+    def _unix_client(self, writer: StreamWriter) -> dict:
+        """Identify the client of the Unix socket by the user of the peer process.
+        Returns None if the user isn't allowed"""
+        _, uid, _ = utils.peer_credentials(writer.get_extra_info("socket"))
+        if self.unix_uids is not None and uid not in self.unix_uids:
+            _logger.warning(f"Rejected the Unix socket client of user {uid}")
+            return None
+        return {"name": utils.user_name(uid)}
+
+    async def _serve_unix(self, reader: StreamReader, writer: StreamWriter) -> None:
+        """Authenticate the client of the Unix socket by the peer credentials
+        instead of a token"""
+        client = self._unix_client(writer)
+        if not client:
+            await self._stop(reader, writer)
+            return
+
+        await self._serve(reader, writer, client)
+
+    async def _serve(
+        self, reader: StreamReader, writer: StreamWriter, client: dict = None
+    ) -> None:
+        """Authenticate the client unless it's already known and wait for logs to
+        process them"""
+        if client is None and self.use_auth:
+            message = await self._read_message(reader, self.auth_timeout)
             message = self._validate_message(message, ["token"])
             client = self.auth_client(message)
 
@@ -127,44 +434,362 @@ class LogServer:
                 await self._stop(reader, writer)
                 return
 
-            name = client["name"]
+        client = client or {}
+        name = client.get("name")
+        if name:
             _logger.info(f"Client '{name}' connected")
-        else:
-            client = {}
-            name = None
 
+            if self.scheduler:
+                self.scheduler.set_weight(name, client.get("weight", 1))
+
+        # Clients without authentication are identified by their address
+        key = None
+        if self.max_client_connections > 0:
+            key = name or writer.get_extra_info("peername")[0]
+            if self.connections[key] >= self.max_client_connections:
+                _logger.warning(f"Maximum number of connections reached for {key}")
+                await self._stop(reader, writer)
+                return
+
+            self.connections[key] += 1
+
+        # The host is inserted into relayed frames with a prefix per connection
+        host = self._host_prefix(name)
+
+        try:
+            while True:
+                message = await self._read_message(reader, self.idle_timeout, host)
+                data = self._prepare_message(message, name)
+                if data is None:
+                    break
+
+                await self._process_message(data, name)
+        finally:
+            if key is not None:
+                self.connections[key] -= 1
+                if not self.connections[key]:
+                    del self.connections[key]
+
+        await self._stop(reader, writer)
+
+    async def _serve_syslog(self, reader: StreamReader, writer: StreamWriter) -> None:
+        """Wait for syslog messages to process them. The host of the client is
+        used if the messages don't contain a hostname"""
+        host = writer.get_extra_info("peername")[0]
+        while True:
+            try:
+                if self.idle_timeout > 0:
+                    data = await asyncio.wait_for(
+                        self._read_syslog_frame(reader), self.idle_timeout
+                    )
+                else:
+                    data = await self._read_syslog_frame(reader)
+            except (
+                IncompleteReadError,
+                asyncio.LimitOverrunError,
+                asyncio.TimeoutError,
+                ValueError,
+            ):
+                break
+
+            if not data.strip():
+                continue
+
+            message = self._prepare_message(parsers.parse_syslog(data, host))
+            if message is not None:
+                await self._process_message(message)
+
+        await self._stop(reader, writer)
+
+    def _backpressure(self, client_name: str = None) -> bool:
+        """Return if the queue of the client or the forwarder is full"""
+        if self.scheduler:
+            return self.scheduler.full(client_name)
+        return self.forwarder.full()
+
+    async def _ingest(
+        self, reader: StreamReader, writer: StreamWriter, request: ingest.Request
+    ) -> Tuple[int, dict]:
+        """Authenticate the request and forward the lines of the NDJSON body while
+        it's read. Returns the status and body of the response"""
+        method, path, _, headers = request
+        if path != "/logs":
+            raise ingest.HTTPError(404)
+        if method != "POST":
+            raise ingest.HTTPError(405)
+
+        name = None
+        if self.use_auth:
+            scheme, _, token = headers.get("authorization", "").partition(" ")
+            client = self.auth_client({"token": token.strip()})
+            if scheme.lower() != "bearer" or not client:
+                raise ingest.HTTPError(401)
+
+            name = client["name"]
+            if self.scheduler:
+                self.scheduler.set_weight(name, client.get("weight", 1))
+
+        if self._backpressure(name):
+            raise ingest.HTTPError(429)
+
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        host = self._host_prefix(name)
+        body = ingest.read_body(reader, headers)
+        body = ingest.decompress(body, headers.get("content-encoding", ""))
+
+        result = {"accepted": 0, "rejected": 0}
+        async for line in ingest.iter_lines(body, self.max_frame_size):
+            # The remaining body isn't read and the client retries it later
+            if self._backpressure(name):
+                raise ingest.HTTPError(429, body=result)
+
+            try:
+                message = self._prepare_message(self._decode(line, host), name)
+            except ValueError:
+                message = None
+
+            if message is None:
+                result["rejected"] += 1
+            else:
+                await self._process_message(message, name)
+                result["accepted"] += 1
+        return 200, result
+
+    async def _serve_http(self, reader: StreamReader, writer: StreamWriter) -> None:
+        """Answer the requests of the client until it closes the connection. Errors
+        close the connection because the body might not be read"""
         while True:
-            message = await self._read_message(reader)
-            data = self._validate_message(message, RequiredFields)
-            if not isinstance(data, dict):
+            try:
+                if self.idle_timeout > 0:
+                    request = await asyncio.wait_for(
+                        ingest.read_request(reader), self.idle_timeout
+                    )
+                else:
+                    request = await ingest.read_request(reader)
+                if request is None:
+                    break
+
+                status, body = await self._ingest(reader, writer, request)
+                keep_alive = ingest.keep_alive(request[2], request[3])
+            except ingest.HTTPError as e:
+                status, body, keep_alive = e.status, e.body, False
+            except (
+                IncompleteReadError,
+                asyncio.LimitOverrunError,
+                asyncio.TimeoutError,
+            ):
                 break
 
-            await self._process_message(data, name)
+            writer.write(ingest.response(status, body, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
 
         await self._stop(reader, writer)
 
+    def _setup_profiler(self) -> None:
+        """Register the traced stages and toggle the profiler with SIGUSR1"""
+        tracer = self.profiler.tracer
+        for name in ("_read_message", "_process_message"):
+            tracer.add(self, name)
+
+        if self.forwarder:
+            for name in ("put", "process_message", "process_messages"):
+                tracer.add(self.forwarder, name)
+
+        if hasattr(signal, "SIGUSR1"):
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.toggle)
+
+    def _start_forwarder(self) -> None:
+        _logger.info(f"Starting forwarder to {self.forwarder}")
+        self.tasks = [asyncio.create_task(self.forwarder.process())]
+
+        if self.stats_interval > 0:
+            self.tasks.append(
+                asyncio.create_task(self.forwarder.report(self.stats_interval))
+            )
+
+    async def replace_forwarder(
+        self, forwarder: forwarders.Forwarder, timeout: float = None
+    ) -> None:
+        """Switch to a new forwarder. The old one gets the chance to send its queue
+        until the timeout and the remaining messages are moved to the new one"""
+        old, tasks = self.forwarder, self.tasks
+        self.forwarder = forwarder
+        if self.scheduler:
+            self.scheduler.forwarder = forwarder
+        self._start_forwarder()
+
+        if not await old.drain(timeout):
+            _logger.warning(f"{old} couldn't send all messages before the timeout")
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        moved = old.transfer(forwarder)
+        if moved:
+            _logger.info(f"Moved {moved} messages to {forwarder}")
+
+    def listening_fds(self) -> List[int]:
+        """Return the file descriptors of the listening sockets"""
+        return [sock.fileno() for server in self.servers for sock in server.sockets]
+
+    async def shutdown(self, timeout: float = None) -> None:
+        """Stop accepting clients and close the connections. The queued messages
+        are forwarded until the timeout before the server stops"""
+        _logger.info("Shutting down the log server")
+        for server in self.servers:
+            server.close()
+
+        for listener in self.listeners:
+            listener.close()
+
+        for writer in list(self.clients):
+            writer.close()
+
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        if self.scheduler and not await self.scheduler.drain(timeout):
+            _logger.warning("The client queues couldn't be emptied before the timeout")
+
+        if self.forwarder:
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            if not await self.forwarder.drain(remaining):
+                _logger.warning(
+                    f"{self.forwarder.queue.qsize()} messages couldn't be forwarded "
+                    "before the timeout"
+                )
+
+            # Close the connection of the forwarder to flush its buffers
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.forwarder.invalidate()
+
+        await self.stop()
+
     async def run(self) -> None:
         """Start the server and listen for logs"""
+        if self.profiler:
+            self._setup_profiler()
+
         if self.forwarder:
-            _logger.info(f"Starting forwarder to {self.forwarder}")
-            asyncio.create_task(self.forwarder.process())
-
-        _logger.info(f"Starting log server on {self.host}:{self.port}")
-        self.sock = await asyncio.start_server(
-            self._accept,
-            self.host,
-            self.port,
-            ssl=self.ssl_context,
-        )
+            self._start_forwarder()
 
-        async with self.sock:
-            await self.sock.serve_forever()
+        if self.stats_interval > 0 and isinstance(self.ssl_context, SessionContext):
+            asyncio.create_task(self.report(self.stats_interval))
+
+        if self.scheduler:
+            asyncio.create_task(self.scheduler.run())
+
+        self.closed = asyncio.Event()
+        if self.sockets:
+            # Continue to listen on the sockets inherited from the previous process
+            _logger.info(
+                f"Starting log server on {len(self.sockets)} inherited sockets"
+            )
+            self.servers = [await self._start_server(sock) for sock in self.sockets]
+        else:
+            _logger.info(f"Starting log server on {self.host}:{self.port}")
+            self.servers = [
+                await asyncio.start_server(
+                    self._accept,
+                    self.host,
+                    self.port,
+                    ssl=self.ssl_context,
+                )
+            ]
+
+        inherited = any(sock.family == socket.AF_UNIX for sock in self.sockets or ())
+        if self.unix_path and not inherited:
+            _logger.info(f"Starting log server on {self.unix_path}")
+            sock = utils.unix_socket(self.unix_path, self.unix_mode)
+            self.servers.append(await self._start_server(sock))
+
+        if self.http_address:
+            host, port = self.http_address
+            _logger.info(f"Starting HTTP listener on {host}:{port}")
+            self.listeners.append(
+                await asyncio.start_server(
+                    lambda reader, writer: self._accept(
+                        reader, writer, self._serve_http
+                    ),
+                    host or None,
+                    port,
+                    ssl=self.ssl_context,
+                    reuse_port=hasattr(socket, "SO_REUSEPORT"),
+                )
+            )
+
+        if self.udp_address:
+            host, port = self.udp_address
+            _logger.info(f"Starting UDP listener on {host}:{port}")
+            await self._listen_datagrams(self.udp_address, self._receive_datagram)
+
+        if self.syslog_address:
+            host, port = self.syslog_address
+            _logger.info(f"Starting syslog listener on {host}:{port}")
+            await self._listen_datagrams(self.syslog_address, self._receive_syslog)
+            self.listeners.append(
+                await asyncio.start_server(
+                    lambda reader, writer: self._accept(
+                        reader, writer, self._serve_syslog
+                    ),
+                    host or None,
+                    port,
+                    limit=max(self.max_frame_size, 1 << 16),
+                    reuse_port=hasattr(socket, "SO_REUSEPORT"),
+                )
+            )
+
+        # Let the previous process shut down once everything is listening
+        if self.ready_fd is not None:
+            utils.notify_ready(self.ready_fd)
+            self.ready_fd = None
+
+        await self.closed.wait()
+
+    async def _start_server(self, sock: socket.socket) -> asyncio.AbstractServer:
+        """Start to serve the clients on the socket. Unix sockets use the peer
+        credentials instead of TLS and tokens"""
+        if sock.family == socket.AF_UNIX:
+            return await asyncio.start_unix_server(
+                lambda reader, writer: self._accept(reader, writer, self._serve_unix),
+                sock=sock,
+            )
+        return await asyncio.start_server(self._accept, sock=sock, ssl=self.ssl_context)
+
+    async def _listen_datagrams(
+        self, address: Tuple[str, int], callback: Callable[[bytes, tuple], None]
+    ) -> None:
+        """Receive datagrams on the address. The port is reused to allow an upgraded
+        process to listen before the old one stopped"""
+        host, port = address
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(callback),
+            # Datagram endpoints need an explicit address to listen on all IPs
+            local_addr=(host or "0.0.0.0", port),
+            reuse_port=hasattr(socket, "SO_REUSEPORT"),
+        )
+        self.listeners.append(transport)
 
     def start(self) -> None:
         """Start the log server as asyncio task"""
         asyncio.run(self.run())
 
     async def stop(self) -> None:
-        """Stop the LogServer and close the socket"""
-        self.sock.close()
-        await self.sock.wait_closed()
+        """Stop the LogServer and close the sockets"""
+        for listener in self.listeners:
+            listener.close()
+
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+        if self.closed:
+            self.closed.set()
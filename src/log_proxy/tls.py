@@ -0,0 +1,81 @@
+import ssl
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Union
+
+SSLConnection = Union[ssl.SSLObject, ssl.SSLSocket]
+
+# Port of the server which is connected in the current context
+_server_port = ContextVar("server_port", default=None)
+
+
+@contextmanager
+def server_port(port: int) -> Iterator[None]:
+    """Set the port of the server connected within the block. The wrapping doesn't
+    get the port passed while the sessions are kept per host and port"""
+    token = _server_port.set(port)
+    try:
+        yield
+    finally:
+        _server_port.reset(token)
+
+
+class SessionContext(ssl.SSLContext):
+    """SSL context which counts the handshakes and how many of them resumed a
+    previous session. On the client side the last session of every server is kept
+    and offered again on reconnects to skip the full handshake. Servers are told
+    apart by the host name and the port"""
+
+    def __new__(cls, protocol: int = ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        return super().__new__(cls, protocol, *args, **kwargs)
+
+    def __init__(self, protocol: int = ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}
+        self.handshakes = self.resumed = 0
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and not kwargs.get("server_side"):
+            session = self.sessions.get((server_hostname, _server_port.get()))
+
+        return super().wrap_socket(
+            sock, *args, server_hostname=server_hostname, session=session, **kwargs
+        )
+
+    def wrap_bio(self, *args, server_hostname=None, session=None, **kwargs):
+        # asyncio wraps the connections with the BIO interface
+        if session is None and not kwargs.get("server_side"):
+            session = self.sessions.get((server_hostname, _server_port.get()))
+
+        return super().wrap_bio(
+            *args, server_hostname=server_hostname, session=session, **kwargs
+        )
+
+    def handshake(self, connection: SSLConnection, port: int = None) -> bool:
+        """Count the finished handshake of the connection and return if its session
+        could be kept"""
+        self.handshakes += 1
+        if connection.session_reused:
+            self.resumed += 1
+        return self.save(connection, port)
+
+    def save(self, connection: SSLConnection, port: int = None) -> bool:
+        """Keep the session of the connection if it can be resumed. With TLS 1.3 the
+        ticket arrives after the handshake which requires to save it again later"""
+        if connection.server_side:
+            return False
+
+        session = connection.session
+        if session is None or not (session.has_ticket or session.id):
+            return False
+
+        self.sessions[connection.server_hostname, port] = session
+        return True
+
+    def stats(self) -> dict:
+        """Return the number of handshakes and the ratio of the resumed ones"""
+        return {
+            "handshakes": self.handshakes,
+            "resumed": self.resumed,
+            "resumed_ratio": self.resumed / self.handshakes if self.handshakes else 0,
+        }
@@ -3,14 +3,25 @@ import asyncio
 import logging
 import os
 import re
+import socket
 import ssl
+import stat
 import struct
 import sys
 from argparse import ArgumentParser, Namespace
-from typing import Any, List, Tuple, Union
+from datetime import datetime
+from typing import Any, Iterable, List, Set, Tuple, Union
 from urllib.parse import urlsplit
 
+from . import base
+from .forwarders import Forwarder
 from .handlers import JSONSocketHandler
+from .tls import SessionContext
+
+try:
+    import pwd
+except ImportError:
+    pwd = None
 
 _logger = logging.getLogger()
 
@@ -59,12 +70,14 @@ def generate_ssl_context(
     server: bool = False,
     ciphers: List[str] = None,
     check_hostname: bool = False,
+    tickets: int = None,
 ) -> ssl.SSLContext:
-    """Generate a SSL context for the tunnel"""
+    """Generate a SSL context for the tunnel. Clients resume the sessions on
+    reconnects and servers issue the given number of TLS 1.3 session tickets"""
 
     # Set the protocol and create the basic context
     proto = ssl.PROTOCOL_TLS_SERVER if server else ssl.PROTOCOL_TLS_CLIENT
-    ctx = ssl.SSLContext(proto)
+    ctx = SessionContext(proto)
 
     ctx.check_hostname = check_hostname
     ctx.minimum_version = ssl.TLSVersion.TLSv1_2
@@ -73,6 +86,10 @@ def generate_ssl_context(
     if server:
         ctx.options |= ssl.OP_SINGLE_DH_USE | ssl.OP_SINGLE_ECDH_USE
 
+        # Tickets allow the clients to resume the session without full handshake
+        if tickets is not None:
+            ctx.num_tickets = tickets
+
     # Load a certificate and key for the connection
     if cert:
         ctx.load_cert_chain(cert, keyfile=key)
@@ -156,23 +173,177 @@ def parse_address(
     raise argparse.ArgumentTypeError("Invalid address parsed. Host required.")
 
 
+def inherited_sockets() -> List[socket.socket]:
+    """Return the listening sockets passed by the previous process. The variable
+    is removed to not pass them further"""
+    fds = os.environ.pop(base.LISTEN_FDS_ENV, None)
+    if not fds:
+        return None
+    return [socket.socket(fileno=int(fd)) for fd in fds.split(",")]
+
+
+def inherited_ready_fd() -> int:
+    """Return the pipe to confirm the readiness to the previous process. The
+    variable is removed to not pass it further"""
+    fd = os.environ.pop(base.READY_FD_ENV, None)
+    return int(fd) if fd else None
+
+
+def notify_ready(fd: int) -> None:
+    """Confirm the readiness on the pipe and close it"""
+    try:
+        os.write(fd, b"1")
+    finally:
+        os.close(fd)
+
+
+async def wait_ready(fd: int) -> bool:
+    """Wait for the confirmation on the pipe and close it. The pipe is closed
+    without confirmation if the other process exits first"""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+
+    def read() -> None:
+        if not ready.done():
+            ready.set_result(os.read(fd, 1) == b"1")
+
+    loop.add_reader(fd, read)
+    try:
+        return await ready
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+def parse_users(users: str) -> Set[int]:
+    """Parse a comma separated list of user names or ids into the user ids"""
+    uids = set()
+    for user in filter(None, map(str.strip, users.split(","))):
+        if user.isdigit():
+            uids.add(int(user))
+            continue
+
+        try:
+            uids.add(pwd.getpwnam(user).pw_uid)
+        except (AttributeError, KeyError) as e:
+            raise argparse.ArgumentTypeError(f"Unknown user {user}.") from e
+    return uids
+
+
+def user_name(uid: int) -> str:
+    """Return the name of the user or the id if it's unknown"""
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (AttributeError, KeyError):
+        return str(uid)
+
+
+def peer_credentials(sock: socket.socket) -> Tuple[int, int, int]:
+    """Return the pid, uid and gid of the process connected to the Unix socket"""
+    size = struct.calcsize("3i")
+    return struct.unpack(
+        "3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, size)
+    )
+
+
+def unix_socket(path: str, mode: int) -> socket.socket:
+    """Bind a Unix socket to the path. Stale sockets are replaced and the
+    permissions are set before the socket starts to listen"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def parse_addresses(
+    addresses: str, host: str = None, port: int = None
+) -> List[Tuple[str, int]]:
+    """Parse a comma separated list of addresses with one host each"""
+    return [
+        parse_address(address.strip(), host=host, port=port)
+        for address in addresses.split(",")
+    ]
+
+
 async def receive_struct(reader: asyncio.StreamReader, fmt: str) -> Tuple[Any]:
     size = struct.calcsize(fmt)
     return struct.unpack(fmt, await reader.readexactly(size))
 
 
-async def stdin_to_log() -> None:
-    """Use the stdin and pass it to the logger"""
+def lines_to_messages(lines: Iterable[str], created_by: str) -> List[dict]:
+    """Convert the non-empty lines into INFO messages"""
+    created_at = datetime.now().isoformat(" ")
+    pid = os.getpid()
+    return [
+        {
+            "level": logging.INFO,
+            "pid": pid,
+            "created_at": created_at,
+            "created_by": created_by,
+            "message": line,
+        }
+        for line in map(str.strip, lines)
+        if line
+    ]
+
+
+async def stdin_to_forwarder(
+    forwarder: Forwarder,
+    *,
+    chunk_size: int = 1 << 16,
+    block: bool = True,
+) -> None:
+    """Read the stdin in large chunks and pass the full lines in batches to the
+    forwarder. If the queue of the forwarder is full the reading either waits
+    or the forwarder drops messages"""
     loop = asyncio.get_event_loop()
     reader = asyncio.StreamReader()
     protocol = asyncio.StreamReaderProtocol(reader)
     await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+
+    pending = b""
     while True:
-        line = await reader.readline()
-        if not line:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            # Send the last line even without line break
+            data, pending = pending, b""
+        else:
+            data = pending + chunk
+            end = data.rfind(b"\n") + 1
+            data, pending = data[:end], data[end:]
+
+        messages = lines_to_messages(data.decode(errors="replace").split("\n"), "stdin")
+        if block:
+            for message in messages:
+                await forwarder.put_wait(message)
+        else:
+            forwarder.put_many(messages)
+
+        if not chunk:
             return
 
-        _logger.info(line.decode().strip())
+
+def positive_float(value: str) -> float:
+    """Convert the value into a positive float otherwise raise an error. This
+    function is used for the argument parsing"""
+    try:
+        result = float(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError("Not a number.") from e
+
+    if result <= 0:
+        raise argparse.ArgumentTypeError("Must be positive.")
+    return result
 
 
 def valid_file(path: str) -> str:
@@ -1,90 +1,620 @@
 import asyncio
+import heapq
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
-from watchdog.events import FileModifiedEvent, PatternMatchingEventHandler
+from watchdog.events import (
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+    FileSystemEventHandler,
+    PatternMatchingEventHandler,
+)
 from watchdog.observers import Observer
 from watchdog.utils.patterns import match_any_paths
 
+from . import utils
+from .forwarders import Forwarder
+from .parsers import LineParser
+
+_logger = logging.getLogger(__name__)
+
+MIN_POLL_INTERVAL = 0.01
+
 
 class WatcherHandler(PatternMatchingEventHandler):
     """Watcher class to observe changes in all specified files in the folder"""
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        checkpoint: str = None,
+        forwarder: Forwarder = None,
+        loop: asyncio.AbstractEventLoop = None,
+        chunk_size: int = 1 << 16,
+        parsers: List[LineParser] = None,
+        debounce: float = 0,
+        workers: int = None,
+        cache_size: int = 1 << 16,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
+        self.debounce = debounce
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.cache_size = cache_size
+        self.matches = {}
+        self.modified = {}
+        self.events = []
+        self.parsers = parsers or []
+        self.path_parsers = {}
+        self.lock = threading.Lock()
+        self.forwarder = forwarder
+        self.loop = loop
+        self.chunk_size = chunk_size
         self.observed = {}
+        self.inodes = {}
+        self.checkpoint = checkpoint
+        self.checkpoints = {}
+        self.dirty = False
 
     def match_file(self, path):
-        """Check if the path matches the patterns and folder"""
-        return match_any_paths(
-            [path],
-            included_patterns=self.patterns,
-            excluded_patterns=self.ignore_patterns,
-            case_sensitive=self.case_sensitive,
-        )
+        """Check if the path matches the patterns and folder. The results are
+        cached because the pattern matching is expensive"""
+        result = self.matches.get(path)
+        if result is None:
+            if len(self.matches) >= self.cache_size:
+                self.matches.clear()
+
+            result = self.matches[path] = match_any_paths(
+                [path],
+                included_patterns=self.patterns,
+                excluded_patterns=self.ignore_patterns,
+                case_sensitive=self.case_sensitive,
+            )
+        return result
+
+    def dispatch(self, event):
+        """Dispatch the event if one of the paths matches using the cache"""
+        if self.ignore_directories and event.is_directory:
+            return
+
+        paths = (event.src_path, getattr(event, "dest_path", None))
+        if any(self.match_file(os.fsdecode(p)) for p in paths if p):
+            FileSystemEventHandler.dispatch(self, event)
 
     def get_size(self, path):
         return self.observed.get(path, 0)
 
     def set_size(self, path, size):
+        if self.observed.get(path) != size:
+            self.dirty = True
         self.observed[path] = size
 
+    def load_checkpoint(self):
+        """Load the offsets and inodes of the files from the checkpoint file"""
+        if not self.checkpoint or not os.path.isfile(self.checkpoint):
+            return
+
+        try:
+            with open(self.checkpoint) as fp:
+                self.checkpoints = {
+                    path: tuple(value) for path, value in json.load(fp).items()
+                }
+        except (OSError, ValueError, TypeError) as e:
+            _logger.warning(f"Invalid checkpoint file {self.checkpoint}: {e}")
+
+    def save_checkpoint(self):
+        """Write the inodes and offsets of the files to the checkpoint file if
+        anything changed"""
+        if not self.checkpoint or not self.dirty:
+            return
+
+        self.dirty = False
+        observed = dict(self.observed)
+        data = {
+            path: [self.inodes.get(path), offset] for path, offset in observed.items()
+        }
+
+        # Replace the file atomically to never leave a broken checkpoint
+        tmp = f"{self.checkpoint}.tmp"
+        try:
+            with open(tmp, "w") as fp:
+                json.dump(data, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, self.checkpoint)
+        except OSError as e:
+            _logger.error(f"Can't write checkpoint: {e}")
+            self.dirty = True
+
+    def _find_inode(self, directory, inode):
+        """Find the file with the inode in the directory. This is used to find
+        rotated files"""
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.inode() == inode:
+                        return entry.path
+        except OSError:
+            pass
+        return None
+
+    def register(self, path, stat=None):
+        """Register a file with the offset from the checkpoint. If no checkpoint
+        exists the file is read from the current end"""
+        stat = stat or os.stat(path)
+        self.inodes[path] = stat.st_ino
+
+        inode, offset = self.checkpoints.pop(path, (None, None))
+        if offset is None:
+            self.set_size(path, stat.st_size)
+            return
+
+        if inode != stat.st_ino:
+            # The file was rotated while the watcher was down. Finish the old file
+            # if it can still be found and continue with the new one
+            rotated = self._find_inode(os.path.dirname(path), inode)
+            if rotated:
+                self.read_lines(path, rotated, offset)
+            offset = 0
+        elif offset > stat.st_size:
+            # The file was truncated
+            offset = 0
+
+        self.set_size(path, offset)
+        self.read_changes(path)
+
     def read_initial_size(self, path):
-        """Read the initial size of the file to not send the entire file on start"""
+        """Read the initial size of the file to not send the entire file on start.
+        If a checkpoint is available the reading continues from there.
+
+        All files are registered eagerly. Registering a file on its first event
+        would take the size after the write and lose the lines which triggered
+        the event. The stat of the scan is needed for the initial offset anyway"""
+        self.load_checkpoint()
+
         if os.path.isfile(path):
             if self.match_file(path):
-                self.observed[path] = os.path.getsize(path)
+                self.register(path)
             return
 
-        for dirname, _, files in os.walk(path):
-            for file in files:
-                path = os.path.join(dirname, file)
-                if self.match_file(path):
-                    self.observed[path] = os.path.getsize(path)
+        # Scan the sub directories in parallel
+        files, directories = self.scan(path, recursive=False)
+        if len(directories) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                for result, _ in executor.map(self.scan, directories):
+                    files.extend(result)
+        else:
+            for directory in directories:
+                files.extend(self.scan(directory)[0])
 
-    def on_new_line(self, path, line):
-        """Send the line to the logging"""
-        logging.getLogger(path).info(line)
+        for file, stat in files:
+            self.register(file, stat)
 
-    def on_modified(self, event):
-        """React on modified files and append the new lines"""
-        if not isinstance(event, FileModifiedEvent):
+    def scan(self, path, recursive=True):
+        """Scan the directory using scandir and return the matching files with
+        their stat and the sub directories"""
+        files, directories = [], []
+        stack = [path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif entry.is_file() and self.match_file(entry.path):
+                            files.append((entry.path, entry.stat()))
+            except OSError as e:
+                _logger.warning(f"Can't scan directory: {e}")
+
+            if recursive:
+                stack.extend(directories)
+                directories = []
+        return files, directories
+
+    def get_parser(self, path):
+        """Return the first parser matching the path"""
+        if path not in self.path_parsers:
+            if len(self.path_parsers) >= self.cache_size:
+                self.path_parsers.clear()
+
+            parsers = (p for p in self.parsers if p.match(path))
+            self.path_parsers[path] = next(parsers, None)
+        return self.path_parsers[path]
+
+    def flush_parsers(self, path=None, max_age=0):
+        """Send the pending multi-line records of the parsers"""
+        for parser in self.parsers:
+            with self.lock:
+                messages = parser.flush(path, max_age=max_age)
+            if messages:
+                self.send(messages)
+
+    def on_new_text(self, path, text):
+        """Parse the text with full lines and send the messages"""
+        parser = self.get_parser(path)
+        if parser is None:
+            lines = [line for line in map(str.strip, text.split("\n")) if line]
+            if lines:
+                self.on_new_lines(path, lines)
             return
 
-        size = os.path.getsize(event.src_path)
+        with self.lock:
+            messages = parser.feed(path, text)
+        if messages:
+            self.send(messages)
 
-        # Get the already observed lines
-        current = self.get_size(event.src_path)
-        if current >= size:
-            self.set_size(event.src_path, size)
+    def on_new_lines(self, path, lines):
+        """Pass the lines as messages to the forwarder"""
+        self.send(utils.lines_to_messages(lines, path))
+
+    def send(self, messages):
+        """Pass the messages to the forwarder"""
+        if not self.forwarder:
             return
 
-        # Open the file and seek to the last position
-        with open(event.src_path) as fp:
+        # The observer runs in its own thread and the queue of the forwarder
+        # belongs to the event loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if self.loop is None or running is self.loop:
+            self.forwarder.put_many(messages)
+        else:
+            self.loop.call_soon_threadsafe(self.forwarder.put_many, messages)
+
+    def read_lines(self, path, filename, current):
+        """Read the full lines from the file starting at the offset and return the
+        new offset. The lines are send in the name of path"""
+        with open(filename, "rb") as fp:
             fp.seek(current)
 
-            # Read line by line and only use full lines
-            for line in fp:
-                stripped = line.strip()
-                if line.endswith("\n") and stripped:
-                    current += len(line)
-                    self.on_new_line(event.src_path, stripped)
+            # Read large chunks and only use full lines
+            pending = b""
+            while True:
+                chunk = fp.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                data = pending + chunk
+                end = data.rfind(b"\n") + 1
+                pending = data[end:]
+                if not end:
+                    continue
+
+                current += end
+                self.on_new_text(path, data[:end].decode(errors="replace"))
+        return current
+
+    def read_changes(self, path):
+        """Read the new lines of the file and detect truncated or replaced files"""
+        stat = os.stat(path)
+        size = stat.st_size
+
+        # Get the already observed lines
+        current = self.get_size(path)
+
+        # A new inode means that the file got replaced. Finish the old file if it
+        # was renamed within the directory and start again
+        inode = self.inodes.get(path, stat.st_ino)
+        if inode != stat.st_ino:
+            rotated = self._find_inode(os.path.dirname(path), inode)
+            if rotated:
+                offset = self.read_lines(path, rotated, current)
+
+                # Keep the offset if the rotated file is watched as well
+                if self.match_file(rotated):
+                    self.inodes[rotated] = inode
+                    self.set_size(rotated, offset)
+            current = 0
+        self.inodes[path] = stat.st_ino
+
+        # The file was truncated. Start again
+        if current > size:
+            current = 0
+
+        if current >= size:
+            self.set_size(path, size)
+            return
 
         # Update the position
-        self.set_size(event.src_path, current)
+        self.set_size(path, self.read_lines(path, path, current))
+
+    def rename(self, src, dest):
+        """Carry the offset of a renamed file over to the new path. The source
+        path is read from the start because a new file will appear there"""
+        inode = self.inodes.pop(src, None)
+        if inode is not None:
+            self.inodes[dest] = inode
+        self.set_size(dest, self.observed.get(src, 0))
+        self.set_size(src, 0)
 
+    def forget(self, path):
+        """Stop tracking a file which doesn't exist anymore"""
+        with self.lock:
+            self.modified.pop(path, None)
 
-async def watch(path, **kwargs):
-    """Watch on files of in a directory and log new lines"""
-    handler = WatcherHandler(**kwargs)
-    handler.read_initial_size(path)
-    observer = Observer()
+        self.inodes.pop(path, None)
+        if self.observed.pop(path, None) is not None:
+            self.dirty = True
+        self.flush_parsers(path)
+
+    def on_modified(self, event):
+        """React on modified files and append the new lines. If debouncing is
+        enabled bursts of events are collected and the file is read once"""
+        if not isinstance(event, FileModifiedEvent):
+            return
+
+        if self.debounce > 0:
+            with self.lock:
+                self.modified.setdefault(event.src_path, time.monotonic())
+            return
+
+        self.read_changes(event.src_path)
+
+    def defer(self, func, *args):
+        """Run the function in the reader of the files. With debouncing this is
+        process_modified otherwise it's the thread of the observer"""
+        if self.debounce <= 0:
+            func(*args)
+            return
+
+        with self.lock:
+            self.events.append((func, args))
+
+    def process_modified(self):
+        """Handle the deferred events and read the files which were modified at
+        least debounce seconds ago"""
+        with self.lock:
+            events, self.events = self.events, []
+
+        for func, args in events:
+            try:
+                func(*args)
+            except OSError as e:
+                _logger.warning(f"Can't handle event: {e}")
+
+        deadline = time.monotonic() - self.debounce
+        with self.lock:
+            paths = [p for p, ts in self.modified.items() if ts <= deadline]
+            for path in paths:
+                self.modified.pop(path)
+
+        for path in paths:
+            try:
+                self.read_changes(path)
+            except OSError as e:
+                _logger.warning(f"Can't read file: {e}")
+
+    def on_created(self, event):
+        if isinstance(event, FileCreatedEvent):
+            self.defer(self.created, event.src_path)
+
+    def on_moved(self, event):
+        if isinstance(event, FileMovedEvent):
+            self.defer(self.moved, event.src_path, event.dest_path)
+
+    def on_deleted(self, event):
+        if isinstance(event, FileDeletedEvent):
+            self.defer(self.forget, event.src_path)
+
+    def created(self, path):
+        """New files are read from the beginning"""
+        self.inodes.pop(path, None)
+        self.set_size(path, 0)
+
+    def moved(self, src, dest):
+        """Finish reading rotated files before switching to the new file"""
+        if src not in self.observed:
+            return
+
+        offset = self.observed.pop(src)
+        inode = self.inodes.pop(src, None)
+        self.dirty = True
+
+        try:
+            offset = self.read_lines(src, dest, offset)
+        except OSError:
+            return
+        finally:
+            self.flush_parsers(src)
+
+        # Continue to watch the rotated file if it matches
+        if self.match_file(dest):
+            self.inodes[dest] = inode
+            self.set_size(dest, offset)
+
+
+class PollingObserver(threading.Thread):
+    """Observer for filesystems without inotify support which polls the files on
+    an adaptive schedule. Changed files are polled every min_interval seconds
+    while the interval of idle files doubles up to max_interval. Only the files
+    which are due get stat'ed and new files are found by checking the modification
+    time of the known directories"""
+
+    def __init__(self, min_interval=0.5, max_interval=10, scan_interval=5):
+        super().__init__(daemon=True)
+        self.min_interval = max(min_interval, MIN_POLL_INTERVAL)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.scan_interval = scan_interval
+        self.handler = self.path = None
+        self.stopped = threading.Event()
+        self.schedules = []
+        self.intervals = {}
+        self.stats = {}
+        self.directories = {}
+
+    def schedule(self, handler, path, recursive=True):
+        """Define the handler and path to watch"""
+        self.handler, self.path = handler, path
+
+    def stop(self):
+        self.stopped.set()
+
+    def add(self, path, due=None):
+        """Add a file to the schedule"""
+        if path not in self.intervals:
+            self.intervals[path] = self.min_interval
+            heapq.heappush(self.schedules, (due or time.monotonic(), path))
+
+    def scan_directory(self, directory):
+        """List a directory and add new files and sub directories"""
+        try:
+            self.directories[directory] = os.stat(directory).st_mtime_ns
+            files, directories = self.handler.scan(directory, recursive=False)
+        except OSError:
+            self.directories.pop(directory, None)
+            return
+
+        inodes = None
+        for path, stat in files:
+            if path not in self.handler.observed:
+                if inodes is None:
+                    inodes = {ino: p for p, ino in self.handler.inodes.items()}
+
+                # Renamed files keep their offset while new files are read from
+                # the beginning
+                src = inodes.get(stat.st_ino)
+                if src and src != path and self._moved(src, stat.st_ino):
+                    self.handler.rename(src, path)
+                else:
+                    self.handler.set_size(path, 0)
+            self.add(path)
+
+        for sub in directories:
+            if sub not in self.directories:
+                self.scan_directory(sub)
+
+    def _moved(self, path, inode):
+        """Check if the file with the inode isn't at the path anymore"""
+        try:
+            return os.stat(path).st_ino != inode
+        except OSError:
+            return True
+
+    def scan(self):
+        """Scan the directories which changed since the last scan"""
+        for directory, mtime in list(self.directories.items()):
+            try:
+                changed = os.stat(directory).st_mtime_ns != mtime
+            except OSError:
+                self.directories.pop(directory, None)
+                continue
+
+            if changed:
+                self.scan_directory(directory)
+
+    def poll(self):
+        """Stat the files which are due and read the changed ones"""
+        now = time.monotonic()
+        due = []
+        while self.schedules and self.schedules[0][0] <= now:
+            due.append(heapq.heappop(self.schedules)[1])
+
+        for path in due:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.intervals.pop(path, None)
+                self.stats.pop(path, None)
+                self.handler.forget(path)
+                continue
+
+            key = stat.st_ino, stat.st_size, stat.st_mtime_ns
+            if self.stats.get(path) != key:
+                self.stats[path] = key
+                self.intervals[path] = self.min_interval
+                try:
+                    self.handler.read_changes(path)
+                except OSError as e:
+                    _logger.warning(f"Can't read file: {e}")
+            else:
+                interval = self.intervals[path] * 2
+                self.intervals[path] = min(interval, self.max_interval)
+
+            heapq.heappush(self.schedules, (now + self.intervals[path], path))
+
+    def run(self):
+        if os.path.isfile(self.path):
+            self.add(self.path)
+        else:
+            self.scan_directory(self.path)
+
+        scanned = time.monotonic()
+        while not self.stopped.is_set():
+            self.poll()
+
+            if time.monotonic() - scanned >= self.scan_interval:
+                self.scan()
+                scanned = time.monotonic()
+
+            timeout = self.scan_interval
+            if self.schedules:
+                timeout = min(timeout, self.schedules[0][0] - time.monotonic())
+            self.stopped.wait(max(timeout, 0.01))
+
+
+async def watch(
+    path,
+    forwarder,
+    checkpoint=None,
+    checkpoint_interval=5,
+    flush_interval=1,
+    debounce=0.05,
+    backend="native",
+    poll_interval=0.5,
+    poll_max_interval=10,
+    **kwargs,
+):
+    """Watch on files of in a directory and pass new lines to the forwarder.
+    Multi-line records are send after flush_interval seconds without new lines.
+    The native backend uses the watchdog observer while the poll backend polls
+    the files on an adaptive schedule"""
+    loop = asyncio.get_running_loop()
+    handler = WatcherHandler(
+        checkpoint=checkpoint,
+        forwarder=forwarder,
+        loop=loop,
+        debounce=debounce,
+        **kwargs,
+    )
+
+    # Scanning and reading the files is blocking and shouldn't stall the loop
+    start = time.monotonic()
+    await loop.run_in_executor(None, handler.read_initial_size, path)
+    _logger.info(
+        f"Registered {len(handler.observed)} files in "
+        f"{time.monotonic() - start:.2f} seconds"
+    )
+
+    if backend == "poll":
+        observer = PollingObserver(poll_interval, poll_max_interval)
+    else:
+        observer = Observer()
     observer.schedule(handler, path=path, recursive=True)
     observer.start()
 
     try:
+        flushed = time.monotonic()
         while observer.is_alive():
-            await asyncio.sleep(0.1)
+            await asyncio.sleep(min(debounce, 0.1) if debounce > 0 else 0.1)
+            if handler.modified:
+                await loop.run_in_executor(None, handler.process_modified)
+            handler.flush_parsers(max_age=flush_interval)
+
+            if time.monotonic() - flushed >= checkpoint_interval:
+                handler.save_checkpoint()
+                flushed = time.monotonic()
     finally:
         observer.stop()
         observer.join()
+        handler.flush_parsers()
+        handler.save_checkpoint()
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import json
+import logging
+from unittest.mock import AsyncMock
+
+import pytest
+
+from log_proxy import LogServer
+from log_proxy.bench import Benchmark, parse_distribution, parse_level, percentile
+from log_proxy.forwarders import Forwarder
+
+
+def test_parse_distribution():
+    assert parse_distribution("100:8, 1000:2", int) == ([100, 1000], [8.0, 2.0])
+    assert parse_distribution("info,ERROR:0.5,5", parse_level) == (
+        [logging.INFO, logging.ERROR, 5],
+        [1.0, 0.5, 1.0],
+    )
+
+    for value in ("", "x", "100:x", "100:-1", "100:0", "unknown"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_distribution(value, parse_level if value == "unknown" else int)
+
+
+def test_percentile():
+    values = list(range(100))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile(values, 1.0) == 99
+    assert percentile([], 0.5) == 0
+
+
+def test_bench_frames():
+    with pytest.raises(ValueError):
+        Benchmark("127.0.0.1", 0, framing="unknown")
+
+    bench = Benchmark(
+        "127.0.0.1", 0, sizes=([10], [1]), levels=([logging.WARNING], [1])
+    )
+    frame = bench._raw_frame()
+    message = json.loads(frame[4:])
+    assert message["message"] == "x" * 10
+    assert message["level"] == logging.WARNING
+
+    bench.framing = "handler"
+    message = json.loads(bench.frame()[4:])
+    assert message["created_by"] == "bench"
+    assert message["level"] == logging.WARNING
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("framing", ["raw", "handler"])
+async def test_bench(unused_tcp_port, framing):
+    forwarder = Forwarder()
+    forwarder.process = AsyncMock()
+    server = LogServer("127.0.0.1", unused_tcp_port, forwarder)
+    server.add_token("abc")
+    task = asyncio.create_task(server.run())
+    await asyncio.sleep(0.1)
+
+    bench = Benchmark(
+        "127.0.0.1",
+        unused_tcp_port,
+        connections=2,
+        rate=200,
+        duration=0.5,
+        framing=framing,
+        token="abc",
+    )
+    report = await bench.run()
+    await asyncio.sleep(0.1)
+
+    # The rate is kept and every record arrived
+    assert 80 <= report["sent"] <= 110
+    assert forwarder.queue.qsize() == report["sent"]
+    assert not report["errors"]
+    assert 0 <= report["latency"]["p50"] <= report["latency"]["max"]
+
+    await server.stop()
+    await asyncio.wait_for(task, 1)
+
+
+@pytest.mark.asyncio
+async def test_bench_errors(unused_tcp_port):
+    bench = Benchmark("127.0.0.1", unused_tcp_port, duration=0.3)
+    report = await bench.run()
+    assert report["sent"] == 0
+    assert report["errors"]["ConnectionRefusedError"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_bench_timeout(unused_tcp_port):
+    async def stall(reader, writer):
+        await asyncio.sleep(5)
+
+    # The benchmark ends at the deadline even if the server stops reading
+    server = await asyncio.start_server(stall, "127.0.0.1", unused_tcp_port)
+    bench = Benchmark(
+        "127.0.0.1", unused_tcp_port, duration=0.3, sizes=([100000], [1.0])
+    )
+    report = await asyncio.wait_for(bench.run(), 2)
+    assert report["errors"]["TimeoutError"] >= 1
+
+    server.close()
+    await server.wait_closed()
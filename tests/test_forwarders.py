@@ -1,11 +1,19 @@
 import asyncio
+import gzip
+import json
+import logging
+import os
 import socket
+import sqlite3
+import struct
 from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
 from log_proxy import forwarders
+from log_proxy.forwarders.base import RawMessage
+from log_proxy.tls import SessionContext
 
 
 @pytest.mark.asyncio
@@ -40,12 +48,265 @@ async def test_forwarder_base():
     forwarder.process_message.assert_called_once_with({"a": 42})
 
 
+@pytest.mark.asyncio
+async def test_forwarder_requeue():
+    forwarder = forwarders.Forwarder()
+    forwarder.put_many({"created_at": i} for i in range(2))
+    forwarder.process_messages = AsyncMock(side_effect=[ConnectionError(), OSError()])
+    forwarder.invalidate = MagicMock(side_effect=[None, AssertionError()])
+
+    # The failed batch is queued again and sent with the next attempt
+    with patch("asyncio.sleep", AsyncMock()), pytest.raises(AssertionError):
+        await forwarder.process()
+
+    batches = [c.args[0] for c in forwarder.process_messages.call_args_list]
+    assert batches == [[{"created_at": 0}, {"created_at": 1}]] * 2
+    assert forwarder.empty()
+
+
+@pytest.mark.asyncio
+async def test_forwarder_batch():
+    forwarder = forwarders.Forwarder(batch_size=2)
+    forwarder.put_many({"created_at": i} for i in range(3))
+
+    assert await forwarder.get_batch() == [{"created_at": 0}, {"created_at": 1}]
+    assert await forwarder.get_batch() == [{"created_at": 2}]
+
+    forwarder.process_message = AsyncMock()
+    await forwarder.process_messages([{"a": 42}, {"a": 43}])
+    assert forwarder.process_message.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_forwarder_dead_letter(tmp_path):
+    dead_letter = tmp_path / "dead.jsonl"
+    forwarder = forwarders.Forwarder(dead_letter=str(dead_letter))
+    forwarder.connected = MagicMock(return_value=True)
+    forwarder.invalidate = MagicMock()
+
+    sent = []
+
+    async def process_message(message):
+        if "level" not in message:
+            raise KeyError("level")
+        sent.append(message)
+
+    forwarder.process_message = process_message
+    forwarder.put_many([{"level": 1}, {"created_at": 2}, {"level": 3}])
+
+    # The invalid message is rejected without reconnecting
+    task = asyncio.create_task(forwarder.process())
+    assert await forwarder.drain(1)
+    task.cancel()
+
+    assert sent == [{"level": 1}, {"level": 3}]
+    forwarder.invalidate.assert_not_called()
+    assert forwarder.stats()["rejected"] == 1
+    with dead_letter.open() as fp:
+        entry = json.loads(fp.read())
+    assert entry == {"error": "KeyError('level')", "message": {"created_at": 2}}
+
+    # Without dead letter file the message is only logged
+    forwarder.dead_letter = None
+    with patch("log_proxy.forwarders.base._logger") as logger:
+        forwarder.reject({}, ValueError())
+        logger.warning.assert_called_once()
+    assert forwarder.rejected == 2
+
+
+@pytest.mark.asyncio
+async def test_forwarder_backoff():
+    forwarder = forwarders.Forwarder()
+    delays = [forwarder.backoff(i) for i in range(1, 20)]
+    assert 0.005 <= delays[0] <= 0.01
+    assert all(d <= forwarder.max_backoff for d in delays)
+    assert delays[-1] >= forwarder.max_backoff / 2
+
+    # Connection errors back off and retry the remaining messages
+    forwarder.put_many([{"a": 1}, {"a": 2}])
+    forwarder.process_message = AsyncMock(side_effect=[None, ConnectionError(), None])
+    with patch("log_proxy.forwarders.base._logger") as logger:
+        task = asyncio.create_task(forwarder.process())
+        assert await forwarder.drain(1)
+        task.cancel()
+
+    logger.warning.assert_called_once()
+    calls = [c.args[0] for c in forwarder.process_message.call_args_list]
+    assert calls == [{"a": 1}, {"a": 2}, {"a": 2}]
+
+
+@pytest.mark.asyncio
+async def test_forwarder_drain():
+    forwarder = forwarders.Forwarder(max_size=1)
+    forwarder.put_many([{"level": logging.DEBUG}, {"level": logging.INFO}])
+    assert not await forwarder.drain(0.01)
+
+    # Evicted messages don't block the draining
+    forwarder.process_messages = AsyncMock()
+    task = asyncio.create_task(forwarder.process())
+    assert await forwarder.drain(1)
+    forwarder.process_messages.assert_called_once_with([{"level": logging.INFO}])
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_forwarder_report():
+    forwarder = forwarders.Forwarder()
+    forwarder.dropped[logging.INFO] = 2
+
+    with patch("log_proxy.forwarders.base._logger") as logger, patch(
+        "asyncio.sleep", AsyncMock(side_effect=[None, None, AssertionError()])
+    ):
+        with pytest.raises(AssertionError):
+            await forwarder.report(1)
+
+    # Only changes of the counters are reported
+    logger.warning.assert_called_once()
+    assert "dropped 2 messages (INFO=2)" in logger.warning.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_forwarder_shedding():
+    forwarder = forwarders.Forwarder(max_size=3)
+    await forwarder.put({"level": logging.ERROR, "created_at": 1})
+    await forwarder.put({"level": logging.DEBUG, "created_at": 2})
+    await forwarder.put({"level": logging.INFO, "created_at": 3})
+
+    # The debug message is evicted first followed by the info message
+    await forwarder.put({"level": logging.CRITICAL, "created_at": 4})
+    await forwarder.put({"level": logging.WARNING, "created_at": 5})
+    assert forwarder.dropped == {logging.DEBUG: 1, logging.INFO: 1}
+
+    # Less important messages are dropped instead of the queued ones
+    await forwarder.put({"level": logging.INFO, "created_at": 6})
+    assert forwarder.dropped == {logging.DEBUG: 1, logging.INFO: 2}
+
+    # The order over all lanes is kept
+    assert [(await forwarder.get())["created_at"] for _ in range(3)] == [1, 4, 5]
+    stats = {"queued": 0, "dropped": forwarder.dropped, "rejected": 0}
+    assert forwarder.stats() == stats
+
+    # Sample the messages with a low level if the queue is filling up
+    forwarder = forwarders.Forwarder(max_size=4, sample_threshold=0.5)
+    for _ in range(2):
+        await forwarder.put({"level": logging.ERROR})
+
+    with patch("random.random", return_value=0.6):
+        await forwarder.put({"level": logging.INFO})
+        assert forwarder.queue.qsize() == 3
+
+        # The chance to keep the message is 0.5 at this fill level
+        await forwarder.put({"level": logging.INFO})
+        assert forwarder.queue.qsize() == 3
+        assert forwarder.dropped == {logging.INFO: 1}
+
+        await forwarder.put({"level": logging.ERROR})
+        assert forwarder.queue.qsize() == 4
+
+
 @pytest.mark.asyncio
 async def test_forwarder_database():
     forwarder = forwarders.DatabaseForwarder(host=None, port=42)
     assert forwarder.args == {"port": 42}
 
 
+@pytest.mark.asyncio
+async def test_forwarder_file(tmp_path):
+    forwarder = forwarders.FileForwarder(
+        str(tmp_path / "segments"), max_bytes=40, fsync_interval=0
+    )
+    assert str(forwarder) == f"<forwarder file:{tmp_path / 'segments'}>"
+    assert not forwarder.connected()
+
+    await forwarder.connect()
+    assert forwarder.connected()
+    first = forwarder.path
+
+    # Batches are appended as JSON lines and synced
+    await forwarder.process_messages([{"a": 1}, {"a": 2}])
+    assert not forwarder.dirty
+    with open(first) as fp:
+        assert fp.read() == '{"a": 1}\n{"a": 2}\n'
+
+    # The segment rotates once it's too large and gets compressed
+    await forwarder.process_message({"a": "x" * 20})
+    assert forwarder.path != first
+    assert forwarder.size == 0
+    await asyncio.gather(*forwarder.tasks)
+    assert not os.path.exists(first)
+    with gzip.open(f"{first}.gz", "rt") as fp:
+        assert len(fp.readlines()) == 3
+
+    # Old segments rotate after the maximum age
+    forwarder.max_age = 0
+    await forwarder.process_message({"a": 3})
+    assert forwarder.size == 0
+
+    forwarder.invalidate()
+    assert not forwarder.connected()
+
+
+@pytest.mark.asyncio
+async def test_forwarder_file_sync(tmp_path):
+    forwarder = forwarders.FileForwarder(str(tmp_path), fsync_interval=0.01)
+    await forwarder.connect()
+    assert forwarder.syncer
+
+    await forwarder.process_messages([{"a": 1}])
+    assert forwarder.dirty
+    await asyncio.sleep(0.05)
+    assert not forwarder.dirty
+
+    # Stopping the processing closes the segment, the syncer and the executor
+    syncer, path = forwarder.syncer, forwarder.path
+    forwarder.put_nowait({"a": 2})
+    task = asyncio.create_task(forwarder.process())
+    await forwarder.drain(1)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    assert syncer.cancelled() and forwarder.syncer is None
+    assert not forwarder.connected()
+    with pytest.raises(RuntimeError):
+        forwarder.executor.submit(print)
+    with open(path) as fp:
+        assert fp.read() == '{"a": 1}\n{"a": 2}\n'
+
+
+@pytest.mark.asyncio
+async def test_forwarder_sqlite(tmp_path):
+    database = str(tmp_path / "logs.db")
+    forwarder = forwarders.SQLiteForwarder(database=database, host=None)
+    assert str(forwarder) == "<forwarder sqlite:logs>"
+    assert not forwarder.connected()
+
+    await forwarder.connect()
+    assert forwarder.connected()
+
+    message = {
+        "level": logging.INFO,
+        "pid": 42,
+        "message": "hello",
+        "created_at": "2022-01-02 10:11:12",
+        "created_by": "app",
+    }
+    await forwarder.process_messages([message, {**message, "host": "a"}])
+    await forwarder.process_message({**message, "lineno": 7})
+
+    # Invalid batches are rolled back completely
+    with pytest.raises(sqlite3.IntegrityError):
+        await forwarder.process_messages([message, {"level": 10}])
+
+    forwarder.invalidate()
+    assert not forwarder.connected()
+
+    connection = sqlite3.connect(database)
+    assert connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    rows = connection.execute('SELECT "host", "lineno" FROM "logs"').fetchall()
+    assert rows == [(None, None), ("a", None), (None, 7)]
+    connection.close()
+
+
 @pytest.mark.asyncio
 async def test_forwarder_mongo():
     forwarder = forwarders.MongoDBForwarder(database="db", host=None, port=42)
@@ -68,6 +329,50 @@ async def test_forwarder_mongo():
         await forwarder.process_message(msg)
         forwarder.client["db"]["logs"].insert_one.assert_called_once_with(msg)
 
+        await forwarder.process_messages([msg, msg])
+        forwarder.client["db"]["logs"].insert_many.assert_called_once_with([msg, msg])
+
+
+@pytest.mark.asyncio
+async def test_forwarder_mongo_timeseries():
+    forwarder = forwarders.MongoDBForwarder(database="db", timeseries=True, ttl=60)
+
+    with patch("log_proxy.forwarders.mongodb.MongoClient") as mock:
+        db = mock.return_value["db"]
+        db.list_collection_names.return_value = []
+        await forwarder.connect()
+
+        db.create_collection.assert_called_once()
+        assert db.create_collection.call_args.kwargs["expireAfterSeconds"] == 60
+        timeseries = db.create_collection.call_args.kwargs["timeseries"]
+        assert timeseries["timeField"] == "created_at"
+        assert db["logs"].create_index.call_count == 3
+
+        # Existing collections aren't created again
+        db.create_collection.reset_mock()
+        db.list_collection_names.return_value = ["logs"]
+        await forwarder.connect()
+        db.create_collection.assert_not_called()
+
+    # The time is converted and the metadata grouped
+    msg = {"message": "hello", "host": "a", "created_at": "2022-01-02 10:11:12"}
+    await forwarder.process_messages([msg])
+    (doc,) = db["logs"].insert_many.call_args.args[0]
+    assert doc["created_at"] == datetime(2022, 1, 2, 10, 11, 12)
+    assert doc["meta"] == {"host": "a", "created_by": None}
+    assert "host" not in doc
+    assert msg["created_at"] == "2022-01-02 10:11:12"
+
+    # Plain collections with TTL only get the index and converted times
+    forwarder = forwarders.MongoDBForwarder(database="db", ttl=60)
+    with patch("log_proxy.forwarders.mongodb.MongoClient") as mock:
+        await forwarder.connect()
+        collection = mock.return_value["db"]["logs"]
+        collection.create_index.assert_called_once_with(
+            "created_at", expireAfterSeconds=60
+        )
+    assert forwarder.convert(msg)["host"] == "a"
+
 
 @pytest.mark.asyncio
 async def test_forwarder_postgres():
@@ -113,6 +418,144 @@ async def test_forwarder_postgres():
         assert len(exc.call_args.args) == 10
 
 
+@pytest.mark.asyncio
+async def test_forwarder_postgres_partitions():
+    with pytest.raises(ValueError):
+        forwarders.PostgresForwarder(database="db", partition="week")
+
+    forwarder = forwarders.PostgresForwarder(
+        database="db", partition="day", retention=2, premake=1
+    )
+    with patch(
+        "log_proxy.forwarders.postgres.pg_connect", new_callable=AsyncMock
+    ) as connect:
+        connect.return_value.fetchval.return_value = None
+        connect.return_value.transaction = MagicMock()
+        await forwarder.connect()
+
+    exc = forwarder.connection.execute
+    queries = [c.args[0] for c in exc.call_args_list]
+    assert "PARTITION BY RANGE" in queries[0]
+    assert any("USING BRIN" in q for q in queries)
+    assert any("logs_default" in q and "DEFAULT" in q for q in queries)
+
+    # The missing partitions are created while the default one is detached
+    now = datetime(2022, 1, 2, 10, 11)
+    forwarder.connection = AsyncMock()
+    forwarder.connection.transaction = MagicMock()
+    forwarder.connection.fetch.return_value = [
+        ("logs_default",),
+        ("logs_p20211230",),
+        ("logs_p20211231",),
+        ("logs_p20220102",),
+    ]
+    await forwarder.maintain_partitions(now)
+    forwarder.connection.transaction.assert_called_once()
+    calls = forwarder.connection.execute.call_args_list
+    queries = [c.args[0] for c in calls]
+    assert queries[0] == 'ALTER TABLE "logs" DETACH PARTITION "logs_default"'
+    assert queries[1] == (
+        'CREATE TABLE IF NOT EXISTS "logs_p20220103" PARTITION OF "logs" '
+        "FOR VALUES FROM ('2022-01-03 00:00:00') TO ('2022-01-04 00:00:00')"
+    )
+    assert 'INSERT INTO "logs_p20220103"' in queries[2]
+    assert calls[2].args[1:] == (datetime(2022, 1, 3), datetime(2022, 1, 4))
+    assert queries[3] == 'ALTER TABLE "logs" ATTACH PARTITION "logs_default" DEFAULT'
+
+    # Partitions older than the retention are dropped
+    assert queries[4:] == ['DROP TABLE IF EXISTS "logs_p20211230"']
+
+    # The partitions are maintained regularly while processing
+    forwarder.connection.reset_mock()
+    await forwarder.process_messages([])
+    forwarder.connection.execute.assert_not_called()
+    forwarder.maintained = None
+    await forwarder.process_messages([])
+    forwarder.connection.execute.assert_called()
+
+    # Failing maintenance doesn't block the inserts and is retried later
+    forwarder.maintained = None
+    forwarder.connection.fetch.side_effect = ValueError("failed")
+    with patch.object(forwarder, "process_message", new_callable=AsyncMock) as proc:
+        await forwarder.process_messages([{"message": "hello"}])
+        proc.assert_awaited_once()
+    assert forwarder.maintained is not None
+    forwarder.connection.fetch.reset_mock()
+    await forwarder.process_messages([])
+    forwarder.connection.fetch.assert_not_called()
+
+    # An existing regular table isn't partitioned
+    forwarder.partition = "day"
+    forwarder.connection = AsyncMock()
+    forwarder.connection.fetchval.return_value = "r"
+    await forwarder.create_partitioned_table()
+    forwarder.connection.execute.assert_not_called()
+    assert forwarder.partition is None
+
+    forwarder.partition = "hour"
+    assert (
+        forwarder.partition_name(forwarder.partition_start(now)) == "logs_p2022010210"
+    )
+
+
+@pytest.mark.asyncio
+async def test_forwarder_socket_upstreams_requeue():
+    forwarder = forwarders.SocketForwarder(
+        "127.0.0.1", 1, upstreams=[("127.0.0.1", 2), ("127.0.0.1", 3)]
+    )
+    first, second = forwarder.upstreams
+    assert first.counter is second.counter is forwarder.counter
+
+    # Batches requeued by the upstreams with equal times keep their order
+    created_at = "2021-01-01 00:00:00"
+    first.put_many([{"created_at": created_at, "message": "first"}])
+    second.put_many([{"created_at": created_at, "message": "second"}])
+    forwarder.put_many([{"created_at": created_at, "message": "third"}])
+    assert await forwarder.get_batch() == [
+        {"created_at": created_at, "message": "first"},
+        {"created_at": created_at, "message": "second"},
+        {"created_at": created_at, "message": "third"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_forwarder_socket_upstreams(unused_tcp_port_factory):
+    received = []
+
+    async def accept(reader, writer):
+        while True:
+            try:
+                (length,) = struct.unpack(">L", await reader.readexactly(4))
+            except asyncio.IncompleteReadError:
+                return
+            received.append(json.loads(await reader.readexactly(length)))
+
+    port, unreachable = unused_tcp_port_factory(), unused_tcp_port_factory()
+    server = await asyncio.start_server(accept, "127.0.0.1", port)
+
+    forwarder = forwarders.SocketForwarder(
+        "127.0.0.1", unreachable, upstreams=[("127.0.0.1", port)]
+    )
+    assert str(forwarder) == f"<forwarder 127.0.0.1:{unreachable},127.0.0.1:{port}>"
+    (upstream,) = forwarder.upstreams
+    assert upstream.queue is forwarder.queue
+
+    # The unreachable server doesn't take any batches
+    forwarder.put_many({"created_at": i} for i in range(5))
+    with patch("log_proxy.forwarders.base._logger"):
+        task = asyncio.create_task(forwarder.process())
+        assert await forwarder.drain(1)
+        task.cancel()
+
+    await asyncio.sleep(0.05)
+    assert sorted(msg["created_at"] for msg in received) == list(range(5))
+    assert not forwarder.connected()
+    assert upstream.connected()
+
+    server.close()
+    await server.wait_closed()
+
+
 @pytest.mark.asyncio
 async def test_forwarder_socket(unused_tcp_port):
     sock = socket.socket()
@@ -134,5 +577,62 @@ async def test_forwarder_socket(unused_tcp_port):
     await forwarder.process_message({"a": 42})
     assert conn.recv(1024) == b'\x00\x00\x00\x09{"a": 42}'
 
+    await forwarder.process_messages([{"a": 42}, {"b": 43}])
+    assert conn.recv(1024) == b'\x00\x00\x00\x09{"a": 42}\x00\x00\x00\x09{"b": 43}'
+
+    # Relayed messages are sent as the original frame
+    raw = RawMessage(b'{"level":10}', 10)
+    await forwarder.process_messages([raw])
+    assert conn.recv(1024) == b'\x00\x00\x00\x0c{"level":10}'
+
     forwarder.invalidate()
     assert not forwarder.connected()
+
+
+@pytest.mark.asyncio
+async def test_forwarder_socket_tls():
+    ssl_context = SessionContext()
+    forwarder = forwarders.SocketForwarder("127.0.0.1", 0, ssl_context=ssl_context)
+    ssl_object = MagicMock(server_side=False, session_reused=True)
+    ssl_object.server_hostname = "127.0.0.1"
+    ssl_object.session = MagicMock(has_ticket=False, id=b"")
+
+    writer = MagicMock()
+    writer.get_extra_info.return_value = ssl_object
+    with patch("asyncio.open_connection", return_value=(MagicMock(), writer)):
+        await forwarder.connect()
+
+    assert forwarder.stats()["tls"]["resumed"] == 1
+
+    # The session is saved again before the connection is dropped
+    assert ssl_context.sessions == {}
+    ssl_object.session.has_ticket = True
+    forwarder.invalidate()
+    assert ssl_context.sessions == {("127.0.0.1", 0): ssl_object.session}
+
+
+@pytest.mark.asyncio
+async def test_forwarder_transfer():
+    forwarder = forwarders.Forwarder()
+    started = asyncio.Event()
+
+    async def process_messages(messages):
+        started.set()
+        await asyncio.sleep(10)
+
+    # The batch in flight is put back if the processing is cancelled
+    forwarder.process_messages = process_messages
+    forwarder.put_many([{"level": 20, "message": "a"}, {"level": 20, "message": "b"}])
+    task = asyncio.create_task(forwarder.process())
+    await started.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    target = forwarders.Forwarder()
+    assert forwarder.transfer(target) == 2
+    assert await forwarder.drain(0.01)
+    assert await target.get_batch() == [
+        {"level": 20, "message": "a"},
+        {"level": 20, "message": "b"},
+    ]
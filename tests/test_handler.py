@@ -3,7 +3,8 @@ import logging
 import socket
 from unittest.mock import MagicMock
 
-from log_proxy.handlers import JSONSocketHandler
+from log_proxy.handlers import JSONDatagramHandler, JSONSocketHandler
+from log_proxy.tls import SessionContext
 
 
 def test_json_handler_socket(unused_tcp_port):
@@ -21,7 +22,7 @@ def test_json_handler_socket(unused_tcp_port):
     handler.ssl_context.wrap_socket.assert_called_once()
     args, kwargs = handler.ssl_context.wrap_socket.call_args
     assert any(isinstance(arg, socket.socket) for arg in args)
-    assert kwargs["server_side"] is True
+    assert kwargs["server_hostname"] == "127.0.0.1"
 
 
 def test_json_handler_token(unused_tcp_port):
@@ -57,3 +58,63 @@ def test_json_handler_pickle():
     ret = handler.makePickle(record)
     ret = json.loads(ret[4:].decode())
     assert ret["message"] == "hello"
+
+
+def test_json_handler_ticket(unused_tcp_port):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", unused_tcp_port))
+    sock.listen()
+
+    handler = JSONSocketHandler("127.0.0.1", unused_tcp_port)
+    handler.ssl_context = MagicMock(spec=SessionContext)
+    handler.ssl_context.handshake.return_value = False
+    handler.ssl_context.save.side_effect = [False, True]
+
+    handler.sock = handler.makeSocket()
+    assert handler.ticket_pending
+
+    # The session is saved once the ticket arrived
+    handler.send(b"hello")
+    assert handler.ticket_pending
+    handler.send(b"hello")
+    assert not handler.ticket_pending
+    assert handler.ssl_context.save.call_count == 2
+
+
+def test_json_handler_datagram(unused_udp_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", unused_udp_port))
+    sock.settimeout(1)
+
+    handler = JSONDatagramHandler("127.0.0.1", unused_udp_port, token="hello")
+    handler.emit(logging.makeLogRecord({"msg": "hello"}))
+
+    # The token and the record arrive in the same datagram
+    data = sock.recv(65535)
+    prefix = handler._convert_json({"token": "hello"})
+    assert data.startswith(prefix)
+    assert json.loads(data[len(prefix) + 4 :])["message"] == "hello"
+
+    handler.close()
+    sock.close()
+
+
+def test_json_handler_unix(tmp_path):
+    path = str(tmp_path / "log.sock")
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(path)
+    sock.listen()
+
+    # Unix sockets don't use TLS or the token
+    handler = JSONSocketHandler(path, token="hello")
+    handler.ssl_context = MagicMock()
+    handler.emit(logging.makeLogRecord({"msg": "hello"}))
+    handler.ssl_context.wrap_socket.assert_not_called()
+
+    conn, _ = sock.accept()
+    conn.settimeout(1)
+    assert json.loads(conn.recv(65535)[4:])["message"] == "hello"
+
+    handler.close()
+    conn.close()
+    sock.close()
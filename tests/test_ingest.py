@@ -0,0 +1,118 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from log_proxy import ingest
+
+
+def reader_for(data: bytes, limit: int = 1 << 16) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader(limit=limit)
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+async def collect(chunks) -> list:
+    return [chunk async for chunk in chunks]
+
+
+@pytest.mark.asyncio
+async def test_read_request():
+    reader = reader_for(
+        b"POST /logs?x=1 HTTP/1.1\r\nHost: a\r\nContent-Length: 2\r\n\r\n{}"
+    )
+    method, path, version, headers = await ingest.read_request(reader)
+    assert (method, path, version) == ("POST", "/logs", "HTTP/1.1")
+    assert headers == {"host": "a", "content-length": "2"}
+    assert ingest.keep_alive(version, headers)
+
+    assert await ingest.read_request(reader_for(b"")) is None
+    for data in (b"GET /\r\n\r\n", b"GET / HTTP/1.1\r\ninvalid\r\n\r\n", b"GET"):
+        with pytest.raises(ingest.HTTPError) as e:
+            await ingest.read_request(reader_for(data))
+        assert e.value.status == 400
+
+    with pytest.raises(ingest.HTTPError) as e:
+        await ingest.read_request(reader_for(b"GET / HTTP/1.1\r\n" + b"x" * 100, 10))
+    assert e.value.status == 431
+
+
+def test_keep_alive():
+    assert not ingest.keep_alive("HTTP/1.1", {"connection": "close"})
+    assert not ingest.keep_alive("HTTP/1.0", {})
+    assert ingest.keep_alive("HTTP/1.0", {"connection": "Keep-Alive"})
+
+
+@pytest.mark.asyncio
+async def test_read_body():
+    headers = {"content-length": "5"}
+    assert await collect(ingest.read_body(reader_for(b"hello!"), headers)) == [b"hello"]
+
+    data = b"3;ext\r\nabc\r\n2\r\nde\r\n0\r\nTrailer: x\r\n\r\nnext"
+    reader = reader_for(data)
+    headers = {"transfer-encoding": "chunked"}
+    assert await collect(ingest.read_body(reader, headers)) == [b"abc", b"de"]
+    assert await reader.read() == b"next"
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        await collect(ingest.read_body(reader_for(b"abc"), {"content-length": "5"}))
+
+    for data, headers, status in [
+        (b"", {}, 411),
+        (b"", {"content-length": "-1"}, 400),
+        (b"x\r\n", {"transfer-encoding": "chunked"}, 400),
+        (b"1\r\nabc\r\n", {"transfer-encoding": "chunked"}, 400),
+    ]:
+        with pytest.raises(ingest.HTTPError) as e:
+            await collect(ingest.read_body(reader_for(data), headers))
+        assert e.value.status == status
+
+
+async def chunks_of(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_decompress():
+    assert await collect(ingest.decompress(chunks_of(b"a", b"b"), "")) == [b"a", b"b"]
+
+    # Large outputs are produced in steps and multiple members are supported
+    data = gzip.compress(b"x" * (3 * ingest.CHUNK_SIZE)) + gzip.compress(b"y")
+    result = await collect(ingest.decompress(chunks_of(data[:10], data[10:]), "gzip"))
+    assert max(map(len, result)) <= ingest.CHUNK_SIZE
+    assert b"".join(result) == b"x" * (3 * ingest.CHUNK_SIZE) + b"y"
+
+    for encoding, status in (("br", 415), ("gzip", 400)):
+        with pytest.raises(ingest.HTTPError) as e:
+            await collect(ingest.decompress(chunks_of(b"invalid"), encoding))
+        assert e.value.status == status
+
+
+@pytest.mark.asyncio
+async def test_iter_lines():
+    chunks = chunks_of(b'{"a": 1}\n{"b"', b": 2}\r\n\n", b" last ")
+    assert await collect(ingest.iter_lines(chunks)) == [
+        b'{"a": 1}',
+        b'{"b": 2}',
+        b"last",
+    ]
+
+    for chunks in (chunks_of(b"0123456789\n"), chunks_of(b"01234", b"56789")):
+        with pytest.raises(ingest.HTTPError) as e:
+            await collect(ingest.iter_lines(chunks, 8))
+        assert e.value.status == 413
+
+
+def test_response():
+    data = ingest.response(200, {"accepted": 1})
+    head, body = data.split(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"Connection: keep-alive" in head
+    assert json.loads(body) == {"accepted": 1}
+
+    data = ingest.response(429, ingest.HTTPError(429).body, False)
+    assert b"Retry-After: 1" in data and b"Connection: close" in data
+    assert data.endswith(b'{"error": "Too Many Requests"}')
@@ -1,15 +1,23 @@
+import logging
+import os
 from tempfile import NamedTemporaryFile
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from log_proxy import SocketForwarder
-from log_proxy.__main__ import main, parser_watcher, run_server
+from log_proxy import SocketForwarder, base
+from log_proxy.__main__ import (
+    main,
+    parser_watcher,
+    reload_server,
+    run_server,
+    upgrade_server,
+)
 
 
 @patch("log_proxy.__main__.JSONSocketHandler")
 @patch("log_proxy.utils.generate_ssl_context")
-@patch("log_proxy.utils.stdin_to_log", new_callable=AsyncMock)
+@patch("log_proxy.utils.stdin_to_forwarder", new_callable=AsyncMock)
 @patch("log_proxy.__main__.configure")
 def test_client(conf_mock, stdin_mock, ssl_mock, handler_mock, unused_tcp_port):
     main(["client", "--forward", f"localhost:{unused_tcp_port}", "--log-stdin"])
@@ -37,9 +45,53 @@ def test_client(conf_mock, stdin_mock, ssl_mock, handler_mock, unused_tcp_port):
     assert handler_mock.call_args.kwargs["ssl_context"] == ssl_mock.return_value
 
 
+@patch("log_proxy.__main__.Benchmark")
+@patch("log_proxy.utils.generate_ssl_context")
+@patch("log_proxy.__main__.configure")
+def test_bench(conf_mock, ssl_mock, bench_mock, unused_tcp_port):
+    bench_mock.return_value.run = AsyncMock(
+        return_value={
+            "sent": 10,
+            "duration": 1.0,
+            "connections": 2,
+            "rate": 10.0,
+            "latency": {"p50": 1.0},
+            "errors": {"ConnectionResetError": 1},
+        }
+    )
+    with NamedTemporaryFile() as fp:
+        main(
+            [
+                "bench",
+                "--forward",
+                f"localhost:{unused_tcp_port}",
+                "--forward-ca",
+                fp.name,
+                "--forward-token",
+                "abc",
+                "--bench-connections",
+                "2",
+                "--bench-sizes",
+                "10:1,20:3",
+                "--bench-levels",
+                "warning",
+            ]
+        )
+
+    bench_mock.assert_called_once()
+    assert bench_mock.call_args.args == ("localhost", unused_tcp_port)
+    kwargs = bench_mock.call_args.kwargs
+    assert kwargs["connections"] == 2
+    assert kwargs["sizes"] == ([10, 20], [1.0, 3.0])
+    assert kwargs["levels"] == ([logging.WARNING], [1.0])
+    assert kwargs["framing"] == "raw"
+    assert kwargs["token"] == "abc"
+    assert kwargs["ssl_context"] == ssl_mock.return_value
+
+
 @patch("log_proxy.__main__.JSONSocketHandler")
 @patch("log_proxy.__main__.watch", new_callable=AsyncMock)
-@patch("log_proxy.utils.stdin_to_log", new_callable=AsyncMock)
+@patch("log_proxy.utils.stdin_to_forwarder", new_callable=AsyncMock)
 @patch("log_proxy.__main__.configure")
 def test_client_watch(conf_mock, stdin_mock, watch_mock, handler_mock, unused_tcp_port):
     watch_mock.__bool__.return_value = True
@@ -48,6 +100,10 @@ def test_client_watch(conf_mock, stdin_mock, watch_mock, handler_mock, unused_tc
     watch_mock.assert_called_once()
     handler_mock.assert_called_once()
 
+    # The queue of the watched lines is limited
+    forwarder = watch_mock.call_args[0][1]
+    assert forwarder.queue.maxsize == 10000
+
     watch_mock.reset_mock()
     handler_mock.reset_mock()
 
@@ -124,6 +180,13 @@ def test_run_server_postgres(exit_mock, ssl_mock, server_mock, forward_mock):
         )
     server_mock.assert_called_once()
     ssl_mock.assert_called_once()
+    assert ssl_mock.call_args.kwargs["tickets"] == 2
+    assert server_mock.call_args.kwargs["max_frame_size"] == 1 << 20
+    assert server_mock.call_args.kwargs["profiler"] is None
+    assert server_mock.call_args.kwargs["udp_address"] is None
+    assert server_mock.call_args.kwargs["syslog_address"] is None
+    assert server_mock.call_args.kwargs["unix_path"] is None
+    assert server_mock.call_args.kwargs["http_address"] is None
     assert server_mock.call_args.kwargs["forwarder"] == forward_mock.return_value
 
     # Missing forward argument
@@ -139,9 +202,21 @@ def test_run_server_postgres(exit_mock, ssl_mock, server_mock, forward_mock):
 @patch("sys.exit", side_effect=[AssertionError()])
 def test_run_server_mongodb(exit_mock, ssl_mock, server_mock, forward_mock):
     # Spawn a server with a socket forwarder with SSL context
-    main(["server", "mongodb", "--db", "log", "--db-table", "log"])
+    main(
+        [
+            "server",
+            "mongodb",
+            "--db",
+            "log",
+            "--db-table",
+            "log",
+            "--profile-dir",
+            "profiles",
+        ]
+    )
     server_mock.assert_called_once()
     assert server_mock.call_args.kwargs["forwarder"] == forward_mock.return_value
+    assert server_mock.call_args.kwargs["profiler"].directory == "profiles"
 
     # Missing forward argument
     server_mock.reset_mock()
@@ -150,6 +225,65 @@ def test_run_server_mongodb(exit_mock, ssl_mock, server_mock, forward_mock):
     server_mock.assert_not_called()
 
 
+@patch("log_proxy.forwarders.SQLiteForwarder")
+@patch("log_proxy.__main__.LogServer", return_value=AsyncMock())
+@patch("sys.exit", side_effect=[AssertionError()])
+def test_run_server_sqlite(exit_mock, server_mock, forward_mock):
+    main(
+        [
+            "server",
+            "sqlite",
+            "--db",
+            "logs.db",
+            "--udp",
+            ":2773",
+            "--syslog",
+            "",
+            "--unix",
+            "/run/log.sock",
+            "--unix-mode",
+            "600",
+            "--unix-users",
+            "0",
+            "--http",
+            ":8080",
+        ]
+    )
+    server_mock.assert_called_once()
+    kwargs = server_mock.call_args.kwargs
+    assert kwargs["udp_address"] == ("", 2773)
+    assert kwargs["syslog_address"] == ("", 514)
+    assert kwargs["unix_path"] == "/run/log.sock"
+    assert kwargs["unix_mode"] == 0o600
+    assert kwargs["unix_uids"] == {0}
+    assert kwargs["http_address"] == ("", 8080)
+    assert server_mock.call_args.kwargs["forwarder"] == forward_mock.return_value
+    assert forward_mock.call_args.kwargs["table"] == "logs"
+
+    # Missing database argument
+    server_mock.reset_mock()
+    with pytest.raises(AssertionError):
+        main(["server", "sqlite"])
+    server_mock.assert_not_called()
+
+
+@patch("log_proxy.forwarders.FileForwarder")
+@patch("log_proxy.__main__.LogServer", return_value=AsyncMock())
+@patch("sys.exit", side_effect=[AssertionError()])
+def test_run_server_file(exit_mock, server_mock, forward_mock):
+    main(["server", "file", "--file-directory", "/tmp/logs", "--file-no-compress"])
+    server_mock.assert_called_once()
+    assert server_mock.call_args.kwargs["forwarder"] == forward_mock.return_value
+    assert forward_mock.call_args.args == ("/tmp/logs",)
+    assert forward_mock.call_args.kwargs["compress"] is False
+
+    # Missing directory argument
+    server_mock.reset_mock()
+    with pytest.raises(AssertionError):
+        main(["server", "file"])
+    server_mock.assert_not_called()
+
+
 @patch("log_proxy.forwarders.MongoDBForwarder")
 @patch("log_proxy.__main__.LogServer", return_value=AsyncMock())
 @patch("log_proxy.utils.generate_ssl_context")
@@ -186,3 +320,49 @@ async def test_run_invalid(exit_mock, watch_mock, conf_mock, server_mock):
     with MagicMock() as mock:
         parser_watcher(mock)
         mock.add_argument_group.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_reload_server():
+    server = MagicMock(replace_forwarder=AsyncMock())
+    with patch("log_proxy.forwarders.SQLiteForwarder") as forward_mock:
+        await reload_server(server, ["server", "sqlite", "--db", "logs.db"], 5)
+
+    server.reload_tokens.assert_called_once_with(None)
+    server.replace_forwarder.assert_called_once_with(forward_mock.return_value, 5)
+
+    # Invalid configurations keep the current forwarder
+    server.reset_mock()
+    await reload_server(server, ["server", "sqlite"], 5)
+    server.replace_forwarder.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_upgrade_server():
+    server = MagicMock(shutdown=AsyncMock())
+    server.listening_fds.return_value = [5, 6]
+
+    def ready(command, pass_fds, env):
+        os.write(int(env[base.READY_FD_ENV]), b"1")
+        return MagicMock(pid=42)
+
+    with patch("subprocess.Popen", side_effect=ready) as popen_mock:
+        await upgrade_server(server, ["server", "sqlite"], 5)
+
+    args, kwargs = popen_mock.call_args
+    assert args[0][-2:] == ["server", "sqlite"]
+    assert kwargs["pass_fds"] == [5, 6, int(kwargs["env"][base.READY_FD_ENV])]
+    assert kwargs["env"][base.LISTEN_FDS_ENV] == "5,6"
+    server.shutdown.assert_called_once_with(5)
+
+    # The server keeps running if the process exits before it's ready
+    server.reset_mock()
+    with patch("subprocess.Popen", return_value=MagicMock(pid=42)):
+        await upgrade_server(server, ["server", "sqlite"], 5)
+    server.shutdown.assert_not_called()
+
+    # The server keeps running if the process can't be started
+    server.reset_mock()
+    with patch("subprocess.Popen", side_effect=OSError()):
+        await upgrade_server(server, ["server", "sqlite"], 5)
+    server.shutdown.assert_not_called()
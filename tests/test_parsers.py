@@ -0,0 +1,229 @@
+import json
+import logging
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from log_proxy import parsers
+from log_proxy.watcher import WatcherHandler
+
+TRACEBACK = """2022-01-02 10:11:12,345 [ ERROR  ] app: broken
+Traceback (most recent call last):
+  File "app.py", line 1, in <module>
+ValueError: invalid
+2022-01-02 10:11:13,000 [  INFO  ] app: next
+"""
+
+PYTHON_REGEX = (
+    r"(?P<created_at>\S+ \S+) \[\s*(?P<level>\w+)\s*\] (?P<created_by>[^:]+): "
+    r"(?P<message>.*)"
+)
+
+
+def test_parse_level():
+    assert parsers.parse_level(42) == 42
+    assert parsers.parse_level(" 30 ") == 30
+    assert parsers.parse_level("Error") == logging.ERROR
+    assert parsers.parse_level("FATAL") == logging.CRITICAL
+    assert parsers.parse_level("unknown") == logging.INFO
+    assert parsers.parse_level(None, logging.DEBUG) == logging.DEBUG
+
+
+def test_parse_time():
+    # Timestamps with timezone are converted into the naive local time
+    utc = datetime(2022, 1, 2, 10, 11, 12, tzinfo=timezone.utc)
+    local = utc.astimezone().replace(tzinfo=None).isoformat(" ")
+    assert parsers.parse_time("2022-01-02T10:11:12Z") == local
+    assert parsers.parse_time("2022-01-02 10:11:12+00:00") == local
+    assert parsers.parse_time("2022-01-02 10:11:12,345") == "2022-01-02 10:11:12.345000"
+    assert parsers.parse_time("02.01.2022", "%d.%m.%Y") == "2022-01-02 00:00:00"
+    assert parsers.parse_time(0) == datetime.fromtimestamp(0).isoformat(" ")
+
+    with patch("log_proxy.parsers.datetime") as mock:
+        mock.now.return_value.isoformat.return_value = "now"
+        mock.fromisoformat.side_effect = ValueError()
+        assert parsers.parse_time("invalid") == "now"
+        assert parsers.parse_time(None) == "now"
+
+
+def test_parser_invalid():
+    with pytest.raises(ValueError):
+        parsers.LineParser(format="unknown")
+
+    with pytest.raises(ValueError):
+        parsers.LineParser(format="regex")
+
+
+def test_parser_plain():
+    parser = parsers.LineParser("*.log")
+    assert str(parser) == "<parser plain:*.log>"
+    assert parser.match("/var/log/app.log")
+    assert not parser.match("/var/log/app.txt")
+
+    messages = parser.feed("app.log", "hello\n\n world \n")
+    assert [msg["message"] for msg in messages] == ["hello", "world"]
+    assert all(msg["created_by"] == "app.log" for msg in messages)
+    assert not parser.flush()
+
+
+def test_parser_continuation():
+    parser = parsers.LineParser(continuation=r"\s|Traceback|\w+Error:")
+
+    chunk1, chunk2 = TRACEBACK.split("  File", 1)
+    assert parser.feed("app.log", "orphan\n") == []
+    assert parser.feed("app.log", chunk1)[0]["message"] == "orphan"
+    assert parser.feed("app.log", "  File" + chunk2)[0]["exception"] == (
+        'Traceback (most recent call last):\n  File "app.py", line 1, in <module>\n'
+        "ValueError: invalid"
+    )
+
+    # The last record is pending until it gets flushed
+    assert parser.flush(max_age=60) == []
+    (msg,) = parser.flush()
+    assert msg["message"] == "2022-01-02 10:11:13,000 [  INFO  ] app: next"
+    assert "exception" not in msg
+
+
+def test_parser_pending_age():
+    parser = parsers.LineParser(continuation=r"\s")
+    with patch("log_proxy.parsers.time.monotonic", return_value=0):
+        assert parser.feed("app.log", "first\n") == []
+
+    # New continuation lines keep the record pending
+    with patch("log_proxy.parsers.time.monotonic", return_value=10):
+        assert parser.feed("app.log", "  continued\n") == []
+        assert parser.flush(max_age=5) == []
+
+    with patch("log_proxy.parsers.time.monotonic", return_value=20):
+        (msg,) = parser.flush(max_age=5)
+    assert msg["exception"] == "  continued"
+
+
+def test_parser_regex():
+    parser = parsers.LineParser(format="regex", regex=PYTHON_REGEX)
+
+    # Lines without a pending record are passed as they are
+    (orphan,) = parser.feed("app.log", "orphan\n")
+    assert orphan["message"] == "orphan"
+
+    (msg,) = parser.feed("app.log", TRACEBACK)
+    assert msg["level"] == logging.ERROR
+    assert msg["created_at"] == "2022-01-02 10:11:12.345000"
+    assert msg["created_by"] == "app"
+    assert msg["message"] == "broken"
+    assert msg["exception"].endswith("ValueError: invalid")
+
+    (msg,) = parser.flush("app.log")
+    assert msg["level"] == logging.INFO
+    assert msg["message"] == "next"
+
+
+def test_parser_json():
+    parser = parsers.LineParser(format="json", fields={"message": "text"})
+    lines = [
+        {"levelname": "WARNING", "text": "hello", "name": "app", "pid": 42},
+        {"severity": "error", "text": "broken", "exc_info": "Traceback"},
+    ]
+    text = "\n".join(map(json.dumps, lines)) + "\n"
+
+    first, second = parser.feed("app.log", text)
+    assert first["level"] == logging.WARNING
+    assert first["message"] == "hello"
+    assert first["created_by"] == "app"
+    assert first["pid"] == 42
+    assert second["level"] == logging.ERROR
+    assert second["exception"] == "Traceback"
+    assert second["created_by"] == "app.log"
+
+    # Invalid lines are passed as they are
+    messages = parser.feed("app.log", text + "invalid\n[1]\n")
+    assert [msg["message"] for msg in messages] == ["hello", "broken", "invalid", "[1]"]
+    assert parser.feed("app.log", "\n") == []
+
+    # Lines are never merged by the bulk decoding
+    messages = parser.feed("app.log", "[1\n2]\n")
+    assert [msg["message"] for msg in messages] == ["[1", "2]"]
+
+
+def test_load_parsers(tmp_path):
+    path = tmp_path / "parsers.json"
+    path.write_text(json.dumps([{"pattern": "*.json", "format": "json"}]))
+    (parser,) = parsers.load_parsers(str(path))
+    assert parser.format == "json"
+
+    path.write_text("{}")
+    with pytest.raises(ValueError):
+        parsers.load_parsers(str(path))
+
+
+def test_watcher_parsers(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_text(TRACEBACK)
+
+    parser = parsers.LineParser("*.log", format="regex", regex=PYTHON_REGEX)
+    handler = WatcherHandler(parsers=[parser])
+    handler.send = MagicMock()
+    handler.on_new_lines = MagicMock()
+
+    handler.read_lines(str(log), str(log), 0)
+    (msg,) = handler.send.call_args[0][0]
+    assert msg["message"] == "broken"
+
+    handler.flush_parsers()
+    (msg,) = handler.send.call_args[0][0]
+    assert msg["message"] == "next"
+
+    # Files without parser are passed line by line
+    assert handler.get_parser(str(tmp_path / "app.txt")) is None
+    handler.on_new_text(str(tmp_path / "app.txt"), "hello\n")
+    handler.on_new_lines.assert_called_once_with(str(tmp_path / "app.txt"), ["hello"])
+
+
+def test_parse_syslog():
+    message = parsers.parse_syslog(
+        b"<34>1 2003-10-11T22:14:15.003Z mymachine su 42 ID47 "
+        b'[ex@1 a="x\\]y"] \xef\xbb\xbfsu root failed\n',
+        "10.0.0.1",
+    )
+    assert message == {
+        "level": logging.CRITICAL,
+        "pid": 42,
+        "created_by": "su",
+        "host": "mymachine",
+        "created_at": parsers.parse_time("2003-10-11T22:14:15.003Z"),
+        "message": "su root failed",
+    }
+
+    # Nil values fall back to the defaults
+    message = parsers.parse_syslog(b"<15>1 - - - - - -", "10.0.0.1")
+    assert message["level"] == logging.DEBUG
+    assert message["host"] == "10.0.0.1"
+    assert message["created_by"] == "syslog"
+    assert message["message"] == ""
+
+    year = datetime.now().year
+    message = parsers.parse_syslog(b"<12>Feb  5 17:32:18 host sshd[123]: hello")
+    assert message["level"] == logging.WARNING
+    assert message["pid"] == 123
+    assert message["host"] == "host"
+    assert message["created_by"] == "sshd"
+    assert message["created_at"].endswith("-02-05 17:32:18")
+    assert message["created_at"][:4] in (str(year), str(year - 1))
+    assert message["message"] == "hello"
+
+    # Invalid dates use the receive time
+    for data in (b"<12>Feb 31 17:32:18 cron: x", b"<12>Feb  5 25:00:00 cron: x"):
+        created_at = parsers.parse_syslog(data)["created_at"]
+        assert datetime.fromisoformat(created_at).year == year
+
+    message = parsers.parse_syslog(b"<11>Feb  5 17:32:18 cron: x", "10.0.0.1")
+    assert message["level"] == logging.ERROR
+    assert message["host"] == "10.0.0.1"
+    assert message["created_by"] == "cron"
+
+    # Unknown formats are kept as plain text
+    message = parsers.parse_syslog(b"<13>plain text")
+    assert message["message"] == "plain text"
+    assert "host" not in message
+    assert parsers.parse_syslog(b"no priority")["level"] == logging.INFO
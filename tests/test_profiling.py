@@ -0,0 +1,70 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from log_proxy.profiling import SamplingProfiler, Tracer
+
+
+class Stage:
+    async def work(self, value):
+        return value
+
+
+@pytest.mark.asyncio
+async def test_tracer():
+    stage = Stage()
+    tracer = Tracer()
+    tracer.add(stage, "work")
+
+    # Disabled tracing doesn't touch the methods
+    assert "work" not in vars(stage)
+    assert await stage.work(1) == 1
+    assert tracer.summary() == {}
+
+    tracer.enable()
+    assert await stage.work(2) == 2
+    assert await stage.work(3) == 3
+    tracer.disable()
+    assert "work" not in vars(stage)
+    await stage.work(4)
+
+    summary = tracer.summary()
+    assert summary["Stage.work"]["count"] == 2
+    assert summary["Stage.work"]["max"] >= summary["Stage.work"]["mean"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_profiler(tmp_path):
+    stage = Stage()
+    profiler = SamplingProfiler(str(tmp_path), duration=0.2, interval=0.001)
+    profiler.tracer.add(stage, "work")
+
+    profiler.toggle()
+    assert profiler.running()
+
+    # Keep the loop busy to get samples
+    end = time.monotonic() + 0.05
+    while time.monotonic() < end:
+        await stage.work(1)
+
+    await asyncio.sleep(0.3)
+    assert not profiler.running()
+    assert "work" not in vars(stage)
+
+    for _ in range(50):
+        files = sorted(os.listdir(tmp_path))
+        if len(files) == 2:
+            break
+        await asyncio.sleep(0.01)
+
+    folded, summary = files
+    assert folded.endswith(".folded") and summary.endswith(".json")
+    with open(tmp_path / folded) as fp:
+        assert "test_profiler" in fp.read()
+    with open(tmp_path / summary) as fp:
+        data = json.load(fp)
+    assert data["samples"] > 0
+    assert data["stages"]["Stage.work"]["count"] > 0
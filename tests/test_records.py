@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from log_proxy.records import Record, dumps
+
+
+def test_record():
+    data = {
+        "level": 20,
+        "pid": 1,
+        "host": "".join(["ho", "st"]),
+        "message": "hello",
+        "created_at": "2021-01-01 00:00:00",
+        "created_by": "app",
+        "custom": 42,
+    }
+    record = Record(data)
+    assert record == data
+    assert record.to_dict() == data
+    assert list(record) == list(data)
+    assert len(record) == 7
+    assert not hasattr(record, "__dict__")
+
+    # The low-cardinality fields are shared between the records
+    assert Record(data)["host"] is record["host"]
+    assert Record({"host": "".join(["ho", "st"])})["host"] is record["host"]
+
+    assert record.get("exception") is None
+    assert record.get("other", 1) == 1
+    with pytest.raises(KeyError):
+        record["exception"]
+    with pytest.raises(KeyError):
+        del record["other"]
+
+    record["exception"] = "error"
+    del record["custom"]
+    del record["pid"]
+    assert "pid" not in record
+    assert record.to_dict() == {
+        **{k: v for k, v in data.items() if k not in ("pid", "custom")},
+        "exception": "error",
+    }
+
+
+def test_record_dumps():
+    record = Record({"level": 20, "message": "hello", "extra": [1]})
+    assert json.loads(dumps(record)) == {"level": 20, "message": "hello", "extra": [1]}
+    assert (
+        dumps({"a": record}) == '{"a": {"level": 20, "message": "hello", "extra": [1]}}'
+    )
+
+    with pytest.raises(TypeError):
+        dumps({"a": object()})
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from unittest.mock import AsyncMock
+
+import pytest
+
+from log_proxy import LogServer, forwarders
+from log_proxy.scheduler import FairScheduler
+
+
+@pytest.mark.asyncio
+async def test_scheduler_weights():
+    forwarder = forwarders.Forwarder()
+    forwarder.put_wait = AsyncMock(wraps=forwarder.put_wait)
+    scheduler = FairScheduler(forwarder, max_size=100, quantum=1)
+    scheduler.set_weight("big", 3)
+    scheduler.set_weight("zero", 0)
+    assert scheduler.weights == {"big": 3.0, "zero": 1.0}
+
+    for i in range(9):
+        await scheduler.put("big", {"client": "big", "created_at": i})
+    for i in range(3):
+        await scheduler.put("small", {"client": "small", "created_at": 100 + i})
+
+    assert scheduler.qsize("big") == 9
+    assert scheduler.qsize("unknown") == 0
+    assert not scheduler.full("big") and not scheduler.full("unknown")
+
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(0.1)
+
+    # The messages are forwarded in rounds respecting the weights
+    clients = [call.args[0]["client"] for call in forwarder.put_wait.call_args_list]
+    assert clients == (["big"] * 3 + ["small"]) * 3
+    assert not scheduler.active
+    assert not scheduler.deficits
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_backpressure():
+    forwarder = forwarders.Forwarder(max_size=2)
+    forwarder.put_wait = AsyncMock(wraps=forwarder.put_wait)
+    scheduler = FairScheduler(forwarder, max_size=1)
+
+    task = asyncio.create_task(scheduler.run())
+    await scheduler.put("a", {"created_at": 0})
+    await scheduler.put("b", {"created_at": 1})
+    await asyncio.sleep(0.05)
+
+    # The forwarder is full and the scheduler waits instead of dropping
+    await scheduler.put("a", {"created_at": 2})
+    await scheduler.put("a", {"created_at": 3})
+    await asyncio.sleep(0.05)
+    assert forwarder.full()
+    assert forwarder.put_wait.call_count == 3
+    assert scheduler.qsize("a") == 1
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(scheduler.put("a", {"created_at": 4}), 0.05)
+
+    # Free space in the forwarder wakes the scheduler up
+    await forwarder.get()
+    await asyncio.sleep(0.01)
+    assert forwarder.full()
+    assert forwarder.put_wait.call_count == 4
+    assert scheduler.qsize("a") == 0
+    assert not forwarder.dropped
+
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_eviction():
+    forwarder = forwarders.Forwarder()
+    scheduler = FairScheduler(forwarder, max_size=2)
+    await scheduler.put("a", {"level": logging.DEBUG, "created_at": 0})
+    await scheduler.put("a", {"level": logging.INFO, "created_at": 1})
+
+    # Important messages evict the less important ones instead of waiting
+    await scheduler.put("a", {"level": logging.ERROR, "created_at": 2})
+    await scheduler.put("a", {"level": logging.WARNING, "created_at": 3})
+    assert forwarder.dropped == {logging.DEBUG: 1, logging.INFO: 1}
+    assert scheduler.qsize("a") == 2
+
+    # Without less important messages the client has to wait
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(
+            scheduler.put("a", {"level": logging.WARNING, "created_at": 4}), 0.05
+        )
+
+    # The scheduler is drained once the client queues are empty
+    assert not await scheduler.drain(0.01)
+    task = asyncio.create_task(scheduler.run())
+    assert await scheduler.drain(1)
+    assert forwarder.queue.qsize() == 2
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_server_scheduler(unused_tcp_port):
+    forwarder = forwarders.Forwarder()
+    server = LogServer("127.0.0.1", unused_tcp_port, forwarder, client_queue_size=5)
+    assert isinstance(server.scheduler, FairScheduler)
+
+    await server._process_message({"created_at": 0}, "client")
+    assert server.scheduler.qsize("client") == 1
+    assert forwarder.empty()
@@ -1,13 +1,26 @@
 import asyncio
+import gzip
 import json
+import logging
+import os
+import signal
+import socket
+import ssl
+import struct
 from asyncio.exceptions import IncompleteReadError
 from tempfile import NamedTemporaryFile
-from unittest.mock import AsyncMock, MagicMock, call
+from unittest.mock import AsyncMock, MagicMock, call, patch
 
 import pytest
 
-from log_proxy import LogServer, LogTokenFileError, SocketForwarder
-from log_proxy.server import RequiredFields
+from log_proxy import LogServer, LogTokenFileError, SocketForwarder, utils
+from log_proxy.forwarders import Forwarder
+from log_proxy.forwarders.base import RawMessage
+from log_proxy.handlers import JSONDatagramHandler, JSONSocketHandler
+from log_proxy.profiling import SamplingProfiler
+from log_proxy.records import Record
+from log_proxy.server import RequiredFields, split_frames
+from log_proxy.tls import SessionContext
 
 
 def test_server_start(unused_tcp_port):
@@ -30,11 +43,12 @@ async def test_server_stop(unused_tcp_port):
     close.assert_called_once()
     writer.wait_closed.assert_called_once()
 
-    server.sock = AsyncMock()
-    server.sock.close = MagicMock()
+    sock = AsyncMock()
+    sock.close = MagicMock()
+    server.servers = [sock]
     await server.stop()
-    server.sock.close.assert_called_once()
-    server.sock.wait_closed.assert_called_once()
+    sock.close.assert_called_once()
+    sock.wait_closed.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -196,6 +210,7 @@ async def test_server(unused_tcp_port):
     # The host is set to the client name specified above
     message["host"] = "client"
     server.forwarder.put.assert_called_once_with(message)
+    assert isinstance(server.forwarder.put.call_args[0][0], Record)
     server.forwarder.put.reset_mock()
 
     # Process an invalid message closes the connection
@@ -227,3 +242,515 @@ async def test_server(unused_tcp_port):
 
     await server.stop()
     await asyncio.sleep(0.1)
+
+
+@pytest.mark.asyncio
+async def test_server_tls_report(unused_tcp_port):
+    ssl_context = SessionContext(ssl.PROTOCOL_TLS_SERVER)
+    server = LogServer(
+        "127.0.0.1", unused_tcp_port, AsyncMock(), ssl_context, use_auth=False
+    )
+
+    # The handshake of every accepted client is counted
+    reader = MagicMock()
+    writer = MagicMock(wait_closed=AsyncMock())
+    writer.get_extra_info.return_value = MagicMock(session_reused=True)
+    server._read_message = AsyncMock(return_value=None)
+    await server._accept(reader, writer)
+    assert ssl_context.stats()["resumed"] == 1
+
+    with patch("log_proxy.server._logger") as logger, patch(
+        "asyncio.sleep", AsyncMock(side_effect=[None, None, AssertionError()])
+    ):
+        with pytest.raises(AssertionError):
+            await server.report(1)
+
+    logger.info.assert_called_once_with("1 TLS handshakes, 1 resumed (100%)")
+
+
+@pytest.mark.asyncio
+async def test_server_frame_limits(unused_tcp_port):
+    server = LogServer(
+        "127.0.0.1", unused_tcp_port, AsyncMock(), max_frame_size=16, max_field_size=4
+    )
+
+    # Oversized frames aren't read
+    reader = AsyncMock()
+    reader.readexactly = AsyncMock(side_effect=[b"\x00\x00\x00\x11"])
+    assert await server._read_message(reader) is None
+    reader.readexactly.assert_called_once_with(4)
+
+    # Stalled reads run into the timeout
+    async def stall(size):
+        await asyncio.sleep(1)
+
+    reader.readexactly = AsyncMock(side_effect=stall)
+    assert await server._read_message(reader, 0.01) is None
+
+    message = {"message": "hello world", "exception": None}
+    assert server._truncate_message(message) == {
+        "message": "hell... [7 truncated]",
+        "exception": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_server_connection_limits(unused_tcp_port):
+    server = LogServer(
+        "127.0.0.1",
+        unused_tcp_port,
+        AsyncMock(),
+        use_auth=False,
+        max_connections=2,
+        max_client_connections=1,
+    )
+    blocked = asyncio.Event()
+
+    async def read_message(reader, *args):
+        await blocked.wait()
+
+    server._read_message = read_message
+    server._stop = AsyncMock()
+
+    def writer(host):
+        writer = MagicMock()
+        writer.get_extra_info.side_effect = {"peername": (host, 1234)}.get
+        return writer
+
+    first = asyncio.create_task(server._accept(MagicMock(), writer("1.2.3.4")))
+    await asyncio.sleep(0.01)
+    assert server.connections == {"1.2.3.4": 1}
+
+    # The second connection of the client is rejected
+    await server._accept(MagicMock(), writer("1.2.3.4"))
+    assert server._stop.call_count == 1
+    assert server.connection_count == 1
+
+    second = asyncio.create_task(server._accept(MagicMock(), writer("5.6.7.8")))
+    await asyncio.sleep(0.01)
+
+    # The global limit is reached
+    await server._accept(MagicMock(), writer("9.9.9.9"))
+    assert server._stop.call_count == 2
+
+    blocked.set()
+    await asyncio.gather(first, second)
+    assert server.connection_count == 0
+    assert server.connections == {}
+
+
+@pytest.mark.asyncio
+async def test_server_relay(unused_tcp_port):
+    server = LogServer("127.0.0.1", unused_tcp_port, AsyncMock(), relay=True)
+    message = {
+        "level": 42,
+        "pid": 123,
+        "message": "hello",
+        "created_at": "2021-01-01 00:00:00",
+        "created_by": "me",
+    }
+    data = json.dumps(message).encode()
+
+    # The frame is relayed unchanged or with the host prefix
+    raw = server._relay_message(data, message)
+    assert isinstance(raw, RawMessage)
+    assert raw.frame == data and raw == {"level": 42}
+
+    raw = server._relay_message(data, message, b'{"host": "client", ')
+    assert json.loads(raw.frame) == {"host": "client", **message}
+
+    # Messages with a host are kept as they are
+    data_host = json.dumps({**message, "host": "origin"}).encode()
+    raw = server._relay_message(data_host, json.loads(data_host), b'{"host": "c", ')
+    assert raw.frame == data_host
+
+    # Frames which might need a rewrite or are invalid are decoded
+    for frame in (
+        json.dumps({**message, "host": ""}).encode(),
+        b'{"level": 42}',
+        json.dumps({**message, "level": "x"}).encode(),
+        json.dumps({**message, "level": True}).encode(),
+        b'{"level": 20, "message": "pid created_at created_by"}',
+        b"[1]",
+    ):
+        assert server._relay_message(frame, json.loads(frame)) is None
+        assert not isinstance(server._decode(frame), RawMessage)
+
+    with pytest.raises(json.JSONDecodeError):
+        server._decode(b'{"level": 20, "pid" "created_at" "created_by" "message"}')
+
+    server.max_field_size = 10
+    assert server._relay_message(data, message) is None
+    server.max_field_size = 0
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(struct.pack(">L", len(data)) + data)
+    raw = await server._read_message(reader)
+    assert server._validate_message(raw, RequiredFields) is raw
+
+    await server._process_message(raw, "client")
+    server.forwarder.put.assert_called_once_with(raw)
+    assert raw == {"level": 42}
+
+
+@pytest.mark.asyncio
+async def test_server_profiler(unused_tcp_port, tmp_path):
+    profiler = SamplingProfiler(str(tmp_path))
+    server = LogServer("127.0.0.1", unused_tcp_port, AsyncMock(), profiler=profiler)
+    server._setup_profiler()
+    assert len(profiler.tracer.targets) == 5
+
+    # The signal toggles the profiler
+    os.kill(os.getpid(), signal.SIGUSR1)
+    await asyncio.sleep(0.01)
+    assert profiler.running()
+    assert "_read_message" in vars(server)
+
+    profiler.stop()
+    assert "_read_message" not in vars(server)
+
+
+@pytest.mark.asyncio
+async def test_server_shutdown(unused_tcp_port):
+    message = {
+        "level": 42,
+        "pid": 123,
+        "message": "hello",
+        "created_at": "2021-01-01 00:00:00",
+        "created_by": "me",
+    }
+
+    # The server listens on an inherited socket
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", unused_tcp_port))
+    forwarder = Forwarder()
+    forwarder.process = AsyncMock()
+    ready_fd, notify_fd = os.pipe()
+    server = LogServer(
+        "", 0, forwarder, use_auth=False, sockets=[sock], ready_fd=notify_fd
+    )
+    task = asyncio.create_task(server.run())
+
+    # The readiness is confirmed once the server is listening
+    assert await asyncio.wait_for(utils.wait_ready(ready_fd), 1)
+    assert server.listening_fds() == [sock.fileno()]
+
+    client = SocketForwarder("127.0.0.1", unused_tcp_port)
+    await client.connect()
+    await client.process_message(message)
+    await asyncio.sleep(0.1)
+    assert len(server.clients) == 1
+
+    # The connections are closed and the queue is given the time to drain
+    shutdown = asyncio.create_task(server.shutdown(1))
+    await asyncio.sleep(0.1)
+    assert not server.clients
+    assert not task.done()
+
+    assert await forwarder.get() == message
+    forwarder.done(1)
+    await asyncio.wait_for(shutdown, 1)
+    await asyncio.wait_for(task, 1)
+
+    with pytest.raises(OSError):
+        await asyncio.open_connection("127.0.0.1", unused_tcp_port)
+
+
+@pytest.mark.asyncio
+async def test_server_replace_forwarder(unused_tcp_port):
+    old, new = Forwarder(), Forwarder()
+    old.process = new.process = AsyncMock()
+    server = LogServer("127.0.0.1", unused_tcp_port, old, client_queue_size=10)
+    server._start_forwarder()
+
+    await old.put({"level": 20, "message": "queued"})
+    await server.replace_forwarder(new, 0.01)
+
+    # The remaining messages are moved to the new forwarder
+    assert server.forwarder is server.scheduler.forwarder is new
+    assert old.empty()
+    assert await new.get() == {"level": 20, "message": "queued"}
+    assert len(server.tasks) == 1
+
+
+def test_server_reload_tokens(unused_tcp_port, tmp_path):
+    path = tmp_path / "tokens.json"
+    path.write_text(json.dumps({"abc": {}}))
+
+    server = LogServer("127.0.0.1", unused_tcp_port, AsyncMock())
+    server.reload_tokens(str(path))
+    assert server.tokens == {"abc": {}}
+
+    # Invalid files keep the tokens
+    path.write_text("{")
+    server.reload_tokens()
+    assert server.tokens == {"abc": {}}
+
+
+def test_split_frames():
+    frame = json.dumps({"level": 20}).encode()
+    data = struct.pack(">L", len(frame)) + frame
+    assert split_frames(data * 2) == [frame, frame]
+
+    for invalid in (data[:-1], data + b"\x00", struct.pack(">L", 0)):
+        with pytest.raises((ValueError, struct.error)):
+            split_frames(invalid)
+
+
+@pytest.mark.asyncio
+async def test_server_datagram(unused_tcp_port, unused_udp_port, tmp_path):
+    path = tmp_path / "tokens.json"
+    path.write_text(json.dumps({"abc": {"name": "client"}}))
+
+    forwarder = Forwarder()
+    forwarder.process = AsyncMock()
+    server = LogServer(
+        "127.0.0.1",
+        unused_tcp_port,
+        forwarder,
+        token_file=str(path),
+        client_queue_size=10,
+        udp_address=("127.0.0.1", unused_udp_port),
+    )
+    task = asyncio.create_task(server.run())
+    await asyncio.sleep(0.1)
+
+    handler = JSONDatagramHandler("127.0.0.1", unused_udp_port, token="abc")
+    handler.emit(logging.makeLogRecord({"msg": "hello", "levelno": 30}))
+    await asyncio.sleep(0.1)
+
+    # Datagrams bypass the client queues
+    message = await forwarder.get()
+    assert message["message"] == "hello"
+    assert message["host"] == "client"
+    forwarder.done(1)
+
+    # Unknown tokens and broken datagrams are dropped
+    handler.prefix = handler._convert_json({"token": "def"})
+    handler.emit(logging.makeLogRecord({"msg": "hello"}))
+    handler.send(b"\x00\x00\x00\xffbroken")
+    await asyncio.sleep(0.1)
+    assert forwarder.empty()
+
+    handler.close()
+    await server.stop()
+    await asyncio.wait_for(task, 1)
+    assert all(listener.is_closing() for listener in server.listeners)
+
+
+@pytest.mark.asyncio
+async def test_server_syslog(unused_tcp_port, unused_udp_port):
+    forwarder = Forwarder()
+    forwarder.process = AsyncMock()
+    server = LogServer(
+        "127.0.0.1",
+        unused_tcp_port,
+        forwarder,
+        use_auth=False,
+        syslog_address=("127.0.0.1", unused_udp_port),
+    )
+    task = asyncio.create_task(server.run())
+    await asyncio.sleep(0.1)
+
+    # Octet counting and newline framing can be mixed within a stream. Lines
+    # starting with a digit aren't octet counted without the space
+    reader, writer = await asyncio.open_connection("127.0.0.1", unused_udp_port)
+    frame = b"<11>1 - host app 7 - - broken"
+    writer.write(b"%d %s" % (len(frame), frame))
+    writer.write(b"<14>Feb  5 17:32:18 cron: first\n\n2021-01-01 plain\n<14>last")
+    writer.write_eof()
+    await writer.drain()
+    await asyncio.sleep(0.1)
+
+    messages = {m["message"]: m for m in [await forwarder.get() for _ in range(4)]}
+    assert set(messages) == {"broken", "first", "2021-01-01 plain", "last"}
+    assert messages["broken"]["level"] == logging.ERROR
+    assert messages["broken"]["host"] == "host"
+    assert messages["first"]["host"] == "127.0.0.1"
+    assert isinstance(messages["last"], Record)
+    writer.close()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(b"<13>Feb  5 17:32:18 cron: datagram", ("127.0.0.1", unused_udp_port))
+    sock.close()
+    await asyncio.sleep(0.1)
+    assert (await forwarder.get())["message"] == "datagram"
+
+    # Oversized frames close the connection
+    server.max_frame_size = 10
+    reader, writer = await asyncio.open_connection("127.0.0.1", unused_udp_port)
+    writer.write(b"100 <13>")
+    await writer.drain()
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+    assert forwarder.empty()
+
+    await server.shutdown(0.1)
+    await asyncio.wait_for(task, 1)
+    udp, tcp = server.listeners
+    assert udp.is_closing() and not tcp.is_serving()
+
+
+@pytest.mark.asyncio
+async def test_server_unix(unused_tcp_port, tmp_path):
+    path = str(tmp_path / "log.sock")
+    forwarder = Forwarder()
+    forwarder.process = AsyncMock()
+    server = LogServer(
+        "127.0.0.1",
+        unused_tcp_port,
+        forwarder,
+        unix_path=path,
+        unix_mode=0o600,
+        unix_uids=[os.getuid()],
+    )
+    task = asyncio.create_task(server.run())
+    await asyncio.sleep(0.1)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert len(server.listening_fds()) == 2
+
+    # The clients are identified by their user without a token
+    handler = JSONSocketHandler(path)
+    handler.emit(logging.makeLogRecord({"msg": "hello"}))
+    message = await asyncio.wait_for(forwarder.get(), 1)
+    assert message["message"] == "hello"
+    assert message["host"] == utils.user_name(os.getuid())
+    forwarder.done(1)
+    handler.close()
+
+    # Other users are rejected
+    server.unix_uids = {os.getuid() + 1}
+    reader, writer = await asyncio.open_unix_connection(path)
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+    writer.close()
+
+    await server.stop()
+    await asyncio.wait_for(task, 1)
+
+
+async def post(reader, writer, body: bytes, **headers) -> tuple:
+    headers = {"Content-Length": len(body), **headers}
+    head = "".join(
+        f"{key.replace('_', '-')}: {value}\r\n" for key, value in headers.items()
+    )
+    writer.write(f"POST /logs HTTP/1.1\r\n{head}\r\n".encode() + body)
+
+    # Skip the interim responses
+    statuses = []
+    while not statuses or statuses[-1] == 100:
+        head = await reader.readuntil(b"\r\n\r\n")
+        statuses.append(int(head.split()[1]))
+
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    return statuses, head, json.loads(await reader.readexactly(length))
+
+
+@pytest.mark.asyncio
+async def test_server_http(unused_tcp_port, unused_tcp_port_factory):
+    port = unused_tcp_port_factory()
+    forwarder = Forwarder(max_size=3)
+    forwarder.process = AsyncMock()
+    server = LogServer(
+        "127.0.0.1", unused_tcp_port, forwarder, http_address=("127.0.0.1", port)
+    )
+    server.add_token("abc", name="client")
+    task = asyncio.create_task(server.run())
+    await asyncio.sleep(0.1)
+
+    message = {
+        "level": 20,
+        "pid": 1,
+        "message": "hello",
+        "created_at": "2021-01-01 00:00:00",
+        "created_by": "me",
+    }
+    lines = f"{json.dumps(message)}\n{{}}\ninvalid\n".encode()
+    auth = {"Authorization": "Bearer abc"}
+
+    # Plain and gzip compressed bodies on the same connection
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    result = await post(reader, writer, lines, **auth)
+    assert result[0] == [200]
+    assert result[2] == {"accepted": 1, "rejected": 2}
+
+    body = gzip.compress(lines)
+    result = await post(
+        reader, writer, body, Content_Encoding="gzip", Expect="100-continue", **auth
+    )
+    assert result[0] == [100, 200]
+    assert result[2] == {"accepted": 1, "rejected": 2}
+
+    received = [await forwarder.get() for _ in range(2)]
+    assert all(m["host"] == "client" for m in received)
+    forwarder.done(2)
+
+    # Backpressure stops the ingestion and closes the connection
+    result = await post(reader, writer, lines * 4, **auth)
+    assert result[0] == [429]
+    assert b"Retry-After: 1" in result[1]
+    assert result[2] == {"accepted": 3, "rejected": 4}
+    assert await reader.read() == b""
+    writer.close()
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    assert (await post(reader, writer, lines, **auth))[0] == [429]
+    writer.close()
+
+    for _ in range(3):
+        await forwarder.get()
+    forwarder.done(3)
+
+    # Unknown tokens are rejected
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    result = await post(reader, writer, lines, Authorization="Bearer def")
+    assert result[0] == [401]
+    writer.close()
+
+    await server.shutdown(0.1)
+    await asyncio.wait_for(task, 1)
+
+
+@pytest.mark.asyncio
+async def test_server_relay_invalid(unused_tcp_port_factory):
+    message = {
+        "level": 20,
+        "pid": 1,
+        "message": "hello",
+        "created_at": "2021-01-01 00:00:00",
+        "created_by": "me",
+    }
+
+    # A gateway relays to the final server
+    final_port, gateway_port = unused_tcp_port_factory(), unused_tcp_port_factory()
+    final = Forwarder()
+    final.process = AsyncMock()
+    server = LogServer("127.0.0.1", final_port, final, use_auth=False)
+    upstream = SocketForwarder("127.0.0.1", final_port)
+    gateway = LogServer("127.0.0.1", gateway_port, upstream, use_auth=False, relay=True)
+    tasks = [asyncio.create_task(s.run()) for s in (server, gateway)]
+    await asyncio.sleep(0.1)
+
+    good = SocketForwarder("127.0.0.1", gateway_port)
+    await good.connect()
+    await good.process_message(message)
+    assert await asyncio.wait_for(final.get(), 1) == message
+    connection = upstream.writer
+
+    # Malformed frames of a client don't break the upstream connection
+    for frame in (
+        b'{"level": 20, "pid" "created_at" "created_by" "message"}',
+        b'{"level": 20, "message": "pid created_at created_by"}',
+    ):
+        writer = (await asyncio.open_connection("127.0.0.1", gateway_port))[1]
+        writer.write(struct.pack(">L", len(frame)) + frame)
+        await writer.drain()
+        writer.close()
+    await asyncio.sleep(0.2)
+
+    await good.process_message(message)
+    assert await asyncio.wait_for(final.get(), 1) == message
+    assert upstream.writer is connection
+    assert final.empty()
+
+    for s in (gateway, server):
+        await s.stop()
+    await asyncio.wait_for(asyncio.gather(*tasks), 1)
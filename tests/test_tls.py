@@ -0,0 +1,136 @@
+import asyncio
+import shutil
+import ssl
+import subprocess
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from log_proxy import utils
+from log_proxy.forwarders import SocketForwarder
+from log_proxy.tls import SessionContext, server_port
+
+
+@pytest.fixture
+def certificate(tmp_path):
+    if not shutil.which("openssl"):
+        pytest.skip("openssl is required to create a certificate")
+
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-keyout",
+            str(key),
+            "-out",
+            str(cert),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return str(cert), str(key)
+
+
+def test_session_context_resume():
+    ctx = SessionContext()
+    connection = MagicMock(server_side=False, server_hostname="example.org")
+
+    # The TLS 1.3 session without ticket can't be resumed
+    connection.session_reused = False
+    connection.session = MagicMock(has_ticket=False, id=b"")
+    assert not ctx.handshake(connection)
+    assert ctx.sessions == {}
+
+    connection.session.has_ticket = True
+    assert ctx.save(connection, 443)
+    assert ctx.sessions == {("example.org", 443): connection.session}
+
+    # The session is offered again to the same server
+    with patch.object(ssl.SSLContext, "wrap_bio") as wrap:
+        with server_port(443):
+            ctx.wrap_bio(None, None, server_hostname="example.org")
+        assert wrap.call_args.kwargs["session"] == connection.session
+
+        with server_port(443):
+            ctx.wrap_bio(None, None, server_hostname="other.org")
+        assert wrap.call_args.kwargs["session"] is None
+
+        # Other ports of the host are different servers
+        with server_port(8443):
+            ctx.wrap_bio(None, None, server_hostname="example.org")
+        assert wrap.call_args.kwargs["session"] is None
+
+    with patch.object(ssl.SSLContext, "wrap_socket") as wrap:
+        with server_port(443):
+            ctx.wrap_socket(None, server_hostname="example.org")
+        assert wrap.call_args.kwargs["session"] == connection.session
+
+
+def test_session_context_stats():
+    ctx = SessionContext(ssl.PROTOCOL_TLS_SERVER)
+    assert ctx.stats() == {"handshakes": 0, "resumed": 0, "resumed_ratio": 0}
+
+    connection = MagicMock(server_side=True, session_reused=True)
+    assert not ctx.handshake(connection)
+    connection.session_reused = False
+    ctx.handshake(connection)
+
+    assert ctx.stats() == {"handshakes": 2, "resumed": 1, "resumed_ratio": 0.5}
+    assert ctx.sessions == {}
+
+
+@pytest.mark.asyncio
+async def test_session_context_loopback(certificate, unused_tcp_port_factory):
+    cert, key = certificate
+
+    async def accept(reader, writer):
+        await reader.read()
+        writer.close()
+
+    # Two servers on the same host with their own session tickets
+    servers, ports = [], []
+    for _ in range(2):
+        ports.append(unused_tcp_port_factory())
+        servers.append(
+            await asyncio.start_server(
+                accept,
+                "localhost",
+                ports[-1],
+                ssl=utils.generate_ssl_context(cert=cert, key=key, server=True),
+            )
+        )
+
+    client = utils.generate_ssl_context(ca=cert)
+
+    async def connect(port):
+        forwarder = SocketForwarder("localhost", port, ssl_context=client)
+        await forwarder.connect()
+        await forwarder.process_message({"message": "hello"})
+        await asyncio.sleep(0.1)
+        resumed = forwarder.writer.get_extra_info("ssl_object").session_reused
+        forwarder.writer.close()
+        forwarder.invalidate()
+        return resumed
+
+    try:
+        assert not await connect(ports[0])
+        assert not await connect(ports[1])
+        assert set(client.sessions) == {("localhost", port) for port in ports}
+
+        # The sessions are resumed per server
+        assert await connect(ports[0])
+        assert await connect(ports[1])
+        assert client.stats()["resumed"] == 2
+    finally:
+        for server in servers:
+            server.close()
+            await server.wait_closed()
@@ -1,11 +1,14 @@
 import argparse
+import asyncio
 import logging
+import os
+import socket
 import ssl
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from log_proxy import JSONSocketHandler, utils
+from log_proxy import JSONSocketHandler, base, forwarders, utils
 
 
 def test_configure_logging():
@@ -34,17 +37,20 @@ def test_configure_logging():
 
 def test_generate_ssl_context():
     ctx = utils.generate_ssl_context()
-    assert isinstance(ctx, ssl.SSLContext)
+    assert isinstance(ctx, utils.SessionContext)
 
-    with patch("ssl.SSLContext"):
+    with patch("log_proxy.utils.SessionContext"):
         ctx = utils.generate_ssl_context(
             cert="cert",
             key="key",
             ca="ca",
             ciphers="ciphers",
             server=True,
+            tickets=4,
         )
 
+        assert ctx.num_tickets == 4
+
         ctx.load_cert_chain.assert_called_once_with("cert", keyfile="key")
         ctx.load_verify_locations.assert_called_once_with(cafile="ca")
         ctx.set_ciphers.assert_called_once_with("ciphers")
@@ -91,6 +97,60 @@ def test_parse_address():
     assert utils.parse_address(addresses, multiple=True), (hosts, 80)
 
 
+def test_inherited_sockets():
+    assert utils.inherited_sockets() is None
+
+    sock = socket.socket()
+    with patch.dict(os.environ, {base.LISTEN_FDS_ENV: str(sock.fileno())}):
+        (inherited,) = utils.inherited_sockets()
+        assert inherited.fileno() == sock.fileno()
+        assert base.LISTEN_FDS_ENV not in os.environ
+
+    inherited.detach()
+    sock.close()
+
+
+def test_parse_users():
+    root = utils.user_name(0)
+    assert utils.parse_users(f"{root}, 1000,") == {0, 1000}
+    assert utils.user_name(2**31 - 2) == str(2**31 - 2)
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        utils.parse_users("unknown-user-name")
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "log.sock")
+    utils.unix_socket(path, 0o600).close()
+
+    # Stale sockets are replaced
+    sock = utils.unix_socket(path, 0o640)
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    sock.listen()
+
+    client = socket.socket(socket.AF_UNIX)
+    client.connect(path)
+    conn, _ = sock.accept()
+    assert utils.peer_credentials(conn) == (os.getpid(), os.getuid(), os.getgid())
+    for s in (conn, client, sock):
+        s.close()
+
+    # Other files aren't touched
+    os.remove(path)
+    with open(path, "w"):
+        pass
+    with pytest.raises(OSError):
+        utils.unix_socket(path, 0o600)
+
+
+def test_parse_addresses():
+    assert utils.parse_addresses("example.org", port=80) == [("example.org", 80)]
+    assert utils.parse_addresses("a:1, b", port=80) == [("a", 1), ("b", 80)]
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        utils.parse_addresses("a:1,", port=80)
+
+
 @pytest.mark.asyncio
 async def test_receive_struct():
     reader = AsyncMock()
@@ -98,17 +158,44 @@ async def test_receive_struct():
     assert await utils.receive_struct(reader, ">L2s") == (18, b"{}")
 
 
+def test_lines_to_messages():
+    (msg,) = utils.lines_to_messages(["", " hello ", "  "], "stdin")
+    assert msg["message"] == "hello"
+    assert msg["created_by"] == "stdin"
+    assert msg["level"] == logging.INFO
+
+
 @pytest.mark.asyncio
-async def test_stdin_to_log():
-    log = logging.getLogger().info = MagicMock()
+async def test_stdin_to_forwarder():
+    forwarder = forwarders.Forwarder(max_size=2)
+    chunks = [b"hello\nwor", b"ld\n\nlast", b""]
 
     with patch("asyncio.get_event_loop") as mock:
         with patch("asyncio.StreamReader") as reader:
             mock.return_value = AsyncMock()
-            reader.return_value.readline = AsyncMock(side_effect=[b"hello\n", b""])
-            await utils.stdin_to_log()
+            reader.return_value.read = AsyncMock(side_effect=list(chunks))
+            await utils.stdin_to_forwarder(forwarder, block=False)
             mock.assert_called_once()
-            log.assert_called_once_with("hello")
+
+    # The chunks are split into full lines and the oldest line was dropped
+    assert [(await forwarder.get())["message"] for _ in range(2)] == ["world", "last"]
+    assert forwarder.dropped == {logging.INFO: 1}
+
+    # Blocking waits for free space in the queue
+    forwarder = forwarders.Forwarder(max_size=1)
+    with patch("asyncio.get_event_loop") as mock:
+        with patch("asyncio.StreamReader") as reader:
+            mock.return_value = AsyncMock()
+            reader.return_value.read = AsyncMock(side_effect=list(chunks))
+            task = asyncio.create_task(utils.stdin_to_forwarder(forwarder))
+            await asyncio.sleep(0.01)
+            assert not task.done()
+
+            messages = [(await forwarder.get())["message"] for _ in range(3)]
+            await task
+
+    assert messages == ["hello", "world", "last"]
+    assert not forwarder.dropped
 
 
 def test_valid_file():
@@ -117,6 +204,13 @@ def test_valid_file():
     assert utils.valid_file(__file__) == __file__
 
 
+def test_positive_float():
+    assert utils.positive_float("0.5") == 0.5
+    for value in ["0", "-1", "abc"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            utils.positive_float(value)
+
+
 def test_parser():
     parser = utils.ConfigArgumentParser()
     parser.add_argument("-f-a", "--flag-a")
@@ -1,14 +1,24 @@
 import asyncio
+import json
 import os
+import threading
 import time
 from tempfile import NamedTemporaryFile
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 
 import pytest
-from watchdog.events import FileModifiedEvent
+from watchdog.events import (
+    DirModifiedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
 from watchdog.observers import Observer
 
-from log_proxy.watcher import WatcherHandler, watch
+from log_proxy import forwarders
+from log_proxy.server import RequiredFields
+from log_proxy.watcher import MIN_POLL_INTERVAL, PollingObserver, WatcherHandler, watch
 
 
 @pytest.fixture
@@ -48,22 +58,22 @@ def test_watcher(named_file):
         named_file.flush()
         time.sleep(0.1)
 
-        mock = handler.on_new_line = MagicMock()
+        mock = handler.on_new_lines = MagicMock()
 
         named_file.write("test\n")
         named_file.flush()
         time.sleep(0.1)
 
-        mock.assert_called_once_with(named_file.name, "test")
+        mock.assert_called_once_with(named_file.name, ["test"])
         mock.reset_mock()
 
-        # Skip if the file is smaller now
+        # Read the file from the start if it got truncated
         handler.observed[named_file.name] = 100
         named_file.seek(0)
         named_file.write("abc\n")
         named_file.flush()
         time.sleep(0.1)
-        mock.assert_not_called()
+        mock.assert_called_once_with(named_file.name, ["abc", "o", "test"])
     finally:
         observer.stop()
         observer.join()
@@ -77,7 +87,7 @@ def test_watcher_modified(named_file):
 
     get_mock = handler.get_size = MagicMock(return_value=0)
     set_mock = handler.set_size = MagicMock()
-    line_mock = handler.on_new_line = MagicMock(9)
+    line_mock = handler.on_new_lines = MagicMock()
 
     handler.on_modified(None)
     get_mock.assert_not_called()
@@ -92,10 +102,355 @@ def test_watcher_modified(named_file):
     named_file.flush()
 
     handler.on_modified(event)
-    line_mock.assert_called_once_with(named_file.name, "test")
+    line_mock.assert_called_once_with(named_file.name, ["test"])
     set_mock.assert_called_once_with(named_file.name, 5)
 
 
+@pytest.mark.asyncio
+async def test_watcher_forwarder(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_bytes(b"first\n\n  second \r\n\xff\npartial")
+
+    forwarder = forwarders.Forwarder()
+    handler = WatcherHandler(forwarder=forwarder, chunk_size=4)
+
+    # Only full lines are read while empty lines are skipped
+    assert handler.read_lines(str(log), str(log), 0) == 20
+    messages = [await forwarder.get() for _ in range(3)]
+    assert [msg["message"] for msg in messages] == ["first", "second", "\ufffd"]
+    assert all(set(msg).issuperset(RequiredFields) for msg in messages)
+    assert messages[0]["created_by"] == str(log)
+    assert forwarder.empty()
+
+    # Lines from another thread are passed to the loop of the forwarder
+    handler.loop = asyncio.get_running_loop()
+    thread = threading.Thread(target=handler.on_new_lines, args=("a", ["hello"]))
+    thread.start()
+    thread.join()
+    assert forwarder.empty()
+    await asyncio.sleep(0.01)
+    assert (await forwarder.get())["message"] == "hello"
+
+    # Without forwarder nothing happens
+    handler.forwarder = None
+    handler.on_new_lines("a", ["hello"])
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_watcher_scan(tmp_path, workers):
+    for i in range(3):
+        directory = tmp_path / f"dir{i}" / "sub"
+        directory.mkdir(parents=True)
+        (directory / "app.log").write_text("hello\n")
+        (directory / "app.txt").write_text("hello\n")
+    (tmp_path / "app.log").write_text("hi\n")
+
+    handler = WatcherHandler(patterns=["*.log"], workers=workers)
+    handler.read_initial_size(str(tmp_path))
+    assert handler.observed == {
+        str(tmp_path / "app.log"): 3,
+        **{str(tmp_path / f"dir{i}" / "sub" / "app.log"): 6 for i in range(3)},
+    }
+
+    # The match results are cached
+    assert len(handler.matches) == 7
+    with patch("log_proxy.watcher.match_any_paths") as mock:
+        assert handler.match_file(str(tmp_path / "app.log"))
+        mock.assert_not_called()
+
+    # The cache is bounded
+    handler.cache_size = 7
+    handler.match_file(str(tmp_path / "new.log"))
+    assert len(handler.matches) == 1
+
+    with patch("os.scandir", side_effect=OSError()):
+        assert handler.scan(str(tmp_path)) == ([], [])
+
+
+def test_watcher_dispatch(named_file):
+    path, name = os.path.split(named_file.name)
+    handler = WatcherHandler(patterns=[name], ignore_directories=True)
+    handler.on_modified = MagicMock()
+
+    handler.dispatch(FileModifiedEvent(named_file.name))
+    handler.on_modified.assert_called_once()
+
+    handler.on_modified.reset_mock()
+    handler.dispatch(FileModifiedEvent(os.path.join(path, "other")))
+    handler.dispatch(DirModifiedEvent(path))
+    handler.on_modified.assert_not_called()
+
+
+def test_watcher_debounce(named_file):
+    handler = WatcherHandler(debounce=60)
+    handler.read_initial_size(named_file.name)
+    mock = handler.on_new_lines = MagicMock()
+
+    # Bursts of events are collected
+    for line in ["a", "b"]:
+        named_file.write(f"{line}\n")
+        named_file.flush()
+        handler.on_modified(FileModifiedEvent(named_file.name))
+    assert list(handler.modified) == [named_file.name]
+
+    handler.process_modified()
+    mock.assert_not_called()
+
+    # The file is read once after the debounce time
+    handler.debounce = 0.01
+    time.sleep(0.01)
+    handler.process_modified()
+    mock.assert_called_once_with(named_file.name, ["a", "b"])
+    assert not handler.modified
+
+    # Errors are logged
+    handler.modified["/invalid/path"] = 0
+    handler.process_modified()
+    assert not handler.modified
+
+
+def test_watcher_polling(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_text("hello\n")
+
+    handler = WatcherHandler(patterns=["*.log"])
+    handler.read_initial_size(str(tmp_path))
+    mock = handler.on_new_lines = MagicMock()
+
+    # The interval is clamped to keep the poll loop finite
+    observer = PollingObserver(min_interval=0, max_interval=4)
+    assert observer.min_interval == MIN_POLL_INTERVAL
+    observer.schedule(handler, str(tmp_path))
+    observer.scan_directory(str(tmp_path))
+    assert observer.intervals == {str(log): MIN_POLL_INTERVAL}
+    assert observer.directories == {str(tmp_path): os.stat(tmp_path).st_mtime_ns}
+
+    # The first poll only stores the stat
+    observer.poll()
+    mock.assert_not_called()
+
+    # Idle files back off
+    for interval in [1, 2, 4, 4]:
+        observer.intervals[str(log)] = interval / 2
+        observer.schedules = [(0, str(log))]
+        observer.poll()
+        assert observer.intervals[str(log)] == interval
+
+    # Changed files are read and polled again quickly
+    with log.open("a") as fp:
+        fp.write("world\n")
+    observer.schedules = [(0, str(log))]
+    observer.poll()
+    mock.assert_called_once_with(str(log), ["world"])
+    assert observer.intervals[str(log)] == MIN_POLL_INTERVAL
+
+    # New files in changed directories are read from the start
+    mock.reset_mock()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "new.log").write_text("new\n")
+    observer.scan()
+    assert str(tmp_path / "sub") in observer.directories
+    observer.schedules = [(0, str(tmp_path / "sub" / "new.log"))]
+    observer.poll()
+    mock.assert_called_once_with(str(tmp_path / "sub" / "new.log"), ["new"])
+
+    # Deleted files and directories are removed
+    os.remove(tmp_path / "sub" / "new.log")
+    os.rmdir(tmp_path / "sub")
+    observer.scan()
+    assert str(tmp_path / "sub") not in observer.directories
+    observer.schedules = [(0, str(tmp_path / "sub" / "new.log"))]
+    observer.poll()
+    assert str(tmp_path / "sub" / "new.log") not in observer.intervals
+
+    observer.scan_directory(str(tmp_path / "sub"))
+    assert str(tmp_path / "sub") not in observer.directories
+    assert str(tmp_path / "sub" / "new.log") not in handler.observed
+    assert str(tmp_path / "sub" / "new.log") not in handler.inodes
+
+
+def test_watcher_polling_rename(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_text("hello\n")
+
+    handler = WatcherHandler(patterns=["*.log", "*.log.*"])
+    handler.read_initial_size(str(tmp_path))
+    mock = handler.on_new_lines = MagicMock()
+
+    observer = PollingObserver()
+    observer.schedule(handler, str(tmp_path))
+    observer.scan_directory(str(tmp_path))
+
+    # The renamed file keeps the offset and isn't sent again
+    os.rename(log, tmp_path / "app.log.1")
+    log.write_text("new\n")
+    observer.scan_directory(str(tmp_path))
+    assert handler.observed[str(tmp_path / "app.log.1")] == 6
+    assert handler.observed[str(log)] == 0
+
+    observer.schedules = [(0, str(tmp_path / "app.log.1")), (0, str(log))]
+    observer.poll()
+    mock.assert_called_once_with(str(log), ["new"])
+
+
+def test_watcher_polling_thread(named_file):
+    handler = WatcherHandler()
+    handler.read_initial_size(named_file.name)
+    mock = handler.on_new_lines = MagicMock()
+
+    observer = PollingObserver(min_interval=0.01, scan_interval=0.01)
+    observer.schedule(handler, named_file.name)
+    observer.start()
+    try:
+        time.sleep(0.05)
+        named_file.write("hello\n")
+        named_file.flush()
+        time.sleep(0.1)
+        mock.assert_called_once_with(named_file.name, ["hello"])
+    finally:
+        observer.stop()
+        observer.join()
+    assert not observer.is_alive()
+
+
+def test_watcher_checkpoint(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_text("hello\n")
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    handler = WatcherHandler(patterns=["*.log"], checkpoint=checkpoint)
+    handler.read_initial_size(str(tmp_path))
+    assert handler.observed == {str(log): 6}
+
+    # Nothing is written if nothing changed
+    handler.dirty = False
+    handler.save_checkpoint()
+    assert not os.path.isfile(checkpoint)
+
+    handler.dirty = True
+    handler.save_checkpoint()
+    assert not handler.dirty
+    with open(checkpoint) as fp:
+        assert json.load(fp) == {str(log): [os.stat(log).st_ino, 6]}
+
+    # Continue after a restart
+    with log.open("a") as fp:
+        fp.write("world\n")
+
+    handler = WatcherHandler(patterns=["*.log"], checkpoint=checkpoint)
+    mock = handler.on_new_lines = MagicMock()
+    handler.read_initial_size(str(tmp_path))
+    mock.assert_called_once_with(str(log), ["world"])
+    assert handler.observed == {str(log): 12}
+    handler.save_checkpoint()
+
+    # Rotate the file while the watcher is down
+    with log.open("a") as fp:
+        fp.write("rotated\n")
+    log.rename(tmp_path / "app.log.1")
+    log.write_text("new\n")
+
+    handler = WatcherHandler(patterns=["*.log"], checkpoint=checkpoint)
+    mock = handler.on_new_lines = MagicMock()
+    handler.read_initial_size(str(tmp_path))
+    assert mock.call_args_list == [
+        call(str(log), ["rotated"]),
+        call(str(log), ["new"]),
+    ]
+    assert handler.observed == {str(log): 4}
+
+    # Invalid checkpoint files are ignored
+    with open(checkpoint, "w") as fp:
+        fp.write("invalid")
+    handler = WatcherHandler(patterns=["*.log"], checkpoint=checkpoint)
+    handler.read_initial_size(str(tmp_path))
+    assert handler.observed == {str(log): 4}
+
+    # Failed writes are retried with the next save
+    handler.checkpoint = str(tmp_path / "missing" / "checkpoint.json")
+    handler.dirty = True
+    handler.save_checkpoint()
+    assert handler.dirty
+
+
+def test_watcher_rotation(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_text("hello\n")
+
+    handler = WatcherHandler(patterns=["*.log"])
+    handler.read_initial_size(str(tmp_path))
+    mock = handler.on_new_lines = MagicMock()
+
+    # Rename the file and finish reading it before switching
+    with log.open("a") as fp:
+        fp.write("world\n")
+    log.rename(tmp_path / "app.log.1")
+    handler.on_moved(FileMovedEvent(str(log), str(tmp_path / "app.log.1")))
+    mock.assert_called_once_with(str(log), ["world"])
+    assert handler.observed == {}
+
+    log.write_text("new\n")
+    handler.on_created(FileCreatedEvent(str(log)))
+    handler.on_modified(FileModifiedEvent(str(log)))
+    mock.assert_called_with(str(log), ["new"])
+    assert handler.observed == {str(log): 4}
+
+    # A new inode at the same path is read from the start
+    mock.reset_mock()
+    (tmp_path / "other").write_text("other\n")
+    os.replace(tmp_path / "other", log)
+    handler.on_modified(FileModifiedEvent(str(log)))
+    mock.assert_called_once_with(str(log), ["other"])
+
+    # Unknown files and other events are ignored
+    mock.reset_mock()
+    handler.on_moved(FileMovedEvent(str(tmp_path / "a"), str(tmp_path / "b")))
+    handler.on_moved(None)
+    handler.on_created(None)
+    handler.on_deleted(None)
+    mock.assert_not_called()
+
+    # Deleted files are forgotten
+    log.unlink()
+    handler.on_deleted(FileDeletedEvent(str(log)))
+    assert handler.observed == {}
+    assert handler.inodes == {}
+
+
+def test_watcher_deferred_events(tmp_path):
+    log = tmp_path / "app.log"
+    log.write_text("hello\n")
+
+    handler = WatcherHandler(patterns=["*.log"], debounce=60)
+    handler.read_initial_size(str(tmp_path))
+    mock = handler.on_new_lines = MagicMock()
+
+    # Events of the observer thread are handled by the reader of the files
+    with log.open("a") as fp:
+        fp.write("world\n")
+    log.rename(tmp_path / "app.log.1")
+    log.write_text("new\n")
+    handler.on_modified(FileModifiedEvent(str(log)))
+    handler.on_moved(FileMovedEvent(str(log), str(tmp_path / "app.log.1")))
+    handler.on_created(FileCreatedEvent(str(log)))
+    mock.assert_not_called()
+    assert len(handler.events) == 2
+
+    handler.process_modified()
+    mock.assert_called_once_with(str(log), ["world"])
+    assert not handler.events
+    assert handler.observed == {str(log): 0}
+
+    # Deleting drops the pending modification
+    log.unlink()
+    handler.on_deleted(FileDeletedEvent(str(log)))
+    handler.debounce = 0.001
+    time.sleep(0.01)
+    handler.process_modified()
+    assert handler.observed == {}
+    assert not handler.modified
+
+
 @pytest.mark.asyncio
 @patch("log_proxy.watcher.Observer")
 async def test_watch(mock, named_file):
@@ -103,7 +458,7 @@ async def test_watch(mock, named_file):
     observer.is_alive.side_effect = [True, False]
 
     path, name = os.path.split(named_file.name)
-    await watch(path, patterns=[name])
+    await watch(path, MagicMock(), patterns=[name])
     await asyncio.sleep(0.1)
 
     mock.assert_called_once()
@@ -112,3 +467,15 @@ async def test_watch(mock, named_file):
     observer.start.assert_called_once()
     observer.stop.assert_called_once()
     observer.join.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch("log_proxy.watcher.PollingObserver")
+async def test_watch_polling(mock, named_file):
+    observer = mock.return_value
+    observer.is_alive.side_effect = [True, False]
+
+    await watch(named_file.name, MagicMock(), backend="poll", poll_interval=1)
+    mock.assert_called_once_with(1, 10)
+    observer.schedule.assert_called_once()
+    observer.start.assert_called_once()